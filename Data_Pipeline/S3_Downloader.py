@@ -1,28 +1,32 @@
-import boto3
+import argparse
 import os
 from pathlib import Path
 
-s3 = boto3.client("s3")
+from s3_transfer import download_prefix, make_client, make_transfer_config
+import metrics  # s3_transfer puts the repo root on sys.path
 
 SOURCE_BUCKET = "memoryscapes-media-dev"
 SOURCE_PREFIX = "uploads/raw"
 
 ##Download photos from S3 bucket
-def download_photos():
-    objects = s3.list_objects_v2(Bucket=SOURCE_BUCKET, Prefix=SOURCE_PREFIX)
-    download_dir = Path("/app/Data/input_images")
-    download_dir.mkdir(parents=True, exist_ok=True)
-    for obj in objects.get("Contents", []):
-        key = obj["Key"]
-        if key.endswith("/"): 
-            continue
-        file_path = download_dir / Path(key).name
-        s3.download_file(SOURCE_BUCKET, key, str(file_path))
-        # print(f"Downloaded: {file_path}")
+def download_photos(download_dir="/app/Data/input_images", max_workers=16, s3=None):
+    # paginated listing + concurrent downloads; unchanged objects (same ETag/size) are skipped
+    s3 = s3 or make_client(max_workers)
+    download_dir = Path(download_dir)
+    downloaded, skipped, failed = download_prefix(s3, SOURCE_BUCKET, SOURCE_PREFIX, download_dir,
+                                                  max_workers=max_workers, transfer_config=make_transfer_config())
+    print(f"Downloaded {len(downloaded)}, skipped {len(skipped)} unchanged, {len(failed)} failed -> {download_dir}")
     return download_dir
 
 def main():
-    photos_dir = download_photos()
+    parser = argparse.ArgumentParser(description="Download raw uploads from S3")
+    parser.add_argument("--download-dir", type=str, default="/app/Data/input_images")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("S3_WORKERS", 16)))
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="record per-object transfer times as JSON lines or a *.prom textfile (default: $NIGHTSHADE_METRICS)")
+    args = parser.parse_args()
+    metrics.configure(args.metrics)
+    photos_dir = download_photos(args.download_dir, args.workers)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,35 @@
-import boto3
+import argparse
 import os
 from pathlib import Path
 
-s3 = boto3.client("s3")
+from s3_transfer import MANIFEST_NAME, make_client, make_transfer_config, upload_files
+import metrics  # s3_transfer puts the repo root on sys.path
 
 SOURCE_BUCKET = "memoryscapes-media-dev"
 DEST_PREFIX = "uploads/poison/"
 
 #upload images to s3 bucket
-def upload_file(file_path):
-    dest_key = f"{DEST_PREFIX}{file_path.name}"
-    s3.upload_file(str(file_path), SOURCE_BUCKET, dest_key)
-    print(f"Uploaded -> s3://{SOURCE_BUCKET}/{dest_key}")
+def upload_dir(processed_photos, max_workers=16, s3=None):
+    # concurrent uploads with retries; files unchanged since the last successful upload are skipped
+    s3 = s3 or make_client(max_workers)
+    processed_photos = Path(processed_photos)
+    uploaded, skipped, failed = upload_files(s3, SOURCE_BUCKET, DEST_PREFIX, sorted(processed_photos.iterdir()),
+                                             manifest_path=processed_photos / MANIFEST_NAME,
+                                             max_workers=max_workers, transfer_config=make_transfer_config())
+    for key in uploaded:
+        print(f"Uploaded -> s3://{SOURCE_BUCKET}/{key}")
+    print(f"Uploaded {len(uploaded)}, skipped {len(skipped)} unchanged, {len(failed)} failed")
+    return uploaded
 
-    
 def main():
-    processed_photos = Path("/app/Data/s3_image_upload")
-    for img_file in processed_photos.iterdir():
-        upload_file(img_file)
+    parser = argparse.ArgumentParser(description="Upload poisoned images to S3")
+    parser.add_argument("--upload-dir", type=str, default="/app/Data/s3_image_upload")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("S3_WORKERS", 16)))
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="record per-object transfer times as JSON lines or a *.prom textfile (default: $NIGHTSHADE_METRICS)")
+    args = parser.parse_args()
+    metrics.configure(args.metrics)
+    upload_dir(args.upload_dir, args.workers)
 
 if __name__ == "__main__":
     main()
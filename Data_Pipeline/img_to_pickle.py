@@ -4,56 +4,158 @@
 #!/usr/bin/env python
 # ...existing code...
 import argparse
+import json
 import os
 import sys
-import pickle as pkl
+from collections import defaultdict, deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List
 
 import numpy as np
 from PIL import Image, UnidentifiedImageError
 import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset_store import ShardReader, is_shard_store, open_writer
+from caching import EmbeddingCache, content_hash
+# re-exported: poison_worker.py and the benchmarks import the BLIP helpers from here
+from captioning import BLIP_MODEL_ID, CaptionEngine, auto_batch_size, caption_dtype, caption_images, load_blip
+
 ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tiff"}
+# every later stage works on 512x512 crops, so nothing needs more than a 512px short side
+STORE_MIN_SIDE = 512
+DUPLICATES_FILE = "duplicates.json"
+
+try:
+    # optional: phone uploads are often HEIC
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    ALLOWED_EXTS |= {".heic", ".heif"}
+except ImportError:
+    pass
 
 #get list of images in a directory
 def list_images(input_dir: Path) -> List[Path]:
     return sorted([p for p in input_dir.iterdir() if p.suffix.lower() in ALLOWED_EXTS and p.is_file()])
 
 #load image with error handling
-def load_image_safe(p: Path):
+def load_image_safe(p: Path, min_side=None):
+    """
+    RGB image, or None if unreadable. With min_side, the image is decoded at reduced size: JPEG
+    draft mode lets libjpeg scale by 1/2..1/8 while decoding, then a resize brings the short side
+    down to min_side (images already smaller are left alone).
+    """
     try:
         with Image.open(p) as im:
+            if min_side:
+                scale = min_side / min(im.size)
+                if scale < 1:
+                    target = (max(min_side, round(im.width * scale)), max(min_side, round(im.height * scale)))
+                    # draft picks the smallest DCT scale that still covers the requested size
+                    im.draft("RGB", target)
+                    im = im.convert("RGB")
+                    scale = min_side / min(im.size)
+                    if scale < 1:
+                        size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+                        im = im.resize(size, Image.Resampling.BICUBIC, reducing_gap=3.0)
+                    return im
             return im.convert("RGB")
     except (UnidentifiedImageError, OSError):
         return None
-#save pickle file with image and text
-def save_pickle(path: Path, img_obj: Image.Image, text: str = ""):
-    arr = np.array(img_obj, dtype=np.uint8)
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "wb") as f:
-        pkl.dump({"img": arr, "text": text}, f, protocol=4)
-
-#batching helper
+
+
+def dhash(img, size=8):
+    """64-bit difference hash: sign of horizontal gradients on a (size+1) x size grayscale thumbnail."""
+    small = np.asarray(img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class NearDuplicateIndex(object):
+    """
+    Finds a stored dHash within max_distance bits of a query. Hashes are split into max_distance+1
+    chunks; by pigeonhole a near duplicate matches at least one chunk exactly, so only hashes sharing
+    a chunk are compared instead of every stored one.
+    """
+
+    def __init__(self, max_distance=4, bits=64):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        self.bounds = [(bits * i // chunks, bits * (i + 1) // chunks) for i in range(chunks)]
+        self.tables = [defaultdict(list) for _ in self.bounds]
+
+    def _parts(self, h):
+        return [(h >> lo) & ((1 << (hi - lo)) - 1) for lo, hi in self.bounds]
+
+    def find(self, h):
+        for table, part in zip(self.tables, self._parts(h)):
+            for other, name in table.get(part, ()):
+                if bin(h ^ other).count("1") <= self.max_distance:
+                    return name
+        return None
+
+    def add(self, h, name):
+        for table, part in zip(self.tables, self._parts(h)):
+            table[part].append((h, name))
+
+
+def ingest_image(p: Path, min_side=STORE_MIN_SIDE):
+    """Decode-pool task: (path, uint8 array, dhash, file content hash), or (path, None, ...) if unreadable."""
+    img = load_image_safe(p, min_side)
+    if img is None:
+        return p, None, None, None
+    return p, np.asarray(img, dtype=np.uint8), dhash(img), content_hash(p)
+
+
+def imap_bounded(pool, fn, items, window):
+    """Ordered pool.map that keeps at most window tasks in flight, so decoded images never pile up."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+#batching helper (any iterable, consumed lazily)
 def batched(seq, n):
-    for i in range(0, len(seq), n):
-        yield seq[i : i + n]
+    batch = []
+    for item in seq:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def main():
     parser = argparse.ArgumentParser(description="Batch caption images and write .p pickles")
     parser.add_argument("--input-dir", type=Path, required=True)
     parser.add_argument("--output-dir", type=Path, required=True)
-    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="BLIP batch size (default: sized from free memory, halved on out-of-memory)")
     parser.add_argument("--max-new-tokens", type=int, default=30)
     parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--format", choices=["pickle", "shard"], default="pickle",
+                        help="one .p per image, or a sharded store (see dataset_store.py)")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="caption cache root (default: $NIGHTSHADE_CACHE_DIR or ~/.cache/nightshade)")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--decode-workers", type=int, default=os.cpu_count(),
+                        help="processes decoding images in parallel with captioning")
+    parser.add_argument("--store-min-side", type=int, default=STORE_MIN_SIDE,
+                        help="decode and store images with this short side; 0 keeps full resolution")
+    parser.add_argument("--dedupe-distance", type=int, default=4,
+                        help="max dHash bit distance at which two photos count as the same shot; -1 disables dedupe")
     args = parser.parse_args()
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    dtype = torch.float16 if device == "cuda" else torch.float32
+    dtype = caption_dtype(device)
     if args.batch_size is None:
-        args.batch_size = 8 if device == "cuda" else 2
+        args.batch_size = auto_batch_size(device, dtype)
 
     images = list_images(args.input_dir)
     if not images:
@@ -63,45 +165,83 @@ def main():
     print(f"[img_to_pickle] Using device={device}, dtype={dtype}, batch_size={args.batch_size}")
     print(f"[img_to_pickle] Found {len(images)} images")
 
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base", use_fast=True)
-    model = BlipForConditionalGeneration.from_pretrained(
-        "Salesforce/blip-image-captioning-base",
-        torch_dtype=dtype
-    ).to(device)
-    model.eval()
-    # Inference loop
-    with torch.inference_mode():
-        # Process images in batches
-        for batch_paths in tqdm(list(batched(images, args.batch_size)), desc="Captioning", unit="batch"):
+    existing = set()
+    seen = NearDuplicateIndex(args.dedupe_distance) if args.dedupe_distance >= 0 else None
+    if not args.overwrite and is_shard_store(args.output_dir):
+        reader = ShardReader(args.output_dir)
+        existing = set(reader.names)
+        # hashes of earlier runs' records, so re-uploads of an already ingested photo are caught too
+        if seen is not None:
+            for rec in reader.records:
+                if "dhash" in rec:
+                    seen.add(int(rec["dhash"], 16), rec["name"])
+
+    # name of every skipped near duplicate -> the record it duplicates
+    duplicates_path = args.output_dir / DUPLICATES_FILE
+    duplicates = {}
+    if not args.overwrite and duplicates_path.exists():
+        with open(duplicates_path, "r", encoding="utf-8") as f:
+            duplicates = json.load(f)
+    known_duplicates = len(duplicates)
+    todo = [p for p in images if args.overwrite or not (
+        (args.output_dir / f"{p.stem}.p").exists() or p.stem in existing or p.stem in duplicates)]
+
+    # captions are cached by file content, so unchanged images skip BLIP on re-runs
+    cache = None if args.no_cache else EmbeddingCache("blip_captions", args.cache_dir)
+    # a caption of the reduced decode is its own cache entry; full-resolution runs keep the old keys
+    decode_params = {"min_side": args.store_min_side} if args.store_min_side else {}
+    engine = None
+    with open_writer(args.output_dir, args.format) as writer, \
+            ProcessPoolExecutor(max_workers=args.decode_workers) as pool:
+        # decoding runs ahead in the pool while the current batch is captioned
+        decode = partial(ingest_image, min_side=args.store_min_side or None)
+        decoded = imap_bounded(pool, decode, todo, window=max(2 * args.batch_size, 2 * args.decode_workers))
+        num_batches = (len(todo) + args.batch_size - 1) // args.batch_size
+        for batch in tqdm(batched(decoded, args.batch_size), total=num_batches, desc="Captioning", unit="batch"):
             to_process = []
-            out_paths = []
-            for p in batch_paths:
-                out_p = args.output_dir / f"{p.stem}.p"
-                if not args.overwrite and out_p.exists():
-                    continue
-                img = load_image_safe(p)
-                if img is None:
+            names = []
+            keys = []
+            hashes = []
+            for p, arr, h, file_hash in batch:
+                if arr is None:
                     print(f"[img_to_pickle] Skipping unreadable image: {p}")
                     continue
-                to_process.append(img)
-                out_paths.append(out_p)
+                if seen is not None:
+                    original = seen.find(h)
+                    if original is not None:
+                        # burst shots and re-uploads are neither captioned nor poisoned twice
+                        duplicates[p.stem] = original
+                        continue
+                    seen.add(h, p.stem)
+                to_process.append(arr)
+                names.append(p.stem)
+                hashes.append(h)
+                keys.append(EmbeddingCache.key(file_hash, BLIP_MODEL_ID, dtype=str(dtype),
+                                               max_new_tokens=args.max_new_tokens, **decode_params))
 
             if not to_process:
                 continue
-            # Prepare inputs
-            inputs = processor(images=to_process, return_tensors="pt", padding=True)
-            inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
-            # Generate captions
-            if device == "cuda":
-                with torch.autocast("cuda", dtype=torch.float16):
-                    gen = model.generate(**inputs, max_new_tokens=args.max_new_tokens)
-            else:
-                gen = model.generate(**inputs, max_new_tokens=args.max_new_tokens)
-
-            captions = processor.batch_decode(gen, skip_special_tokens=True)
-            # Save pickles
-            for img, cap, out_p in zip(to_process, captions, out_paths):
-                save_pickle(out_p, img, cap)
+            captions = [cache.get(k) if cache else None for k in keys]
+            misses = [i for i, cap in enumerate(captions) if cap is None]
+            if misses:
+                if engine is None:
+                    engine = CaptionEngine(device, dtype, args.batch_size, args.max_new_tokens)
+                new_captions = engine.caption([Image.fromarray(to_process[i]) for i in misses])
+                for i, cap in zip(misses, new_captions):
+                    captions[i] = cap
+                    if cache:
+                        cache.put(keys[i], cap)
+            # Save pickles / shard records
+            for arr, cap, name, h in zip(to_process, captions, names, hashes):
+                writer.add(name, arr, cap, dhash=format(h, "016x"))
+
+    if len(duplicates) > known_duplicates:
+        tmp_path = str(duplicates_path) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(duplicates, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, duplicates_path)
+        print(f"[img_to_pickle] Skipped {len(duplicates) - known_duplicates} near-duplicate images "
+              f"(see {duplicates_path})")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Overlapped S3 -> poison -> S3 pipeline. Instead of running every stage of run_docker.bash over the
+whole corpus before the next one starts, images flow one by one through
+
+    download -> caption -> filter -> poison -> encode -> upload
+
+with a bounded asyncio.Queue between stages, so a full queue blocks the stage feeding it
+(backpressure) and the first poisoned images are uploaded while later ones are still downloading.
+Downloads and uploads run on an I/O thread pool, the model stages on their own threads (one
+model call at a time per stage by default) and PNG encoding on a small process pool.
+
+The corpus-wide steps of run_docker.bash cannot stream: unsupervised_image_classifier.py clusters
+every caption at once and data_extraction.py ranks every candidate before sampling. This pipeline
+therefore poisons a single --concept, and replaces the top-k sampling with a stable hash-based
+--select-fraction that is decided from the object key before anything is downloaded.
+
+Every finished stage is recorded per image in <work-dir>/run_manifest.jsonl (see run_manifest.py),
+so a restarted run picks each image up after its last completed stage; --force starts over.
+
+Usage:
+    python pipeline.py --concept dog --target tiger --eps 0.04 --work-dir /app/Data/pipeline
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from s3_transfer import list_keys, make_client, make_transfer_config, with_retries
+from S3_Downloader import SOURCE_BUCKET, SOURCE_PREFIX
+from S3_Uploader import DEST_PREFIX
+import metrics
+from export import encode_image, write_metadata
+from run_manifest import RunManifest, fingerprint
+# img_to_pickle (BLIP, i.e. transformers and torch) is imported where it is used, so the encode processes,
+# which only need export, start in a fraction of a second
+
+STOP = object()
+STAGES = ("download", "caption", "filter", "poison", "encode", "upload")
+
+
+def selected(name, fraction):
+    """Stable pseudo-random choice of about `fraction` of all names, independent of listing order."""
+    if fraction >= 1.0:
+        return True
+    digest = hashlib.sha1(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2.0 ** 64 < fraction
+
+
+def make_encode_pool(workers):
+    # spawned, not forked: this process already runs torch threads, the event loop's executors and maybe CUDA.
+    # Each child re-imports __main__, which is why this module keeps its top-level imports light
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class Pipeline(object):
+    """
+    worker provides caption(images), score(image, concept) and poison(crops) (see PoisonWorker);
+    s3 is any boto3-compatible client, so both can be replaced by stand-ins in tests.
+    concurrency and batch_size map stage names to overrides of the defaults below. encode_pool is an
+    already running process pool to encode with (see make_encode_pool), left open after the run.
+    """
+
+    CONCURRENCY = {"download": 16, "caption": 1, "filter": 1, "poison": 1, "encode": min(4, os.cpu_count() or 4),
+                   "upload": 16}
+    BATCH_SIZE = {"caption": 8, "poison": 4}
+
+    def __init__(self, worker, s3, bucket, prefix, dest_prefix, work_dir, concept, select_fraction=1.0,
+                 concurrency=None, batch_size=None, queue_size=32, retries=3, score_threshold=None, force=False,
+                 encode_pool=None):
+        self.worker = worker
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.dest_prefix = dest_prefix
+        self.concept = concept
+        self.select_fraction = select_fraction
+        self.queue_size = queue_size
+        self.retries = retries
+        self.encode_pool = encode_pool
+        if score_threshold is None:
+            from data_extraction import SCORE_THRESHOLD
+            score_threshold = SCORE_THRESHOLD
+        self.score_threshold = score_threshold
+        self.concurrency = dict(self.CONCURRENCY, **(concurrency or {}))
+        self.batch_size = dict(self.BATCH_SIZE, **(batch_size or {}))
+
+        self.input_dir = Path(work_dir) / "input_images"
+        self.output_dir = Path(work_dir) / "poisoned"
+        self.input_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.metadata_path = self.output_dir / "metadata.csv"
+        self.transfer_config = make_transfer_config()
+        self.manifest = RunManifest(Path(work_dir) / "run_manifest.jsonl", force=force)
+        self.rows = []
+        self.claimed = {}
+
+        self.counts = {stage: 0 for stage in STAGES}
+        self.counts.update(listed=0, skipped=0, resumed=0, filtered=0, failed=0)
+        self.first_done = {}
+        self.last_done = {}
+
+    def _mark(self, stage, n=1):
+        now = time.perf_counter() - self.start_time
+        self.counts[stage] += n
+        self.first_done.setdefault(stage, now)
+        self.last_done[stage] = now
+
+    # ---- stage functions: each takes a list of items and returns the items to pass on ----
+    # an item skips any checkpointed stage ("download", "caption", "filter", "encode", "upload")
+    # whose manifest entry still matches its fingerprint; "encode" also covers poisoning
+
+    def _done(self, item, stage):
+        return self.manifest.done(item["key"], stage, item["fp"][stage])
+
+    def _checkpoint(self, item, stage, outputs=(), **info):
+        self.manifest.mark(item["key"], stage, item["fp"][stage], outputs=outputs, **info)
+
+    def fingerprints(self, obj):
+        # each stage hashes the previous one, so a changed source or setting invalidates everything after it
+        params = getattr(self.worker, "params", lambda stage: {})
+        fp = {"download": fingerprint(obj["ETag"], obj["Size"])}
+        fp["caption"] = fingerprint(fp["download"], params("caption"))
+        fp["filter"] = fingerprint(fp["caption"], self.concept, self.score_threshold, params("filter"))
+        fp["encode"] = fingerprint(fp["filter"], params("poison"))
+        fp["upload"] = fingerprint(fp["encode"], self.bucket, self.dest_prefix)
+        return fp
+
+    def download(self, items):
+        from img_to_pickle import STORE_MIN_SIDE, load_image_safe
+        item = items[0]
+        if not self._done(item, "download"):
+            tmp_path = str(item["path"]) + ".part"
+            with metrics.span("s3.download", sync_cuda=False):
+                with_retries(lambda: self.s3.download_file(self.bucket, item["key"], tmp_path,
+                                                           Config=self.transfer_config), retries=self.retries)
+            os.replace(tmp_path, item["path"])
+            self._checkpoint(item, "download", outputs=[item["path"]])
+        if self._done(item, "encode"):
+            return [item]
+        # decode here too, so the model threads only ever see ready PIL images
+        with metrics.span("decode", sync_cuda=False):
+            item["image"] = load_image_safe(item["path"], STORE_MIN_SIDE)
+        if item["image"] is None:
+            print(f"[pipeline] Skipping unreadable image: {item['key']}")
+            return []
+        return [item]
+
+    def caption(self, items):
+        todo = []
+        for item in items:
+            if self._done(item, "caption"):
+                item["caption"] = self.manifest.get(item["key"], "caption")["caption"]
+            else:
+                todo.append(item)
+        if todo:
+            with metrics.span("caption", batch=len(todo)):
+                captions = self.worker.caption([item["image"] for item in todo])
+            for item, caption in zip(todo, captions):
+                item["caption"] = caption
+                self._checkpoint(item, "caption", caption=caption)
+        return items
+
+    def filter(self, items):
+        kept = []
+        for item in items:
+            if self._done(item, "encode"):
+                kept.append(item)
+                continue
+            with metrics.span("clip_score"):
+                score, cropped = self.worker.score(item.pop("image"), self.concept)
+            passed = score > self.score_threshold and bool(item["caption"])
+            self._checkpoint(item, "filter", score=score, passed=passed)
+            if not passed:
+                self.counts["filtered"] += 1
+                continue
+            item["crop"] = cropped
+            kept.append(item)
+        return kept
+
+    def poison(self, items):
+        todo = [item for item in items if "crop" in item]
+        if todo:
+            with metrics.span("poison", batch=len(todo)):
+                poisoned = self.worker.poison([item.pop("crop") for item in todo])
+            for item, img in zip(todo, poisoned):
+                item["pixels"] = np.asarray(img, dtype=np.uint8)
+        return items
+
+    async def encode(self, items, pool):
+        item = items[0]
+        if "pixels" in item:
+            loop = asyncio.get_running_loop()
+            seconds = await loop.run_in_executor(pool, encode_image, item.pop("pixels"), item["output"])
+            metrics.record("png_encode", seconds)
+            self._checkpoint(item, "encode", outputs=[item["output"]], caption=item["caption"])
+        self.rows.append([item["output"].name, item["caption"]])
+        return [item]
+
+    def upload(self, items):
+        item = items[0]
+        key = f"{self.dest_prefix}{item['output'].name}"
+        with metrics.span("s3.upload", sync_cuda=False):
+            with_retries(lambda: self.s3.upload_file(str(item["output"]), self.bucket, key,
+                                                     Config=self.transfer_config), retries=self.retries)
+        self._checkpoint(item, "upload", key=key)
+        return [item]
+
+    # ---- plumbing ----
+
+    def local_name(self, key):
+        # the key below the prefix's directory, so equal basenames under different sub-prefixes stay apart;
+        # keys right under the prefix keep their plain basename
+        rel = key[self.prefix.rfind("/") + 1:]
+        return rel.replace("/", "__")
+
+    async def list_source(self, out_q):
+        from img_to_pickle import ALLOWED_EXTS
+        keys = list_keys(self.s3, self.bucket, self.prefix)
+        while True:
+            # each next() may fetch a listing page, so keep it off the event loop
+            obj = await asyncio.to_thread(next, keys, None)
+            if obj is None:
+                break
+            path = Path(self.local_name(obj["Key"]))
+            if path.suffix.lower() not in ALLOWED_EXTS:
+                continue
+            self.counts["listed"] += 1
+            if not selected(path.stem, self.select_fraction):
+                self.counts["skipped"] += 1
+                continue
+            if self.claimed.setdefault(path.name, obj["Key"]) != obj["Key"]:
+                # would overwrite the download and output of another key
+                print(f"[pipeline] Skipping {obj['Key']}: {path.name} is already used by {self.claimed[path.name]}")
+                self.counts["failed"] += 1
+                continue
+            item = {"key": obj["Key"], "stem": path.stem, "path": self.input_dir / path.name,
+                    "output": self.output_dir / f"{self.concept}_{path.stem}_0.png", "fp": self.fingerprints(obj)}
+            if self._done(item, "upload"):
+                self.counts["resumed"] += 1
+                self.rows.append([item["output"].name, self.manifest.get(item["key"], "encode")["caption"]])
+                continue
+            if self._done(item, "filter") and not self.manifest.get(item["key"], "filter")["passed"]:
+                self.counts["filtered"] += 1
+                continue
+            await out_q.put(item)
+        await out_q.put(STOP)
+
+    async def run_stage(self, stage, fn, in_q, out_q, executor=None):
+        batch_size = self.batch_size.get(stage, 1)
+        loop = asyncio.get_running_loop()
+
+        async def work():
+            while True:
+                batch = [await in_q.get()]
+                if batch[0] is STOP:
+                    await in_q.put(STOP)  # let sibling workers see it too
+                    return
+                # take whatever else is already waiting, up to batch_size, without blocking
+                while len(batch) < batch_size and not in_q.empty():
+                    batch.append(in_q.get_nowait())
+                done = batch[-1] is STOP
+                if done:
+                    batch.pop()
+                try:
+                    if executor is None:
+                        results = await fn(batch)
+                    else:
+                        results = await loop.run_in_executor(executor, fn, batch)
+                except Exception as e:
+                    print(f"[pipeline] {stage} failed for {[item['key'] for item in batch]}: {e}")
+                    self.counts["failed"] += len(batch)
+                    results = []
+                if results:
+                    self._mark(stage, len(results))
+                if out_q is not None:
+                    for item in results:
+                        await out_q.put(item)
+                if done:
+                    await in_q.put(STOP)
+                    return
+
+        await asyncio.gather(*(work() for _ in range(self.concurrency[stage])))
+        if out_q is not None:
+            await out_q.put(STOP)
+
+    async def run(self):
+        self.start_time = time.perf_counter()
+        queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES}
+        io_pool = ThreadPoolExecutor(max_workers=self.concurrency["download"] + self.concurrency["upload"],
+                                     thread_name_prefix="io")
+        model_pools = {stage: ThreadPoolExecutor(max_workers=self.concurrency[stage], thread_name_prefix=stage)
+                       for stage in ("caption", "filter", "poison")}
+        encode_pool = self.encode_pool or make_encode_pool(self.concurrency["encode"])
+        try:
+            await asyncio.gather(
+                self.list_source(queues["download"]),
+                self.run_stage("download", self.download, queues["download"], queues["caption"], io_pool),
+                self.run_stage("caption", self.caption, queues["caption"], queues["filter"], model_pools["caption"]),
+                self.run_stage("filter", self.filter, queues["filter"], queues["poison"], model_pools["filter"]),
+                self.run_stage("poison", self.poison, queues["poison"], queues["encode"], model_pools["poison"]),
+                self.run_stage("encode", lambda batch: self.encode(batch, encode_pool), queues["encode"],
+                               queues["upload"]),
+                self.run_stage("upload", self.upload, queues["upload"], None, io_pool),
+            )
+            # rebuilt from this run's exports plus resumed ones, so restarts never duplicate rows
+            if self.rows:
+                write_metadata(self.metadata_path, sorted(self.rows))
+                key = f"{self.dest_prefix}{self.metadata_path.name}"
+                await asyncio.to_thread(with_retries, lambda: self.s3.upload_file(
+                    str(self.metadata_path), self.bucket, key, Config=self.transfer_config), self.retries)
+        finally:
+            io_pool.shutdown()
+            for pool in model_pools.values():
+                pool.shutdown()
+            if encode_pool is not self.encode_pool:
+                encode_pool.shutdown()
+        return self.summary()
+
+    def summary(self):
+        summary = dict(self.counts)
+        summary["elapsed"] = time.perf_counter() - self.start_time
+        summary["first_done"] = self.first_done
+        summary["last_done"] = self.last_done
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overlapped download/caption/filter/poison/encode/upload pipeline")
+    parser.add_argument("--concept", type=str, required=True, help="source concept to filter and poison")
+    parser.add_argument("--target", type=str, required=True)
+    parser.add_argument("--eps", type=float, default=0.04)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--bucket", type=str, default=SOURCE_BUCKET)
+    parser.add_argument("--prefix", type=str, default=SOURCE_PREFIX)
+    parser.add_argument("--dest-prefix", type=str, default=DEST_PREFIX)
+    parser.add_argument("--work-dir", type=Path, default=Path("/app/Data/pipeline"))
+    parser.add_argument("--select-fraction", type=float, default=0.15,
+                        help="fraction of images to poison, chosen by a hash of the file name")
+    parser.add_argument("--force", action="store_true", help="ignore the run manifest and redo every stage")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="record per-stage timings: *.prom for a Prometheus textfile, else JSON lines "
+                             "(default: $NIGHTSHADE_METRICS)")
+    parser.add_argument("--queue-size", type=int, default=32, help="max items waiting between two stages")
+    for stage in STAGES:
+        parser.add_argument(f"--{stage}-workers", type=int, default=None)
+    for stage in Pipeline.BATCH_SIZE:
+        parser.add_argument(f"--{stage}-batch", type=int, default=None)
+    args = parser.parse_args()
+    metrics.configure(args.metrics)
+
+    concurrency = {s: getattr(args, f"{s}_workers") for s in STAGES if getattr(args, f"{s}_workers")}
+    batch_size = {s: getattr(args, f"{s}_batch") for s in Pipeline.BATCH_SIZE if getattr(args, f"{s}_batch")}
+    io_workers = concurrency.get("download", Pipeline.CONCURRENCY["download"]) + \
+        concurrency.get("upload", Pipeline.CONCURRENCY["upload"])
+
+    from poison_worker import PoisonWorker
+    worker = PoisonWorker(args.work_dir / "poisoned", args.concept, args.target, args.eps, device=args.device,
+                          poison_batch=batch_size.get("poison", Pipeline.BATCH_SIZE["poison"]))
+    pipeline = Pipeline(worker, make_client(io_workers), args.bucket, args.prefix, args.dest_prefix, args.work_dir,
+                        args.concept, select_fraction=args.select_fraction, concurrency=concurrency,
+                        batch_size=batch_size, queue_size=args.queue_size, force=args.force)
+    summary = asyncio.run(pipeline.run())
+
+    print(f"[pipeline] {summary['listed']} listed, {summary['skipped']} not selected, "
+          f"{summary['resumed']} already uploaded, "
+          f"{summary['filtered']} filtered, {summary['failed']} failed, {summary['upload']} uploaded "
+          f"in {summary['elapsed']:.1f}s")
+    if "upload" in summary["first_done"] and "download" in summary["last_done"]:
+        print(f"[pipeline] first upload at {summary['first_done']['upload']:.1f}s, "
+              f"last download at {summary['last_done']['download']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Long-lived poisoning worker. Loads BLIP, CLIP and the poisoning model once and runs
+caption -> CLIP filter -> poison -> PNG export for every work item, writing the same
+<concept>_<stem>_0.png files and metadata.csv rows that run2_.bash produced.
+Finished images are recorded in <output-dir>/run_manifest.jsonl and skipped when seen again
+with the same content and settings, so an interrupted run resumes; --force redoes everything.
+
+Work items come from one of:
+    --watch-dir DIR     poll DIR for new images, taken once they stop changing (add --once to stop after
+                        the current files)
+    --stdin             JSON lines on stdin, e.g. {"path": "/data/img.jpg", "concept": "dog"}
+    --socket PATH       JSON lines over a unix socket; one JSON result line is sent back per item
+
+Usage:
+    python poison_worker.py --output-dir OUT --concept dog --target tiger --eps 0.04 --watch-dir IN --once
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from opt import PoisonGeneration
+from caching import content_hash
+from run_manifest import RunManifest, fingerprint
+from data_extraction import CLIP, CLIP_MODEL_ID, SCORE_THRESHOLD, crop_to_square
+from img_to_pickle import ALLOWED_EXTS, BLIP_MODEL_ID, STORE_MIN_SIDE, load_image_safe
+from captioning import CaptionEngine
+import export
+
+
+FLUSH_INTERVAL = 30.0
+
+
+class PoisonWorker(object):
+    def __init__(self, output_dir, concept, target, eps, device=None, max_new_tokens=30, force=False,
+                 export_options=None, poison_batch=4):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = RunManifest(self.output_dir / "run_manifest.jsonl", force=force)
+        self.concept = concept
+        self.target = target
+        self.max_new_tokens = max_new_tokens
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+        print(f"[worker] Loading models on {self.device}...")
+        self.captioner = CaptionEngine(self.device, max_new_tokens=max_new_tokens)
+        self.clip_model = CLIP(device=self.device)
+        # crops handed to poison() together are optimized in one PGD batch of up to poison_batch images
+        self.poison_generator = PoisonGeneration(target_concept=target, device=self.device, eps=eps,
+                                                 batch_size=poison_batch)
+        # rows of earlier runs are kept; metadata.csv is rewritten on flush() instead of appended per image
+        # encodes are waited for one at a time, so a couple of processes are plenty
+        export_options = dict(export_options or {})
+        export_options["workers"] = export_options.get("workers") or 2
+        self.exporter = export.Exporter(self.output_dir, merge=True, **export_options)
+        self.last_flush = time.monotonic()
+        print("[worker] Ready")
+
+    def params(self, stage):
+        """Settings behind a stage's output, fingerprinted by the run manifest."""
+        if stage == "caption":
+            return {"model": BLIP_MODEL_ID, "max_new_tokens": self.max_new_tokens, "min_side": STORE_MIN_SIDE,
+                    "dtype": str(self.captioner.dtype)}
+        if stage == "filter":
+            return {"model": CLIP_MODEL_ID}
+        return self.poison_generator.params(self.target)
+
+    def caption(self, images):
+        return self.captioner.caption(images)
+
+    def score(self, img, concept):
+        """Square-crops img like data_extraction.py and returns (CLIP score, crop)."""
+        cropped = crop_to_square(img)
+        return float(self.clip_model(cropped, "a photo of a {}".format(concept))), cropped
+
+    def poison(self, crops):
+        # the round trip through uint8 mirrors the selected-data pickle
+        sources = [Image.fromarray(np.array(c)) for c in crops]
+        return self.poison_generator.generate_all(sources, self.target)
+
+    def process(self, path, concept=None):
+        """Runs one image through the whole pipeline and returns a JSON-serialisable result."""
+        path = Path(path)
+        concept = concept or self.concept
+        result = {"path": str(path), "concept": concept}
+
+        fp = fingerprint(content_hash(path), concept, SCORE_THRESHOLD,
+                         *(self.params(stage) for stage in ("caption", "filter", "poison")))
+        entry = self.manifest.get(path.name, "export")
+        if self.manifest.done(path.name, "export", fp):
+            result.update(entry["result"], resumed=True)
+            if result.get("status") == "ok":
+                # a run that stopped before its flush left the image on disk but not its row
+                self.exporter.add_row(self.output_name(concept, path), result["caption"])
+            return result
+
+        img = load_image_safe(path, STORE_MIN_SIDE)
+        if img is None:
+            result["status"] = "unreadable"
+            return result
+
+        # STEP 1 caption
+        if self.manifest.done(path.name, "caption", fp):
+            caption = self.manifest.get(path.name, "caption")["caption"]
+        else:
+            caption = self.caption([img])[0]
+            self.manifest.mark(path.name, "caption", fp, caption=caption)
+        result["caption"] = caption
+
+        # STEP 2 CLIP filter, same crop and threshold as data_extraction.py
+        score, cropped = self.score(img, concept)
+        result["score"] = score
+        if score <= SCORE_THRESHOLD or not caption:
+            result["status"] = "filtered"
+            self.manifest.mark(path.name, "export", fp, result=result)
+            return result
+
+        # STEP 3 poison
+        poisoned = self.poison([cropped])[0]
+
+        # STEP 4 export with the stable name run2_.bash used; encoded in the exporter's pool,
+        # and waited for so the manifest never marks an image that is not on disk
+        name = self.output_name(concept, path)
+        self.exporter.add(name, poisoned, caption).result()
+
+        result["status"] = "ok"
+        result["output"] = self.exporter.path(name)
+        self.manifest.mark(path.name, "export", fp, outputs=[result["output"]], result=result)
+        return result
+
+    def output_name(self, concept, path):
+        return f"{concept}_{path.stem}_0"
+
+    def flush(self):
+        """Writes metadata.csv with every exported row."""
+        self.exporter.flush()
+        self.last_flush = time.monotonic()
+
+    def process_item(self, item):
+        if isinstance(item, str):
+            item = {"path": item}
+        try:
+            return self.process(item["path"], item.get("concept"))
+        except Exception as e:
+            print(f"[worker] Error processing {item}: {e}")
+            return {"path": item.get("path"), "status": "error", "error": str(e)}
+        finally:
+            # long-lived modes have no natural end, so rows are also written out every FLUSH_INTERVAL
+            if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+                self.flush()
+
+
+def watch_directory(worker, watch_dir, once=False, poll_interval=2.0):
+    # a file is taken once its size and mtime held still over one poll, so one that is still being copied in
+    # is not read half-written; a file that changes after it was processed is taken again
+    seen = {}
+    changing = {}
+    while True:
+        new_files = []
+        listed = {}
+        for p in sorted(Path(watch_dir).iterdir()):
+            if not (p.is_file() and p.suffix.lower() in ALLOWED_EXTS):
+                continue
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if seen.get(p) == state:
+                continue
+            if once or changing.get(p) == state:
+                new_files.append((p, state))
+            else:
+                listed[p] = state
+        changing = listed
+        for p, state in new_files:
+            seen[p] = state
+            print(json.dumps(worker.process_item(str(p))), flush=True)
+        if new_files:
+            worker.flush()
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+def serve_stdin(worker):
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        print(json.dumps(worker.process_item(json.loads(line))), flush=True)
+    worker.flush()
+
+
+def serve_socket(worker, socket_path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.strip()
+                if not line:
+                    continue
+                result = worker.process_item(json.loads(line))
+                self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # one request at a time: the models are shared and not thread safe
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        print(f"[worker] Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            worker.flush()
+            os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent caption/filter/poison/export worker")
+    parser.add_argument("--output-dir", type=Path, required=True)
+    parser.add_argument("--concept", type=str, required=True)
+    parser.add_argument("--target", type=str, required=True)
+    parser.add_argument("--eps", type=float, default=0.04)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=30)
+    parser.add_argument("--poison-batch", type=int, default=4, help="max images optimized together in one PGD batch")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--watch-dir", type=Path)
+    source.add_argument("--stdin", action="store_true")
+    source.add_argument("--socket", type=str)
+    parser.add_argument("--once", action="store_true", help="with --watch-dir, exit after the current files")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--force", action="store_true", help="redo images already recorded in the run manifest")
+    export.add_arguments(parser, "export-", sep="-")
+    args = parser.parse_args()
+
+    worker = PoisonWorker(args.output_dir, args.concept, args.target, args.eps,
+                          device=args.device, max_new_tokens=args.max_new_tokens, force=args.force,
+                          export_options=export.exporter_options(args, "export-"), poison_batch=args.poison_batch)
+    if args.watch_dir:
+        watch_directory(worker, args.watch_dir, once=args.once, poll_interval=args.poll_interval)
+    elif args.stdin:
+        serve_stdin(worker)
+    else:
+        serve_socket(worker, args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -54,10 +54,22 @@ BATCH_SIZE=8
 MIN_CONCEPT_COUNT=15
 TARGET="tiger"
 EPS=0.04
-
-rm -rf "$PICKLED_DIR" "$CLASSIFIED_DIR" "$SELECTED_DIR" "$POISONED_DIR" "$FINAL_POISONED_DIR" "$S3_IMAGE_UPLOAD_DIR"
+# target latents (and later caches) live outside the directories wiped below
+export NIGHTSHADE_CACHE_DIR="${NIGHTSHADE_CACHE_DIR:-/app/Data/cache}"
+# completed stages are recorded here; a restarted run skips them (see run_manifest.py)
+MANIFEST=/app/Data/run_manifest.jsonl
+
+# intermediates are kept between runs so an interrupted job resumes; --force starts from scratch
+if [[ "${1:-}" == "--force" ]]; then
+    rm -rf "$PICKLED_DIR" "$CLASSIFIED_DIR" "$SELECTED_DIR" "$POISONED_DIR" "$FINAL_POISONED_DIR" "$S3_IMAGE_UPLOAD_DIR" "$MANIFEST"
+fi
 mkdir -p "$SELECTED_DIR" "$POISONED_DIR" "$S3_IMAGE_UPLOAD_DIR" "$PICKLED_DIR"
 
+# stage_done <item> <stage> <fingerprint>: true if the stage finished with the same fingerprint
+stage_done() { python3 /app/run_manifest.py done "$MANIFEST" "$@"; }
+mark_done() { python3 /app/run_manifest.py mark "$MANIFEST" "$@"; }
+
+# download and captioning are incremental per image: unchanged objects and already captioned names are skipped
 echo ">>> Downloading images from S3..."
 python3 /app/Data_Pipeline/S3_Downloader.py
 
@@ -66,14 +78,22 @@ echo ">>> Captioning images in batches..."
 python3 /app/Data_Pipeline/img_to_pickle.py \
   --input-dir "$INPUT_DIR" \
   --output-dir "$PICKLED_DIR" \
-  --batch-size "${BATCH_SIZE:-}"
-
-echo ">>> Running unsupervised classifier..."
-python3 /app/Data_Pipeline/unsupervised_image_classifier.py \
-  --input_dir "$PICKLED_DIR" \
-  --output_dir "$CLASSIFIED_DIR"
-
-echo ">>> Extracting and poisoning data per concept..."
+  --batch-size "${BATCH_SIZE:-}" \
+  --format shard
+
+# clustering reruns only when the captioned set changed; new captions are assigned to the saved
+# clusters, and the classifier refits from scratch once they outgrow the last fit (--refit_ratio)
+CLASSIFY_FP="pickled=$(python3 /app/dataset_store.py count "$PICKLED_DIR")"
+if stage_done all classify "$CLASSIFY_FP"; then
+    echo ">>> Classification unchanged, skipping"
+else
+    echo ">>> Running unsupervised classifier..."
+    python3 /app/Data_Pipeline/unsupervised_image_classifier.py \
+      --input_dir "$PICKLED_DIR" \
+      --output_dir "$CLASSIFIED_DIR" \
+      --incremental
+    mark_done all classify "$CLASSIFY_FP"
+fi
 
 # STEP 3 extract and poison data per concept
 echo ">>> Extracting and poisoning data per concept..."
@@ -88,43 +108,53 @@ for concept_dir in "$CLASSIFIED_DIR"/*; do
         echo "---------------------------------------------"
         echo "Processing concept: $concept"
 
-        count=$(find "$concept_dir" -type f -name "*.p" | wc -l)
+        # intermediates are sharded stores (see dataset_store.py); count reads only the index
+        count=$(python3 /app/dataset_store.py count "$concept_dir")
         if (( count < MIN_CONCEPT_COUNT )); then
             echo "Skipping concept '$concept' (only $count < $MIN_CONCEPT_COUNT pickles)"
             continue
         fi
         num=$(( count * 15 / 100 )) ## gonna have to play with this number I think 30 is fine for 200+ images
 
-        echo "Found $count .p files → selecting $num"
-
-        python3 /app/data_extraction.py \
-            --directory "$CLASSIFIED_DIR/$concept" \
-            --concept "$concept" \
-            --num "$num" \
-            --outdir "$SELECTED_DIR/$concept"
+        echo "Found $count records → selecting $num"
+
+        # selection samples at random, so it is kept once made; redoing it invalidates the concept's poisoned output
+        SELECT_FP="$CLASSIFY_FP;count=$count;num=$num"
+        if ! stage_done "$concept" select "$SELECT_FP"; then
+            rm -rf "$SELECTED_DIR/$concept" "$POISONED_DIR/$concept"
+            rm -f "$S3_IMAGE_UPLOAD_DIR/${concept}"_*.png
+            python3 /app/data_extraction.py \
+                --directory "$CLASSIFIED_DIR/$concept" \
+                --concept "$concept" \
+                --num "$num" \
+                --outdir "$SELECTED_DIR/$concept" \
+                --format shard
+            mark_done "$concept" select "$SELECT_FP"
+        fi
 
+        # resumes per image from $POISONED_DIR/$concept/run_manifest.jsonl; one worker per GPU (see poison_launcher.py)
         echo "Generating poisoned samples (target = $TARGET)..."
-        python3 /app/gen_poison.py \
+        python3 /app/poison_launcher.py \
             --directory "$SELECTED_DIR/$concept" \
             --target_name "$TARGET" \
             --outdir "$POISONED_DIR/$concept" \
-            --eps "$EPS"
+            --eps "$EPS" \
+            --format shard \
+            --export_dir "$S3_IMAGE_UPLOAD_DIR" \
+            --export_prefix "${concept}_"
     fi
 done
 
 # STEP 4 consolidate poisoned data
+# merged records are named <concept>_<idx> and reference the per-concept shards without copying
+# the merged store only references shards, so it is cheap to rebuild every run
 echo ">>> Renaming and consolidating poisoned files..."
-mkdir -p "$FINAL_POISONED_DIR"
-for concept_dir in "$POISONED_DIR"/*; do
-    if [ -d "$concept_dir" ]; then
-        concept=$(basename "$concept_dir")
-        for file in "$concept_dir"/*.p; do
-            mv "$file" "$FINAL_POISONED_DIR/${concept}_$(basename "$file")"
-        done
-    fi
-done
+rm -rf "$FINAL_POISONED_DIR"
+python3 /app/dataset_store.py merge "$FINAL_POISONED_DIR" "$POISONED_DIR"/*/
 
-python3 /app/Data_Pipeline/Extract_Data.py "$FINAL_POISONED_DIR" "$S3_IMAGE_UPLOAD_DIR"
+# the poisoning workers already exported each image as <concept>_<idx>.png from memory, so this only
+# rebuilds metadata.csv for every concept (and encodes any image that is missing)
+python3 /app/Data_Pipeline/Extract_Data.py "$FINAL_POISONED_DIR" "$S3_IMAGE_UPLOAD_DIR" --skip-existing
 
 # STEP 5 upload poisoned images to S3
 echo ">>> Uploading poisoned images to S3..."
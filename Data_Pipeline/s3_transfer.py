@@ -0,0 +1,190 @@
+"""
+Concurrent, paginated S3 transfers shared by S3_Downloader.py and S3_Uploader.py.
+
+- list_keys pages through list_objects_v2, so prefixes with more than 1000 keys are complete
+- download_prefix / upload_files run a bounded thread pool with per-object retries
+- a local JSON manifest of {key: {"etag", "size"}} lets unchanged objects be skipped
+- multipart thresholds/chunk sizes are tuned through boto3's TransferConfig
+
+Every function takes the client as an argument, so tests can pass a moto or MinIO-backed client.
+"""
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+
+MANIFEST_NAME = ".s3_manifest.json"
+MB = 1024 * 1024
+# seconds between manifest saves while a transfer runs; an interrupted run keeps what finished before
+MANIFEST_SAVE_INTERVAL = 5.0
+
+
+def make_client(max_workers=16):
+    # one connection per worker thread, plus botocore's own adaptive retries for throttling
+    return boto3.client("s3", config=Config(max_pool_connections=max_workers,
+                                            retries={"max_attempts": 5, "mode": "adaptive"}))
+
+
+def make_transfer_config(multipart_threshold_mb=64, multipart_chunksize_mb=16, max_concurrency=4):
+    return TransferConfig(multipart_threshold=multipart_threshold_mb * MB,
+                          multipart_chunksize=multipart_chunksize_mb * MB,
+                          max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+
+
+def list_keys(client, bucket, prefix):
+    """Yields every object under prefix as {"Key", "ETag", "Size"}."""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            yield obj
+
+
+def load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def with_retries(fn, retries=3, backoff=1.0):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download_prefix(client, bucket, prefix, download_dir, max_workers=16, retries=3, transfer_config=None):
+    """
+    Downloads every object under prefix into download_dir (flattened to the key's basename).
+    Objects whose ETag and size match the manifest and whose local file still exists are skipped.
+    Keys that share a basename with another key under the prefix would overwrite each other, so
+    they are not downloaded and are reported as failed. The manifest is saved as downloads finish.
+    Returns (downloaded, skipped, failed) key lists.
+    """
+    download_dir = Path(download_dir)
+    download_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = download_dir / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+    transfer_config = transfer_config or make_transfer_config()
+
+    objects = list(list_keys(client, bucket, prefix))
+    names = Counter(Path(obj["Key"]).name for obj in objects)
+    todo, skipped, failed = [], [], []
+    for obj in objects:
+        key = obj["Key"]
+        local_path = download_dir / Path(key).name
+        if names[local_path.name] > 1:
+            print(f"Not downloading s3://{bucket}/{key}: another key under {prefix} is also named {local_path.name}")
+            failed.append(key)
+            continue
+        entry = manifest.get(key)
+        if (entry and entry.get("etag") == obj["ETag"] and entry.get("size") == obj["Size"]
+                and local_path.exists() and local_path.stat().st_size == obj["Size"]):
+            skipped.append(key)
+        else:
+            todo.append((obj, local_path))
+
+    def fetch(obj, local_path):
+        tmp_path = str(local_path) + ".part"
+        with metrics.span("s3.download", sync_cuda=False, bytes=obj["Size"]):
+            with_retries(lambda: client.download_file(bucket, obj["Key"], tmp_path, Config=transfer_config),
+                         retries=retries)
+        os.replace(tmp_path, local_path)
+        return obj
+
+    downloaded = []
+    last_save = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch, obj, local_path): obj["Key"] for obj, local_path in todo}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    obj = future.result()
+                except Exception as e:
+                    print(f"Failed to download s3://{bucket}/{key}: {e}")
+                    failed.append(key)
+                    continue
+                manifest[key] = {"etag": obj["ETag"], "size": obj["Size"]}
+                downloaded.append(key)
+                if time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                    save_manifest(manifest_path, manifest)
+                    last_save = time.monotonic()
+    finally:
+        save_manifest(manifest_path, manifest)
+    return downloaded, skipped, failed
+
+
+def upload_files(client, bucket, dest_prefix, files, manifest_path=None, max_workers=16, retries=3,
+                 transfer_config=None):
+    """
+    Uploads files to s3://bucket/dest_prefix<name>. With manifest_path set, files whose size and
+    mtime match the last successful upload are skipped; the manifest is saved as uploads finish.
+    Returns (uploaded, skipped, failed) key lists.
+    """
+    manifest = load_manifest(manifest_path) if manifest_path else {}
+    transfer_config = transfer_config or make_transfer_config()
+
+    todo, skipped = [], []
+    for file_path in files:
+        file_path = Path(file_path)
+        if not file_path.is_file() or file_path.name == MANIFEST_NAME:
+            continue
+        key = f"{dest_prefix}{file_path.name}"
+        st = file_path.stat()
+        entry = manifest.get(key)
+        if entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime:
+            skipped.append(key)
+        else:
+            todo.append((file_path, key, st))
+
+    def send(file_path, key, size):
+        with metrics.span("s3.upload", sync_cuda=False, bytes=size):
+            with_retries(lambda: client.upload_file(str(file_path), bucket, key, Config=transfer_config),
+                         retries=retries)
+
+    uploaded, failed = [], []
+    last_save = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(send, file_path, key, st.st_size): (key, st) for file_path, key, st in todo}
+            for future in as_completed(futures):
+                key, st = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed to upload s3://{bucket}/{key}: {e}")
+                    failed.append(key)
+                    continue
+                manifest[key] = {"size": st.st_size, "mtime": st.st_mtime}
+                uploaded.append(key)
+                if manifest_path and time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                    save_manifest(manifest_path, manifest)
+                    last_save = time.monotonic()
+    finally:
+        if manifest_path:
+            save_manifest(manifest_path, manifest)
+    return uploaded, skipped, failed
@@ -3,20 +3,40 @@ import os
 import json
 import hdbscan
 from sklearn.feature_extraction.text import TfidfVectorizer
-import numpy as np  
+import numpy as np
 import spacy
 import pickle
 from sentence_transformers import SentenceTransformer
 from collections import defaultdict, Counter
 import umap
 import shutil
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset_store import ShardReader, ShardWriter, is_shard_store, open_reader
+from caching import EmbeddingCache, text_hash
 
-nlp = spacy.load("en_core_web_sm")
+SENTENCE_MODEL_ID = "all-MiniLM-L6-v2"
+METADATA_FILE = "classification_metadata.json"
+MODEL_FILE = "cluster_model.pkl"
+
+
+# only POS tags and lemmas are used, so the dependency parser and NER stay off
+nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
+# caption -> noun lemmas; BLIP repeats captions a lot, so each distinct one is parsed once
+_nouns = {}
+
+def extract_nouns(captions, n_process=1, batch_size=256):
+    """Noun lemmas of every caption, via batched (optionally multi-process) nlp.pipe over the unseen ones."""
+    todo = list(dict.fromkeys(c for c in captions if c not in _nouns))
+    if todo:
+        docs = nlp.pipe(todo, n_process=n_process, batch_size=batch_size)
+        for text, doc in zip(todo, docs):
+            _nouns[text] = " ".join([t.lemma_ for t in doc if t.pos_ == "NOUN"])
+    return [_nouns[c] for c in captions]
 
 def only_nouns(text):
-    doc = nlp(text)
-    return " ".join([t.lemma_ for t in doc if t.pos_ == "NOUN"])
+    return extract_nouns([text])[0]
 
 def one_word_label(captions):
     vectorizer = TfidfVectorizer(stop_words='english')
@@ -37,48 +57,38 @@ def label_clusters(captions, labels):
         cluster_names[lab] = one_word_label(caps)
     return cluster_names
 
-def main():
+def sentence_embeddings(captions, cache=None, batch_size=256):
+    """MiniLM embeddings per caption; cached captions skip the model, and it is only loaded for misses."""
+    if cache is None:
+        st_model = SentenceTransformer(SENTENCE_MODEL_ID)
+        return st_model.encode(captions, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+    keys = [EmbeddingCache.key(text_hash(c), SENTENCE_MODEL_ID) for c in captions]
+    embeddings = [cache.get(k) for k in keys]
+    # identical captions are encoded once
+    misses = list(dict.fromkeys(captions[i] for i, e in enumerate(embeddings) if e is None))
+    if misses:
+        st_model = SentenceTransformer(SENTENCE_MODEL_ID)
+        new_embeddings = dict(zip(misses, st_model.encode(misses, batch_size=batch_size, show_progress_bar=False,
+                                                          convert_to_numpy=True)))
+        for i, e in enumerate(embeddings):
+            if e is None:
+                embeddings[i] = new_embeddings[captions[i]]
+                cache.put(keys[i], embeddings[i])
+    return np.stack(embeddings)
+
+def fit_clusters(captions, cache=None, embed=sentence_embeddings, n_process=1):
     """
-    Unsupervised Image Classifier using caption clustering
-    Usage:
-        python unsupervised_image_classifier.py --input_dir <input_directory> --output_dir <output_directory>
+    Clusters captions with UMAP + HDBSCAN and names each cluster after its most common noun.
+    Returns (labels, model); model keeps the fitted reducer and clusterer so assign_clusters can
+    place later captions without refitting. embed(captions, cache) can be swapped for a stand-in model.
     """
-
-    parser = argparse.ArgumentParser(description="Unsupervised Image Classifier")
-    parser.add_argument('--input_dir', type=str, required=True, help='Directory containing input images')
-    parser.add_argument('--output_dir', type=str, required=True, help='Directory to classification metadata will be saved as a json')
-    
-    args = parser.parse_args()
-    
-    input_dir = args.input_dir
-    output_dir = args.output_dir
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    ###sanity check messages
-    print(f"Loading images from {input_dir}...")
-    print(f"Saving classified images to {output_dir}...")
-
-    ## open input directory and store file path and captions in a list
-    file_paths = []
-    captions = []
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.p')):
-            image_path = os.path.join(input_dir, filename)
-            file_paths.append(image_path)
-            with open(image_path, 'rb') as f:
-                data = pickle.load(f)
-                captions.append(data['text'])
-
-### CLUSTERING AND LABELING
     # prepare noun-only text for each caption
-    noun_texts = [only_nouns(c) for c in captions]
+    noun_texts = extract_nouns(captions, n_process)
 
     # compute embeddings: prefer semantic SentenceTransformer embeddings, fallback to TF-IDF on nouns
+    vectorizer = None
     try:
-        st_model = SentenceTransformer("all-MiniLM-L6-v2")
-        embeddings = st_model.encode(captions, show_progress_bar=False, convert_to_numpy=True)
+        embeddings = embed(captions, cache)
         #umap dimensionality reduction
         umap_reducer = umap.UMAP(n_neighbors=15, n_components=10, metric='cosine', random_state=67)
         embeddings = umap_reducer.fit_transform(embeddings)
@@ -90,29 +100,133 @@ def main():
         umap_reducer = umap.UMAP(n_neighbors=15, n_components=10, metric='cosine', random_state=67)
         embeddings = umap_reducer.fit_transform(embeddings)
 
-    # cluster with HDBSCAN
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=15, metric='euclidean')
+    # cluster with HDBSCAN; prediction data makes approximate_predict possible later
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=15, metric='euclidean', prediction_data=True)
     labels = clusterer.fit_predict(embeddings)
 
 
-    # group captions by cluster (ignore noise -1)
+    # group noun texts by cluster (ignore noise -1)
     clusters = defaultdict(list)
-    for file_path, label, cap in zip(file_paths, labels, captions):
+    for label, nouns in zip(labels, noun_texts):
         if label != -1:
-            clusters[label].append(cap)
+            clusters[label].append(nouns)
 
     # assign each cluster a label = most common lemmatized noun in the cluster
     cluster_names = {}
-    for lab, caps in clusters.items():
+    for lab, noun_lists in clusters.items():
         noun_counter = Counter()
-        for cap in caps:
-            nouns = [t for t in only_nouns(cap).split() if t]
-            noun_counter.update(nouns)
-        cluster_names[lab] = noun_counter.most_common(1)[0][0] if noun_counter else "unlabeled"
+        for nouns in noun_lists:
+            noun_counter.update([t for t in nouns.split() if t])
+        cluster_names[int(lab)] = noun_counter.most_common(1)[0][0] if noun_counter else "unlabeled"
+    model = {"reducer": umap_reducer, "clusterer": clusterer, "vectorizer": vectorizer,
+             "names": cluster_names, "size": len(captions)}
+    return labels, model
+
+def assign_clusters(model, captions, cache=None, embed=sentence_embeddings, n_process=1):
+    """Labels for new captions from a fitted model (UMAP transform + HDBSCAN approximate_predict)."""
+    if model["vectorizer"] is not None:
+        embeddings = model["vectorizer"].transform(extract_nouns(captions, n_process)).toarray()
+    else:
+        embeddings = embed(captions, cache)
+    labels, _ = hdbscan.approximate_predict(model["clusterer"], model["reducer"].transform(embeddings))
+    return labels
+
+def cluster_captions(captions, cache=None, embed=sentence_embeddings):
+    """(labels, cluster_names) of a full fit."""
+    labels, model = fit_clusters(captions, cache, embed)
+    return labels, model["names"]
+
+def link_or_copy(src, dst_dir):
+    # a hardlink costs no space or I/O; copy only across filesystems
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.exists(dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+def write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+def main():
+    """
+    Unsupervised Image Classifier using caption clustering
+    Usage:
+        python unsupervised_image_classifier.py --input_dir <input_directory> --output_dir <output_directory>
+    With --incremental, records not yet in output_dir's classification metadata are assigned to the
+    clusters saved by the last full fit instead of re-clustering everything.
+    """
+
+    parser = argparse.ArgumentParser(description="Unsupervised Image Classifier")
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory containing input images')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to classification metadata will be saved as a json')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Embedding cache root (default: $NIGHTSHADE_CACHE_DIR or ~/.cache/nightshade)')
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--incremental', action='store_true', help='assign new records to the saved clusters without refitting')
+    parser.add_argument('--refit_ratio', type=float, default=0.5,
+                        help='refit from scratch anyway once new records exceed this fraction of the fitted corpus')
+    parser.add_argument('--n_process', type=int, default=1, help='spaCy worker processes for noun extraction')
+    parser.add_argument('--membership', choices=['link', 'copy'], default='link',
+                        help='pickle inputs: hardlink (fallback: copy) or copy them into cluster folders; shard inputs always get index-only cluster stores')
+
+    args = parser.parse_args()
+
+    input_dir = args.input_dir
+    output_dir = args.output_dir
+    cache = None if args.no_cache else EmbeddingCache("sentence_embeddings", args.cache_dir)
+    metadata_path = os.path.join(output_dir, METADATA_FILE)
+    model_path = os.path.join(output_dir, MODEL_FILE)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    ###sanity check messages
+    print(f"Loading images from {input_dir}...")
+    print(f"Saving classified images to {output_dir}...")
+
+    ## open input directory and store file path and captions in a list
+    # a sharded store serves captions from its index without reading any pixels
+    reader = open_reader(input_dir)
+    sharded = isinstance(reader, ShardReader)
+    if sharded:
+        file_paths = reader.names
+    else:
+        file_paths = [reader.file_path(i) for i in range(len(reader))]
+    captions = reader.texts
+
+    previous = {}
+    model = None
+    if os.path.exists(metadata_path) and os.path.exists(model_path):
+        with open(metadata_path) as f:
+            previous = json.load(f)
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+    new = [i for i, file_path in enumerate(file_paths) if file_path not in previous]
+
+    if args.incremental and model is not None and len(new) <= args.refit_ratio * model["size"]:
+        print(f"Assigning {len(new)} new records to {len(model['names'])} existing clusters...")
+        keep = set(file_paths)
+        classification_metadata = {k: v for k, v in previous.items() if k in keep}
+        labels = assign_clusters(model, [captions[i] for i in new], cache, n_process=args.n_process) if new else []
+        members = new
+    else:
+        # a full refit renames clusters, so folders of the previous fit go
+        for name in set(v['cluster_name'] for v in previous.values()):
+            shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+        labels, model = fit_clusters(captions, cache, n_process=args.n_process)
+        with open(model_path + ".tmp", 'wb') as f:
+            pickle.dump(model, f)
+        os.replace(model_path + ".tmp", model_path)
+        classification_metadata = {}
+        members = list(range(len(file_paths)))
+    cluster_names = model["names"]
 
     # save classification metadata
-    classification_metadata = {}
-    for file_path, label, caption in zip(file_paths, labels, captions):
+    for idx, label in zip(members, labels):
         lab_int = int(label)
         if lab_int == -1:
             cluster_name = "noise"
@@ -120,23 +234,39 @@ def main():
             # cluster_names stores plain strings, so return it directly (don't index [0])
             cluster_name = cluster_names.get(lab_int, "unlabeled")
 
-        classification_metadata[file_path] = {
+        classification_metadata[file_paths[idx]] = {
             'cluster_label': lab_int,
             'cluster_name': cluster_name,
-            'caption': caption
+            'caption': captions[idx]
         }
-    with open(os.path.join(output_dir, 'classification_metadata.json'), 'w') as f:
-        json.dump(classification_metadata, f, indent=4)
 
-
-    ### create a folder for each class and move images into their respective folders
-    for file_path, metadata in classification_metadata.items():
-        cluster_name = metadata['cluster_name']
+    ### put each new member into its class folder: index-only stores or hardlinks, never pixel copies
+    cluster_writers = {}
+    cluster_existing = {}
+    for idx in members:
+        cluster_name = classification_metadata[file_paths[idx]]['cluster_name']
         cluster_folder = os.path.join(output_dir, f"{cluster_name}")
         os.makedirs(cluster_folder, exist_ok=True)
-        shutil.copy(file_path, cluster_folder)
+        if sharded:
+            # cluster folders are index-only stores pointing into the input shards
+            if cluster_name not in cluster_writers:
+                # names already referenced by an interrupted earlier run are not added twice
+                cluster_existing[cluster_name] = set(ShardReader(cluster_folder).names) \
+                    if is_shard_store(cluster_folder) else set()
+                cluster_writers[cluster_name] = ShardWriter(cluster_folder)
+            if file_paths[idx] not in cluster_existing[cluster_name]:
+                cluster_writers[cluster_name].add_reference(reader, idx)
+        elif args.membership == 'link':
+            link_or_copy(file_paths[idx], cluster_folder)
+        else:
+            shutil.copy(file_paths[idx], cluster_folder)
+    for writer in cluster_writers.values():
+        writer.close()
+
+    # written last, so records of an interrupted run are simply assigned again
+    write_json(metadata_path, classification_metadata)
 
     print("Classification metadata saved.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Throughput benchmarks for every stage and for the overlapped pipeline, on the tiny stand-ins in
+standins.py so they run offline on a CPU. Each result is one JSON object; the run is written as
+{"env": {...}, "results": [...]} to stdout (progress goes to stderr), so two runs can be diffed for regressions.
+
+Stages:
+    poison      PoisonGeneration.generate_batch   PGD iterations/s and images/s per resolution and batch size
+    coarse      PoisonGeneration.optimize         coarse-to-fine PGD against full-resolution PGD: final loss ratio,
+                                                  wall-clock speedup and the eps bound, per coarse fraction
+    encoder     encoder_backends                  PGD steps/s of each VAE encoder backend, and its latents and
+                                                  input gradients checked against the eager backend
+    caption     img_to_pickle.caption_images      images/s per corpus size
+    clip        data_extraction.CLIP.score_images images/s per corpus size
+    classifier  cluster_captions                  seconds per corpus size
+    pipeline    Data_Pipeline/pipeline.py         images/s end to end against a local object store
+
+A stage whose dependencies are not installed is reported as skipped instead of failing the run.
+
+Usage:
+    python benchmarks/run_benchmarks.py --out results.json
+    python benchmarks/run_benchmarks.py --stages poison --resolutions 256,512 --precisions fp32,bf16
+    python benchmarks/run_benchmarks.py --stages coarse --iters 100 --coarse_fractions 0.5,0.8 --resolutions 256
+    python benchmarks/run_benchmarks.py --stages encoder --backends eager,torchscript --resolutions 512
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import io
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "Data_Pipeline"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+STAGES = ("poison", "coarse", "encoder", "caption", "clip", "classifier", "pipeline")
+# max |backend - eager| allowed relative to max |eager|, for latents and input gradients
+PARITY_TOLERANCE = {"fp32": 1e-4, "bf16": 5e-2}
+
+
+def timed(fn, repeats):
+    """Median wall time of fn over repeats runs, after one untimed warm-up run."""
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_poison(args):
+    results = []
+    for precision in args.precisions:
+        for resolution in args.resolutions:
+            for batch_size in args.batch_sizes:
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    generator = standins.tiny_poison_generator(cache_dir, resolution=resolution,
+                                                               max_iters=args.iters, precision=precision)
+                    images = standins.random_images(batch_size, resolution)
+                    seconds = timed(lambda: generator.generate_batch(images, standins.TARGET_CONCEPT), args.repeats)
+                results.append(dict(stage="poison", precision=precision, resolution=resolution,
+                                    batch_size=batch_size, iters=args.iters, seconds=seconds,
+                                    iterations_per_s=args.iters / seconds, images_per_s=batch_size / seconds))
+    return results
+
+
+def bench_coarse(args):
+    from opt import images2tensor
+    results = []
+    for resolution in args.resolutions:
+        for batch_size in args.batch_sizes:
+            images = standins.random_images(batch_size, resolution)
+            baseline = None
+            for fraction in [0.0] + args.coarse_fractions:
+                coarse_iters = int(round(fraction * args.iters))
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    generator = standins.tiny_poison_generator(cache_dir, resolution=resolution, max_iters=args.iters,
+                                                               coarse_iters=coarse_iters)
+                    source = images2tensor([generator.transform(img) for img in images], resolution,
+                                           generator.device, generator.dtype, generator.channels_last)
+                    target_latent = generator.get_target_latent(standins.TARGET_CONCEPT)
+                    modifiers = []
+                    seconds = timed(lambda: modifiers.append(generator.optimize(source, target_latent)), args.repeats)
+                    # full-resolution loss of the final modifier, i.e. after the last update
+                    with torch.no_grad():
+                        loss = float(generator.latent_loss(modifiers[-1], source, target_latent).mean())
+                    linf = modifiers[-1].abs().max()
+                    # compared in the modifier's dtype, which is what the clamp bounds it to
+                    within_eps = bool(linf <= torch.tensor(generator.eps / 0.5, dtype=linf.dtype))
+                if baseline is None:
+                    baseline = loss, seconds
+                results.append(dict(stage="coarse", resolution=resolution, batch_size=batch_size, iters=args.iters,
+                                    coarse_iters=coarse_iters, seconds=seconds, loss=loss,
+                                    loss_ratio=loss / baseline[0], speedup=baseline[1] / seconds,
+                                    linf=float(linf), within_eps=within_eps))
+    return results
+
+
+def rel_diff(value, reference):
+    """max |value - reference| relative to max |reference|, as compared with PARITY_TOLERANCE."""
+    return float((value - reference).abs().max() / reference.abs().max())
+
+
+def encoder_step(generator, source, target_latent):
+    """One PGD step's encode + loss, forward and backward; returns (latent, input gradient)."""
+    modifier = torch.zeros_like(source, requires_grad=True)
+    adv_latent = generator.get_latent(torch.clamp(modifier + source, -1, 1))
+    (adv_latent - target_latent).flatten(1).norm(dim=1).sum().backward()
+    return adv_latent.detach(), modifier.grad
+
+
+def bench_encoder(args):
+    results = []
+    for precision in args.precisions:
+        for resolution in args.resolutions:
+            for batch_size in args.batch_sizes:
+                torch.manual_seed(2)
+                source = torch.rand(batch_size, 3, resolution, resolution) * 2 - 1
+                target_latent = reference = None
+                for backend in ["eager"] + [b for b in args.backends if b != "eager"]:
+                    with tempfile.TemporaryDirectory() as cache_dir:
+                        generator = standins.tiny_poison_generator(cache_dir, resolution=resolution,
+                                                                   precision=precision, encoder_backend=backend)
+                        if target_latent is None:
+                            with torch.no_grad():
+                                target_latent = torch.randn_like(generator.get_latent(source))
+                        # the first call traces / compiles; keep it out of the timing
+                        start = time.perf_counter()
+                        latent, grad = encoder_step(generator, source, target_latent)
+                        warmup = time.perf_counter() - start
+                        seconds = timed(lambda: encoder_step(generator, source, target_latent), args.repeats)
+                    if reference is None:
+                        reference = latent, grad
+                    latent_diff, grad_diff = rel_diff(latent, reference[0]), rel_diff(grad, reference[1])
+                    if backend not in args.backends:
+                        continue
+                    results.append(dict(stage="encoder", backend=backend, precision=precision, resolution=resolution,
+                                        batch_size=batch_size, warmup_s=warmup, seconds=seconds,
+                                        steps_per_s=1 / seconds, images_per_s=batch_size / seconds,
+                                        latent_rel_diff=latent_diff, grad_rel_diff=grad_diff,
+                                        parity=max(latent_diff, grad_diff) <= PARITY_TOLERANCE.get(precision, 1e-4)))
+    return results
+
+
+def bench_caption(args):
+    from img_to_pickle import caption_images
+    processor, model = standins.tiny_blip()
+    results = []
+    for size in args.sizes:
+        images = standins.random_images(size, args.image_size)
+        seconds = timed(lambda: caption_images(processor, model, images, "cpu", max_new_tokens=8), args.repeats)
+        results.append(dict(stage="caption", corpus_size=size, seconds=seconds, images_per_s=size / seconds))
+    return results
+
+
+def bench_clip(args):
+    from data_extraction import CLIP
+    model = standins.TinyCLIP()
+    clip_model = CLIP(device="cpu", model=model, preprocess=standins.TinyCLIP.preprocess(), tokenizer=model.tokenize)
+    results = []
+    for size in args.sizes:
+        images = standins.random_images(size, args.image_size)
+        seconds = timed(lambda: clip_model.score_images(images, "a photo of a dog", num_workers=0), args.repeats)
+        results.append(dict(stage="clip", corpus_size=size, seconds=seconds, images_per_s=size / seconds))
+    return results
+
+
+def bench_classifier(args):
+    from unsupervised_image_classifier import cluster_captions
+    results = []
+    for size in args.sizes:
+        captions = standins.random_captions(size)
+        seconds = timed(lambda: cluster_captions(captions, embed=standins.tiny_sentence_embeddings), args.repeats)
+        results.append(dict(stage="classifier", corpus_size=size, seconds=seconds, captions_per_s=size / seconds))
+    return results
+
+
+def bench_pipeline(args):
+    import asyncio
+    from pipeline import Pipeline, make_encode_pool
+    # the spawned encode processes re-import this script, i.e. torch; start them once, outside the timings
+    encode_pool = make_encode_pool(2)
+    list(encode_pool.map(time.sleep, [0.1] * 2))
+    results = []
+    for resolution in args.resolutions:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                store = standins.LocalObjectStore(os.path.join(tmp, "store"))
+                for i, img in enumerate(standins.random_images(size, resolution)):
+                    buf = io.BytesIO()
+                    img.save(buf, format="JPEG")
+                    store.put_object(Bucket="bench", Key=f"raw/img{i:05d}.jpg", Body=buf.getvalue())
+                worker = standins.StandInWorker(os.path.join(tmp, "cache"), resolution=resolution, max_iters=args.iters)
+
+                def run():
+                    pipeline = Pipeline(worker, store, "bench", "raw/", "out/", os.path.join(tmp, "work"), "dog",
+                                        score_threshold=-1.0, force=True,
+                                        concurrency={"download": 4, "upload": 4, "encode": 2},
+                                        encode_pool=encode_pool)
+                    return asyncio.run(pipeline.run())
+
+                summary = run()
+                seconds = timed(run, args.repeats)
+            results.append(dict(stage="pipeline", resolution=resolution, corpus_size=size, iters=args.iters,
+                                seconds=seconds, images_per_s=size / seconds, uploaded=summary["upload"],
+                                first_upload_s=summary["first_done"].get("upload"),
+                                last_download_s=summary["last_done"].get("download")))
+    encode_pool.shutdown()
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"), commit=commit, python=platform.python_version(),
+                torch=torch.__version__, platform=platform.platform(), processor=platform.processor(),
+                cpu_count=os.cpu_count(), torch_threads=torch.get_num_threads())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage and pipeline benchmarks on tiny stand-in models")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES))
+    parser.add_argument("--sizes", type=str, default="8,32,128", help="corpus sizes")
+    parser.add_argument("--resolutions", type=str, default="128,256,512")
+    parser.add_argument("--batch_sizes", type=str, default="1,4", help="PGD batch sizes")
+    parser.add_argument("--precisions", type=str, default="fp32", help="PoisonGeneration precisions, e.g. fp32,bf16")
+    parser.add_argument("--backends", type=str, default="eager,compile,torchscript", help="encoder backends")
+    parser.add_argument("--coarse_fractions", type=str, default="0.5,0.8",
+                        help="shares of --iters run at half resolution in the coarse stage")
+    parser.add_argument("--iters", type=int, default=5, help="PGD iterations per image")
+    parser.add_argument("--image_size", type=int, default=256, help="input size for caption/clip")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--out", type=str, default=None, help="write JSON here as well as to stdout")
+    args = parser.parse_args()
+    args.sizes = [int(x) for x in args.sizes.split(",")]
+    args.resolutions = [int(x) for x in args.resolutions.split(",")]
+    args.batch_sizes = [int(x) for x in args.batch_sizes.split(",")]
+    args.precisions = args.precisions.split(",")
+    args.backends = args.backends.split(",")
+    args.coarse_fractions = [float(x) for x in args.coarse_fractions.split(",")]
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for stage in args.stages.split(","):
+        print(f"[bench] {stage}...", file=sys.stderr, flush=True)
+        try:
+            # stages print progress (e.g. PGD "# Iter" lines); keep stdout for the JSON report only
+            with contextlib.redirect_stdout(sys.stderr):
+                results.extend(globals()["bench_" + stage](args))
+        except ImportError as e:
+            # e.g. clip / spacy / umap not installed on this box
+            results.append(dict(stage=stage, skipped=str(e)))
+
+    report = {"env": environment(), "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Tiny, randomly initialised stand-ins for the models and services the pipeline uses, so the
+benchmarks run offline on a CPU. They keep the real call signatures (and, for the VAE and BLIP,
+the real architectures at a fraction of the width), which is what the timings exercise; their
+outputs are meaningless.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+TARGET_CONCEPT = "tiger"
+WORDS = "a an the photo picture of dog cat tiger bird car tree house on in with grass street red blue small".split()
+
+
+def random_images(n, size, seed=0):
+    rng = np.random.default_rng(seed)
+    return [Image.fromarray(rng.integers(0, 255, (size, size + size // 4, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+def random_captions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, size=6)) for _ in range(n)]
+
+
+def tiny_vae():
+    """AutoencoderKL with the SD layout (4 latent channels, KL posterior) but two narrow blocks."""
+    from diffusers import AutoencoderKL
+    torch.manual_seed(0)
+    vae = AutoencoderKL(block_out_channels=(8, 16), down_block_types=("DownEncoderBlock2D",) * 2,
+                        up_block_types=("UpDecoderBlock2D",) * 2, latent_channels=4, norm_num_groups=4,
+                        layers_per_block=1, mid_block_add_attention=False)
+    vae.decoder = None
+    vae.post_quant_conv = None
+    vae.requires_grad_(False)
+    return vae.eval()
+
+
+def tiny_poison_generator(cache_dir, device="cpu", resolution=512, **kwargs):
+    """PoisonGeneration on tiny_vae(), with a random target latent pre-seeded in cache_dir."""
+    from caching import TargetLatentCache
+    from opt import PoisonGeneration, resolve_precision
+    torch.manual_seed(1)
+    precision = resolve_precision(kwargs.get("precision", "auto"), device)
+    TargetLatentCache(cache_dir).put(PoisonGeneration.target_key(TARGET_CONCEPT, precision),
+                                     torch.randn(1, 4, 64, 64))
+    return PoisonGeneration(TARGET_CONCEPT, device, cache_dir=cache_dir, vae=tiny_vae(), resolution=resolution,
+                            **kwargs)
+
+
+def tiny_blip():
+    """(processor, model) pair accepted by img_to_pickle.caption_images."""
+    from transformers import (BertTokenizerFast, BlipConfig, BlipForConditionalGeneration, BlipImageProcessor,
+                              BlipProcessor)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"] + WORDS
+    vocab_dir = tempfile.mkdtemp(prefix="tiny_blip_")
+    with open(os.path.join(vocab_dir, "vocab.txt"), "w") as f:
+        f.write("\n".join(vocab))
+    tokenizer = BertTokenizerFast(os.path.join(vocab_dir, "vocab.txt"), bos_token="[DEC]")
+    processor = BlipProcessor(image_processor=BlipImageProcessor(size={"height": 64, "width": 64}),
+                              tokenizer=tokenizer)
+    config = BlipConfig(
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=64, patch_size=16),
+        text_config=dict(vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+                         num_attention_heads=2, encoder_hidden_size=32, max_position_embeddings=64,
+                         bos_token_id=vocab.index("[DEC]"), pad_token_id=0, sep_token_id=vocab.index("[SEP]")))
+    torch.manual_seed(0)
+    model = BlipForConditionalGeneration(config).eval()
+    # random weights mostly decode to special tokens, i.e. empty captions that the filter would drop;
+    # suppressing them makes every caption run to max_new_tokens words
+    with torch.no_grad():
+        model.text_decoder.cls.predictions.bias[:6] = -1e4
+    return processor, model
+
+
+class TinyCLIP(torch.nn.Module):
+    """encode_image / encode_text with the openai clip package's conventions."""
+
+    def __init__(self, dim=64, vocab_size=4096):
+        super().__init__()
+        torch.manual_seed(0)
+        self.visual = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 16, 4, stride=4), torch.nn.GELU(),
+            torch.nn.Conv2d(16, 32, 4, stride=4), torch.nn.GELU(),
+            torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(32, dim))
+        self.text = torch.nn.EmbeddingBag(vocab_size, dim)
+        self.vocab_size = vocab_size
+
+    def encode_image(self, images):
+        return self.visual(images)
+
+    def encode_text(self, tokens):
+        return self.text(tokens)
+
+    def tokenize(self, texts, truncate=True, context_length=16):
+        if isinstance(texts, str):
+            texts = [texts]
+        tokens = torch.zeros(len(texts), context_length, dtype=torch.long)
+        for i, text in enumerate(texts):
+            ids = [int(hashlib.md5(w.encode()).hexdigest(), 16) % (self.vocab_size - 1) + 1 for w in text.split()]
+            ids = ids[:context_length]
+            tokens[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        return tokens
+
+    @staticmethod
+    def preprocess():
+        return transforms.Compose([
+            transforms.Resize(64, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(64),
+            transforms.ToTensor(),
+            transforms.Normalize((0.481, 0.458, 0.408), (0.269, 0.261, 0.276)),
+        ])
+
+
+def tiny_sentence_embeddings(captions, cache=None, dim=384):
+    """Drop-in for unsupervised_image_classifier.sentence_embeddings: hashed bag of words, projected."""
+    rng = np.random.default_rng(0)
+    projection = rng.standard_normal((1024, dim)).astype(np.float32)
+    bags = np.zeros((len(captions), 1024), dtype=np.float32)
+    for i, caption in enumerate(captions):
+        for w in caption.split():
+            bags[i, int(hashlib.md5(w.encode()).hexdigest(), 16) % 1024] += 1.0
+    return bags @ projection
+
+
+class StandInWorker(object):
+    """Same caption/score/poison/params interface as poison_worker.PoisonWorker, on the tiny models."""
+
+    def __init__(self, cache_dir, resolution=512, max_iters=5):
+        self.blip_processor, self.blip_model = tiny_blip()
+        self.clip = TinyCLIP()
+        self.clip_preprocess = TinyCLIP.preprocess()
+        self.crop = transforms.Compose([transforms.Resize(resolution), transforms.CenterCrop(resolution)])
+        self.poison_generator = tiny_poison_generator(cache_dir, resolution=resolution, max_iters=max_iters)
+
+    def params(self, stage):
+        return {"stage": stage, "stand_in": True}
+
+    def caption(self, images):
+        from img_to_pickle import caption_images
+        return caption_images(self.blip_processor, self.blip_model, images, "cpu", max_new_tokens=8)
+
+    def score(self, img, concept):
+        cropped = self.crop(img)
+        with torch.no_grad():
+            image_features = self.clip.encode_image(self.clip_preprocess(cropped).unsqueeze(0))
+            text_features = self.clip.encode_text(self.clip.tokenize("a photo of a {}".format(concept)))
+        return float(torch.cosine_similarity(image_features, text_features).item()), cropped
+
+    def poison(self, crops):
+        return self.poison_generator.generate_all(list(crops), TARGET_CONCEPT, batch_size=len(crops))
+
+
+class LocalObjectStore(object):
+    """Directory-backed stand-in for the boto3 S3 client calls made by s3_transfer.py and pipeline.py."""
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(Body)
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        base = os.path.join(self.root, Bucket)
+        objects = []
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                key = os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, "/")
+                if key.startswith(Prefix):
+                    st = os.stat(os.path.join(dirpath, name))
+                    objects.append({"Key": key, "ETag": '"{}-{}"'.format(st.st_size, int(st.st_mtime_ns)),
+                                    "Size": st.st_size})
+        objects.sort(key=lambda o: o["Key"])
+        for start in range(0, len(objects), self.PAGE_SIZE):
+            yield {"Contents": objects[start:start + self.PAGE_SIZE]}
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+import time
+
+import numpy as np
+import torch
+
+DEFAULT_MAX_BYTES = 2 << 30
+
+
+def default_cache_dir():
+    # shared by every stage so cached work survives the rm -rf in the run scripts
+    return os.environ.get("NIGHTSHADE_CACHE_DIR", os.path.expanduser("~/.cache/nightshade"))
+
+
+def make_key(*parts):
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def content_hash(data):
+    """Hash of raw bytes, a file path's bytes, a numpy array or a PIL image."""
+    h = hashlib.blake2b(digest_size=20)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        h.update(data)
+    elif isinstance(data, (str, os.PathLike)):
+        with open(data, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    else:
+        arr = np.ascontiguousarray(np.asarray(data))
+        h.update(str((arr.shape, arr.dtype.str)).encode("utf-8"))
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    Content-addressed on-disk cache for model outputs (embeddings as arrays, captions as strings).
+    Keys combine a content hash with the model id and preprocessing parameters. Reads refresh an
+    entry's mtime, and the least recently used entries are evicted once the namespace exceeds max_bytes.
+    With max_age (seconds) set, entries unused for longer than that are dropped as well.
+    """
+
+    def __init__(self, namespace, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, max_age=None):
+        self.root = os.path.join(cache_dir or default_cache_dir(), namespace)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._size = None
+
+    @staticmethod
+    def key(content_hash, model_id, **params):
+        return make_key(content_hash, model_id, params)
+
+    def _path(self, key, ext):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def contains(self, key):
+        return os.path.exists(self._path(key, ".npy")) or os.path.exists(self._path(key, ".json"))
+
+    def get(self, key):
+        for ext in (".npy", ".json"):
+            path = self._path(key, ext)
+            try:
+                if ext == ".npy":
+                    value = np.load(path)
+                else:
+                    with open(path, "r", encoding="utf-8") as f:
+                        value = json.load(f)
+            except (OSError, ValueError):
+                continue
+            try:
+                os.utime(path)  # mark as recently used
+            except OSError:
+                pass  # evicted since it was read; the value is still good
+            return value
+        return None
+
+    def put(self, key, value):
+        ext = ".npy" if isinstance(value, np.ndarray) else ".json"
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.{}".format(os.getpid())
+        if ext == ".npy":
+            with open(tmp_path, "wb") as f:
+                np.save(f, value)
+        else:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            # first write of the process: full scan, which also applies the age limit
+            self.evict()
+        else:
+            # an overwritten entry only adds the difference
+            self._size += os.path.getsize(path) - replaced
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if ".tmp." in name:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        # drop expired entries, then least recently used ones until the namespace is under 90% of its budget
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        oldest_allowed = time.time() - self.max_age if self.max_age is not None else None
+        for mtime, size, path in entries:
+            expired = oldest_allowed is not None and mtime < oldest_allowed
+            if not expired and total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+
+class TargetLatentCache(object):
+    """
+    Caches target latents keyed by (model id, revision, precision, prompt, seed, guidance, steps, resolution).
+    Entries live in memory for the process and are persisted under cache_dir/targets.
+    """
+
+    _memory = {}
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), "targets")
+
+    @staticmethod
+    def key(model_id, revision, precision, prompt, seed, guidance_scale, num_inference_steps, height, width):
+        return make_key(model_id, revision, precision, prompt, seed, guidance_scale, num_inference_steps, height,
+                        width)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def contains(self, key):
+        return key in self._memory or os.path.exists(self._path(key))
+
+    def get(self, key, device=None):
+        latent = self._memory.get(key)
+        if latent is None:
+            path = self._path(key)
+            if not os.path.exists(path):
+                return None
+            try:
+                latent = torch.load(path, map_location="cpu")
+            except Exception as e:
+                print(f"[cache] Ignoring unreadable target latent {path}: {e}")
+                return None
+            self._memory[key] = latent
+        return latent.to(device) if device is not None else latent
+
+    def put(self, key, latent, image=None):
+        latent = latent.detach().cpu()
+        self._memory[key] = latent
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write then rename so concurrent runs never read a half-written file
+        tmp_path = self._path(key) + ".tmp.{}".format(os.getpid())
+        torch.save(latent, tmp_path)
+        os.replace(tmp_path, self._path(key))
+        if image is not None:
+            image.save(os.path.join(self.cache_dir, key + ".png"))
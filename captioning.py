@@ -0,0 +1,194 @@
+"""
+Batched BLIP captioning shared by Data_Pipeline/img_to_pickle.py, poison_worker.py and
+test_stable_diffusion/prep_loras/caption_raw.py.
+
+- Greedy decoding runs its own loop over the text decoder: a caption that emits [SEP] leaves the
+  batch and the KV cache right away, so short captions stop costing decoder time while the longest
+  one in the batch finishes. Output matches model.generate.
+- Images are decoded and preprocessed by a thread pool ahead of the model (caption_files).
+- The batch size defaults to what free GPU memory / RAM allows and is halved on out-of-memory.
+- dtype follows the device: fp16 on CUDA, bf16 on CPUs with native bf16 (AVX512-BF16/AMX), else fp32.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import BlipForConditionalGeneration, BlipProcessor
+
+BLIP_MODEL_ID = "Salesforce/blip-image-captioning-base"
+MB = 1 << 20
+# activation memory per image at 384px with a 30-token caption, measured with headroom
+PER_IMAGE_MB = {torch.float32: 160, torch.float16: 80, torch.bfloat16: 80}
+MAX_BATCH_SIZE = {"cuda": 64, "cpu": 16}
+
+
+def cpu_has_bf16():
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def caption_dtype(device):
+    if str(device).startswith("cuda"):
+        return torch.float16
+    return torch.bfloat16 if cpu_has_bf16() else torch.float32
+
+
+def available_memory(device):
+    if str(device).startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4 << 30
+
+
+def auto_batch_size(device, dtype):
+    """Largest batch that fits in about half of the currently free memory, capped per device type."""
+    kind = "cuda" if str(device).startswith("cuda") else "cpu"
+    fits = int(available_memory(device) * 0.5 / (PER_IMAGE_MB.get(dtype, 160) * MB))
+    return max(1, min(MAX_BATCH_SIZE[kind], fits))
+
+
+def is_oom(error):
+    msg = str(error)
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in msg or "can't allocate memory" in msg
+
+
+#load BLIP once per process
+def load_blip(device, dtype):
+    processor = BlipProcessor.from_pretrained(BLIP_MODEL_ID, use_fast=True)
+    model = BlipForConditionalGeneration.from_pretrained(
+        BLIP_MODEL_ID,
+        torch_dtype=dtype
+    ).to(device)
+    model.eval()
+    return processor, model
+
+
+def plain_greedy(model):
+    """True if the text decoder's generation config is plain greedy search, which generate_captions reimplements."""
+    config = model.text_decoder.generation_config
+    return (config.num_beams or 1) == 1 and not config.do_sample and (config.repetition_penalty or 1.0) == 1.0 \
+        and not config.no_repeat_ngram_size and not config.min_length and not config.min_new_tokens \
+        and not config.bad_words_ids and not config.suppress_tokens
+
+
+def generate_captions(model, pixel_values, max_new_tokens=30):
+    """
+    Token ids (after the [DEC] prefix) of greedy captions. Finished captions are dropped from the
+    batch and from the KV cache at every step instead of being padded until the longest one ends.
+    """
+    text_config = model.config.text_config
+    with torch.inference_mode():
+        if not plain_greedy(model):
+            return list(model.generate(pixel_values=pixel_values, max_new_tokens=max_new_tokens)[:, 1:])
+        image_embeds = model.vision_model(pixel_values=pixel_values)[0]
+        n = len(image_embeds)
+        tokens = torch.full((n, max_new_tokens), text_config.pad_token_id, dtype=torch.long, device=image_embeds.device)
+        lengths = [max_new_tokens] * n
+        active = torch.arange(n, device=image_embeds.device)
+        step_ids = torch.full((n, 1), text_config.bos_token_id, dtype=torch.long, device=image_embeds.device)
+        mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device)
+        past = None
+        for step in range(max_new_tokens):
+            out = model.text_decoder(input_ids=step_ids, encoder_hidden_states=image_embeds,
+                                     encoder_attention_mask=mask, past_key_values=past, use_cache=True,
+                                     return_dict=True)
+            past = out.past_key_values
+            next_ids = out.logits[:, -1, :].argmax(dim=-1)
+            tokens[active, step] = next_ids
+            done = next_ids == text_config.sep_token_id
+            if done.any():
+                for i in active[done].tolist():
+                    lengths[i] = step + 1
+                keep = (~done).nonzero().flatten()
+                if not len(keep):
+                    break
+                past.batch_select_indices(keep)
+                image_embeds, mask, active, next_ids = image_embeds[keep], mask[keep], active[keep], next_ids[keep]
+            step_ids = next_ids[:, None]
+    return [tokens[i, :length] for i, length in enumerate(lengths)]
+
+
+def caption_images(processor, model, images, device, max_new_tokens=30):
+    """Captions for a list of PIL images in one batch."""
+    inputs = processor(images=images, return_tensors="pt")
+    pixel_values = inputs["pixel_values"].to(device, model.dtype)
+    tokens = generate_captions(model, pixel_values, max_new_tokens)
+    return processor.tokenizer.batch_decode(tokens, skip_special_tokens=True)
+
+
+class CaptionEngine(object):
+    def __init__(self, device=None, dtype=None, batch_size=None, max_new_tokens=30, workers=None,
+                 processor=None, model=None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if model is None:
+            processor, model = load_blip(self.device, dtype or caption_dtype(self.device))
+        self.dtype = model.dtype
+        self.processor = processor
+        self.model = model
+        self.batch_size = batch_size or auto_batch_size(self.device, self.dtype)
+        self.max_new_tokens = max_new_tokens
+        self.workers = workers or min(8, os.cpu_count() or 1)
+
+    def preprocess(self, img):
+        return self.processor(images=img, return_tensors="pt")["pixel_values"][0]
+
+    def caption_tensors(self, pixel_values):
+        """Captions for preprocessed (N, 3, H, W) pixels; halves the batch size and retries on OOM."""
+        captions = []
+        start = 0
+        while start < len(pixel_values):
+            batch = pixel_values[start:start + self.batch_size].to(self.device, self.dtype)
+            try:
+                tokens = generate_captions(self.model, batch, self.max_new_tokens)
+            except RuntimeError as e:
+                if not is_oom(e) or self.batch_size == 1:
+                    raise
+                self.batch_size = max(1, self.batch_size // 2)
+                print(f"[captioning] Out of memory, retrying with batch size {self.batch_size}")
+                if str(self.device).startswith("cuda"):
+                    torch.cuda.empty_cache()
+                continue
+            captions.extend(self.processor.tokenizer.batch_decode(tokens, skip_special_tokens=True))
+            start += len(batch)
+        return captions
+
+    def caption(self, images):
+        """Captions for a list of PIL images, in order."""
+        if not images:
+            return []
+        return self.caption_tensors(torch.stack([self.preprocess(img) for img in images]))
+
+    def caption_files(self, paths, load):
+        """
+        Yields (path, caption) in order, or (path, None) when load(path) returns None. Decode and
+        preprocessing of upcoming files run in a thread pool while the current batch is generated.
+        """
+        def prepare(path):
+            img = load(path)
+            return path, None if img is None else self.preprocess(img)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            paths = iter(paths)
+            exhausted = False
+            while pending or not exhausted:
+                # keep two batches of decodes in flight
+                while not exhausted and len(pending) < 2 * self.batch_size:
+                    path = next(paths, None)
+                    if path is None:
+                        exhausted = True
+                    else:
+                        pending.append(pool.submit(prepare, path))
+                batch = [pending.popleft().result() for _ in range(min(self.batch_size, len(pending)))]
+                ready = [(path, pixels) for path, pixels in batch if pixels is not None]
+                captions = iter(self.caption_tensors(torch.stack([p for _, p in ready]))) if ready else iter(())
+                for path, pixels in batch:
+                    yield path, (None if pixels is None else next(captions))
@@ -13,6 +13,11 @@ import numpy as np
 import random
 from sklearn.metrics.pairwise import cosine_similarity
 import clip
+from dataset_store import open_reader, open_writer
+from caching import EmbeddingCache, content_hash, text_hash
+
+CLIP_MODEL_ID = "ViT-B/32"
+SCORE_THRESHOLD = 0.05  # changed this from .24 to .05 i dont think accuracy matters much for the proof of concept, but we should find a better way to set this threshold later.
 
 
 def crop_to_square(img):
@@ -26,39 +31,139 @@ def crop_to_square(img):
     return image_transforms(img)
 
 
+class PreprocessedImages(torch.utils.data.Dataset):
+    """
+    Yields (cache key, cached embedding, preprocessed tensor): the embedding when the cache has it, else the
+    tensor to encode. One get() decides, so an entry evicted meanwhile is simply encoded again.
+    """
+
+    def __init__(self, images, preprocess, cache=None, dtype=None):
+        self.images = images
+        self.preprocess = preprocess
+        self.cache = cache
+        self.dtype = str(dtype)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        img = self.images[idx]
+        if self.cache is None:
+            return None, None, self.preprocess(img)
+        key = EmbeddingCache.key(content_hash(img), CLIP_MODEL_ID, kind="image", dtype=self.dtype)
+        embedding = self.cache.get(key)
+        if embedding is not None:
+            return key, embedding, None
+        return key, None, self.preprocess(img)
+
+
+class CroppedRecords(object):
+    """Lazy view of a dataset reader: decodes and square-crops record idx on access."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, idx):
+        return crop_to_square(Image.fromarray(np.asarray(self.reader.image(idx))))
+
+
 class CLIP(object):
-    def __init__(self):
-        self.device = "cuda"
-        model, preprocess = clip.load("ViT-B/32", device=self.device)
-        tokenizer = clip.tokenize
-        model = model.cuda()
+    def __init__(self, device=None, cache=None, model=None, preprocess=None, tokenizer=None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.cache = cache
+        if model is None:
+            model, preprocess = clip.load(CLIP_MODEL_ID, device=self.device)
+        # any model with encode_image/encode_text works, e.g. a tiny stand-in for benchmarks
+        tokenizer = tokenizer or clip.tokenize
+        model = model.to(self.device)
         self.model = model
+        # clip.load gives fp16 weights on CUDA and fp32 on CPU; their embeddings are cached apart
+        self.dtype = next(model.parameters()).dtype
         self.preprocess = preprocess
         self.tokenizer = tokenizer
 
     def text_emb(self, text_ls):
         if isinstance(text_ls, str):
             text_ls = [text_ls]
+        if self.cache is not None:
+            return self._cached_text_emb(text_ls)
         text = self.tokenizer(text_ls, truncate=True).to(self.device)
         with torch.no_grad():
             text_features = self.model.encode_text(text)
         return text_features
 
+    def _cached_text_emb(self, text_ls):
+        keys = [EmbeddingCache.key(text_hash(t), CLIP_MODEL_ID, kind="text", dtype=str(self.dtype)) for t in text_ls]
+        features = [self.cache.get(k) for k in keys]
+        misses = [i for i, f in enumerate(features) if f is None]
+        if misses:
+            text = self.tokenizer([text_ls[i] for i in misses], truncate=True).to(self.device)
+            with torch.no_grad():
+                new_features = self.model.encode_text(text).cpu().numpy()
+            for i, f in zip(misses, new_features):
+                features[i] = f
+                self.cache.put(keys[i], f)
+        return torch.from_numpy(np.stack(features)).to(self.device)
+
     def img_emb(self, img):
-        image = self.preprocess(img).unsqueeze(0).to("cuda")
+        image = self.preprocess(img).unsqueeze(0).to(self.device)
         with torch.no_grad():
             image_features = self.model.encode_image(image)
         return image_features
 
+    def score_images(self, images, text, batch_size=64, num_workers=4):
+        """
+        Cosine similarity of every image with one prompt. The prompt is encoded once; images are
+        preprocessed by DataLoader workers and encoded in batches. images can be any indexable
+        sequence of PIL images, including a lazy one that decodes on access.
+        """
+        text_features = self.text_emb(text)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+
+        scores = []
+        for image_features in self.image_embs(images, batch_size, num_workers):
+            image_features = image_features.to(text_features.dtype)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            scores.append((image_features @ text_features.T).squeeze(-1).float().cpu())
+        if not scores:
+            return np.zeros(0, dtype=np.float32)
+        return torch.cat(scores).numpy()
+
+    def image_embs(self, images, batch_size=64, num_workers=4):
+        """Yields unnormalised image features batch by batch, serving cached embeddings without a forward pass."""
+        dataset = PreprocessedImages(images, self.preprocess, self.cache, self.dtype)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                                             collate_fn=list, pin_memory=False)
+        with torch.no_grad():
+            for batch in loader:
+                features = [None] * len(batch)
+                misses = [i for i, (_, _, tensor) in enumerate(batch) if tensor is not None]
+                for i, (_, embedding, _) in enumerate(batch):
+                    if embedding is not None:
+                        features[i] = torch.from_numpy(np.asarray(embedding)).to(self.device)
+                if misses:
+                    stacked = torch.stack([batch[i][2] for i in misses])
+                    if self.device.startswith("cuda"):
+                        stacked = stacked.pin_memory()
+                    encoded = self.model.encode_image(stacked.to(self.device, non_blocking=True))
+                    for i, f in zip(misses, encoded):
+                        features[i] = f
+                        if self.cache is not None:
+                            self.cache.put(batch[i][0], f.cpu().numpy())
+                yield torch.stack(features)
+
     def __call__(self, image, text, softmax=False):
         if isinstance(text, str):
             text = [text]
 
         if isinstance(image, list):
-            image = [self.preprocess(i).unsqueeze(0).to("cuda") for i in image]
+            image = [self.preprocess(i).unsqueeze(0).to(self.device) for i in image]
             image = torch.concat(image)
         else:
-            image = self.preprocess(image).unsqueeze(0).to("cuda")
+            image = self.preprocess(image).unsqueeze(0).to(self.device)
 
         text = self.tokenizer(text).to(self.device)
 
@@ -81,22 +186,20 @@ class CLIP(object):
 
 
 def main():
-    clip_model = CLIP()
+    cache = None if args.no_cache else EmbeddingCache("clip", args.cache_dir)
+    clip_model = CLIP(cache=cache)
     data_dir = args.directory
 
     source_concept = args.concept
     os.makedirs(args.outdir, exist_ok=True)
-    all_data = glob.glob(os.path.join(data_dir, "*.p"))
-    res_ls = []
-    for idx, cur_data_f in enumerate(all_data):
-        cur_data = pickle.load(open(cur_data_f, "rb"))
-        cur_img = Image.fromarray(cur_data["img"])
-        cur_text = cur_data["text"]
-
-        cur_img = crop_to_square(cur_img)
-        score = clip_model(cur_img, "a photo of a {}".format(source_concept))
-        if score > 0.05: # changed this from .24 to .05 i dont think accuracy matters much for the proof of concept, but we should find a better way to set this threshold later. 
-            res_ls.append((cur_img, cur_text))
+    reader = open_reader(data_dir)
+    # decode + crop + preprocess run in DataLoader workers; the prompt is encoded once for the folder
+    cropped = CroppedRecords(reader)
+    scores = clip_model.score_images(cropped, "a photo of a {}".format(source_concept),
+                                     batch_size=args.batch_size, num_workers=args.num_workers)
+    texts = reader.texts
+    # only the passing indices are kept; crops are rebuilt for the few that get selected
+    res_ls = [(idx, texts[idx]) for idx in range(len(reader)) if scores[idx] > SCORE_THRESHOLD]
 
     # Guard: nothing passed threshold
     if len(res_ls) == 0:
@@ -130,13 +233,10 @@ def main():
     random_selected_candidate = random.sample(list(candidate), k)
 
     final_list = [res_ls[i] for i in random_selected_candidate]
-    for i, data in enumerate(final_list):
-        img, text = data
-        cur_data = {
-            "img": np.array(img),
-            "text": text,
-        }
-        pickle.dump(cur_data, open(os.path.join(args.outdir, "{}.p".format(i)), "wb"))
+    with open_writer(args.outdir, args.format) as writer:
+        for i, data in enumerate(final_list):
+            idx, text = data
+            writer.add(str(i), np.array(cropped[idx]), text)
 
 
 def parse_arguments(argv):
@@ -149,6 +249,15 @@ def parse_arguments(argv):
                         help="", default=100)
     parser.add_argument('-c', '--concept', type=str, required=True,
                         help="")
+    parser.add_argument('--format', choices=["pickle", "shard"], default="pickle",
+                        help="output format; the input format is detected")
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help="images per CLIP forward pass")
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="DataLoader workers for decode/crop/preprocess")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="embedding cache root (default: $NIGHTSHADE_CACHE_DIR or ~/.cache/nightshade)")
+    parser.add_argument('--no_cache', action='store_true')
     return parser.parse_args(argv)
 
 
@@ -0,0 +1,249 @@
+"""
+Sharded image/caption store shared by every pipeline stage.
+
+A store is a directory holding
+    index.jsonl        one JSON line per record: name, text, shard, offset, shape (+ any extra metadata);
+                       a later line with the same name replaces the earlier one
+    shard_00000.bin    raw uint8 HWC image bytes, appended back to back
+
+Captions and metadata come from the index alone, so filtering and selecting never touch pixel data.
+Images are zero-copy views into memory-mapped shards. An index entry may point at a shard of another
+store, which is how cluster folders and merged outputs are built without copying pixels.
+
+The older one-pickle-per-image directories ({"img": ndarray, "text": str}) are still readable and
+writable through the same open_reader / open_writer API.
+
+Usage:
+    python dataset_store.py count <store>
+    python dataset_store.py merge <out_store> <store> [<store> ...]   # names prefixed with the store's dirname
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+from PIL import Image
+
+INDEX_FILE = "index.jsonl"
+DEFAULT_SHARD_BYTES = 1 << 30
+
+
+def is_shard_store(path):
+    return os.path.exists(os.path.join(path, INDEX_FILE))
+
+
+def to_uint8_array(img):
+    if isinstance(img, Image.Image):
+        img = np.asarray(img.convert("RGB"))
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        img = img.astype(np.uint8)
+    return np.ascontiguousarray(img)
+
+
+class ShardReader(object):
+    def __init__(self, path):
+        self.path = path
+        # name -> record; a name written again (a resumed run redoing a record whose completion was never
+        # marked) keeps its first position and its last copy
+        records = {}
+        with open(os.path.join(path, INDEX_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    records[record["name"]] = record
+        self.records = list(records.values())
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def names(self):
+        return [r["name"] for r in self.records]
+
+    @property
+    def texts(self):
+        return [r["text"] for r in self.records]
+
+    def name(self, i):
+        return self.records[i]["name"]
+
+    def text(self, i):
+        return self.records[i]["text"]
+
+    def shard_path(self, i):
+        # relative shard names live next to the index; absolute ones point into another store
+        return os.path.join(self.path, self.records[i]["shard"])
+
+    def image(self, i):
+        """Zero-copy, read-only HWC uint8 view of record i."""
+        rec = self.records[i]
+        shard = self.shard_path(i)
+        mm = self._maps.get(shard)
+        if mm is None:
+            mm = np.memmap(shard, dtype=np.uint8, mode="r")
+            self._maps[shard] = mm
+        size = int(np.prod(rec["shape"]))
+        return mm[rec["offset"]:rec["offset"] + size].reshape(rec["shape"])
+
+    def load(self, i):
+        return {"img": self.image(i), "text": self.text(i)}
+
+
+class PickleDirReader(object):
+    """Same read API over a directory of {"img", "text"} pickles."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = sorted(f for f in os.listdir(path) if f.endswith(".p"))
+        self._texts = None
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def names(self):
+        return [os.path.splitext(f)[0] for f in self.files]
+
+    @property
+    def texts(self):
+        # pickles have no separate index, so captions cost a full unpickle
+        if self._texts is None:
+            self._texts = [self.load(i)["text"] for i in range(len(self))]
+        return self._texts
+
+    def name(self, i):
+        return os.path.splitext(self.files[i])[0]
+
+    def text(self, i):
+        return self.texts[i]
+
+    def file_path(self, i):
+        return os.path.join(self.path, self.files[i])
+
+    def image(self, i):
+        return self.load(i)["img"]
+
+    def load(self, i):
+        with open(self.file_path(i), "rb") as f:
+            return pickle.load(f)
+
+
+class ShardWriter(object):
+    def __init__(self, path, shard_bytes=DEFAULT_SHARD_BYTES):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        os.makedirs(path, exist_ok=True)
+        # appending to an existing store starts a fresh shard so earlier shards are never rewritten
+        self._shard_idx = len([f for f in os.listdir(path) if f.startswith("shard_")])
+        self._shard = None
+        self._offset = 0
+        self._index = open(os.path.join(path, INDEX_FILE), "a", encoding="utf-8")
+
+    def _open_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_name = "shard_{:05d}.bin".format(self._shard_idx)
+        self._shard_idx += 1
+        self._shard = open(os.path.join(self.path, self._shard_name), "ab")
+        self._offset = self._shard.tell()
+
+    def add(self, name, img, text, **meta):
+        arr = to_uint8_array(img)
+        if self._shard is None or self._offset + arr.nbytes > self.shard_bytes:
+            self._open_shard()
+        self._shard.write(arr.tobytes())
+        self._shard.flush()
+        record = dict(meta, name=name, text=text, shard=self._shard_name, offset=self._offset,
+                      shape=list(arr.shape))
+        self._offset += arr.nbytes
+        self._write_record(record)
+
+    def add_reference(self, reader, i, name=None, **meta):
+        """Adds record i of another ShardReader without copying its pixels."""
+        record = dict(reader.records[i], **meta)
+        record["shard"] = os.path.abspath(reader.shard_path(i))
+        if name is not None:
+            record["name"] = name
+        self._write_record(record)
+
+    def _write_record(self, record):
+        # the index line is written after the pixels, so a crash never leaves a dangling entry
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()
+
+    def close(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PickleDirWriter(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, name, img, text, **meta):
+        with open(os.path.join(self.path, "{}.p".format(name)), "wb") as f:
+            pickle.dump({"img": img, "text": text}, f, protocol=4)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_reader(path):
+    return ShardReader(path) if is_shard_store(path) else PickleDirReader(path)
+
+
+def open_writer(path, fmt="pickle"):
+    if fmt == "shard":
+        return ShardWriter(path)
+    if fmt == "pickle":
+        return PickleDirWriter(path)
+    raise ValueError("Unknown dataset format: {}".format(fmt))
+
+
+def merge(out_path, in_paths):
+    with ShardWriter(out_path) as writer:
+        for in_path in in_paths:
+            prefix = os.path.basename(os.path.normpath(in_path))
+            reader = ShardReader(in_path)
+            for i in range(len(reader)):
+                writer.add_reference(reader, i, name="{}_{}".format(prefix, reader.name(i)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and combine sharded image stores")
+    sub = parser.add_subparsers(dest="command", required=True)
+    count_p = sub.add_parser("count")
+    count_p.add_argument("store")
+    merge_p = sub.add_parser("merge")
+    merge_p.add_argument("out_store")
+    merge_p.add_argument("stores", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "count":
+        print(len(open_reader(args.store)) if os.path.isdir(args.store) else 0)
+    else:
+        merge(args.out_store, [p for p in args.stores if is_shard_store(p)])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
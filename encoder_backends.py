@@ -0,0 +1,99 @@
+"""
+Interchangeable implementations of the VAE encode that PGD runs forward and backward every step.
+PoisonGeneration(encoder_backend=...) / gen_poison.py --encoder_backend pick one; the attack code only
+ever calls encoder(tensor) -> latent mean and differentiates through it.
+
+    eager        plain PyTorch modules
+    compile      torch.compile of the encode (first call per input shape is slow)
+    torchscript  torch.jit.trace of the encode per input shape; the traced graph keeps autograd, so
+                 input gradients work as in eager mode
+
+ONNX Runtime is not offered: its inference sessions cannot return gradients w.r.t. the input.
+benchmarks/run_benchmarks.py --stages encoder checks each backend against eager and measures steps/s,
+to pick the fastest one for a host.
+"""
+import contextlib
+import warnings
+
+import torch
+
+ENCODER_BACKENDS = ("eager", "compile", "torchscript")
+
+
+class _Encode(torch.nn.Module):
+    # a module whose forward is only the encode, so it can be traced or compiled on its own
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, tensor):
+        return self.vae.encode(tensor).latent_dist.mean
+
+
+@contextlib.contextmanager
+def _jit_autocast_off():
+    # under autocast the trace records the casts itself; TorchScript's own autocast pass would then rewrite
+    # the graph on some calls and not others, giving results that drift from eager
+    prev = torch._C._jit_set_autocast_mode(False)
+    try:
+        yield
+    finally:
+        torch._C._jit_set_autocast_mode(prev)
+
+
+class EagerEncoder(object):
+    name = "eager"
+
+    def __init__(self, vae, device="cpu", autocast_dtype=None):
+        self.module = _Encode(vae)
+        self.device_type = torch.device(device).type
+        self.autocast_dtype = autocast_dtype
+
+    def encode(self, tensor):
+        return self.module(tensor)
+
+    def __call__(self, tensor):
+        if self.autocast_dtype is not None:
+            with torch.autocast(self.device_type, dtype=self.autocast_dtype):
+                return self.encode(tensor).float()
+        return self.encode(tensor)
+
+
+class CompiledEncoder(EagerEncoder):
+    name = "compile"
+
+    def __init__(self, vae, device="cpu", autocast_dtype=None):
+        super().__init__(vae, device, autocast_dtype)
+        self.compiled = torch.compile(self.module)
+
+    def encode(self, tensor):
+        return self.compiled(tensor)
+
+
+class TorchScriptEncoder(EagerEncoder):
+    name = "torchscript"
+
+    def __init__(self, vae, device="cpu", autocast_dtype=None):
+        super().__init__(vae, device, autocast_dtype)
+        # one trace per (shape, layout): PGD drops converged samples, and targets are encoded at their own size
+        self.traces = {}
+
+    def encode(self, tensor):
+        key = (tuple(tensor.shape), tensor.is_contiguous(memory_format=torch.channels_last), tensor.dtype,
+               torch.is_autocast_enabled())
+        with _jit_autocast_off():
+            if key not in self.traces:
+                # traced on a detached copy so the trace itself records no graph of the caller's tensor;
+                # check_trace would run the model twice more for nothing
+                with warnings.catch_warnings():
+                    # diffusers' shape asserts are constant for a fixed input shape, which is what a trace is for
+                    warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                    self.traces[key] = torch.jit.trace(self.module, tensor.detach(), check_trace=False)
+            return self.traces[key](tensor)
+
+
+def make_encoder(backend, vae, device="cpu", autocast_dtype=None):
+    classes = {cls.name: cls for cls in (EagerEncoder, CompiledEncoder, TorchScriptEncoder)}
+    if backend not in classes:
+        raise ValueError(f"unknown encoder backend {backend!r}; choose from {', '.join(ENCODER_BACKENDS)}")
+    return classes[backend](vae, device, autocast_dtype)
@@ -0,0 +1,195 @@
+"""
+Image export shared by Data_Pipeline/Extract_Data.py, Extract_Data_Lora.py, poison_worker.py and
+gen_poison.py --export_dir.
+
+Images are encoded in a process pool (PNG at a chosen compress level, lossless WebP or JPEG at a
+chosen quality) while the caller keeps producing them, and metadata.csv is written once, when the
+exporter is flushed or closed, through a temp file and rename. Callers hand over PIL images, arrays
+or tensors directly, so poisoned outputs need not go through a pickle first.
+"""
+import csv
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+METADATA_FILE = "metadata.csv"
+
+
+def to_pixels(img_data):
+    """HWC uint8 array from a PIL image, numpy array or torch tensor; floats are taken to be in [0, 1]."""
+    if isinstance(img_data, Image.Image):
+        return np.asarray(img_data if img_data.mode in ("RGB", "L") else img_data.convert("RGB"))
+    if hasattr(img_data, "detach"):
+        img_data = img_data.detach().cpu().numpy()
+    if not isinstance(img_data, np.ndarray):
+        raise TypeError(f"unknown image data type: {type(img_data)}")
+    if img_data.dtype == np.float32 or img_data.dtype == np.float64:
+        img_data = img_data * 255.0
+    return img_data.astype(np.uint8, copy=False)
+
+
+def encode_image(pixels, path, fmt="png", compress_level=6, quality=95):
+    # runs in a worker process; write then rename so nobody ever sees a partial file
+    start = time.perf_counter()
+    tmp_path = str(path) + ".part"
+    img = Image.fromarray(pixels)
+    if fmt == "png":
+        img.save(tmp_path, format="PNG", compress_level=compress_level)
+    elif fmt == "webp":
+        img.save(tmp_path, format="WEBP", lossless=True, quality=quality)
+    else:
+        img.save(tmp_path, format="JPEG", quality=quality)
+    os.replace(tmp_path, path)
+    # the pool process has no metrics sink, so the caller records the encode time
+    return time.perf_counter() - start
+
+
+def read_metadata(path):
+    """(file_name, text) rows of an existing metadata.csv, or [] if there is none."""
+    if not os.path.exists(path):
+        return []
+    with open(path, newline="", encoding="utf-8") as f:
+        return [row[:2] for row in list(csv.reader(f))[1:] if len(row) >= 2]
+
+
+def write_metadata(path, rows):
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["file_name", "text"])
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+class Exporter(object):
+    """
+    Encodes images into output_dir and collects their metadata rows.
+    With merge, rows of an existing metadata.csv are kept (a re-exported file name replaces its row),
+    otherwise the file is rebuilt from this run's rows. metadata=None writes no CSV; rows then stay
+    available to the caller.
+    """
+
+    def __init__(self, output_dir, fmt="png", compress_level=6, quality=95, workers=None, merge=False,
+                 metadata=METADATA_FILE):
+        self.output_dir = str(output_dir)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.fmt = fmt
+        self.compress_level = compress_level
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.metadata_path = os.path.join(self.output_dir, metadata) if metadata else None
+        # file_name -> caption, in insertion order
+        self.rows = dict(read_metadata(self.metadata_path)) if merge and self.metadata_path else {}
+        self.pending = deque()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def file_name(self, name):
+        return name + EXTENSIONS[self.fmt]
+
+    def path(self, name):
+        return os.path.join(self.output_dir, self.file_name(name))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def add_row(self, name, caption):
+        """Metadata row for an image that is already on disk."""
+        self.rows[self.file_name(name)] = caption
+
+    def add(self, name, img, caption):
+        """Queues img for encoding as <name><ext> and returns the future of its encode time."""
+        if self.pool is None:
+            # spawned, not forked: callers run torch thread pools, loader/writer threads and maybe CUDA
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        # a bounded number of encodes in flight keeps memory flat when the producer is faster
+        while len(self.pending) >= 4 * self.workers:
+            self._collect(self.pending.popleft())
+        future = self.pool.submit(encode_image, to_pixels(img), self.path(name), self.fmt, self.compress_level,
+                                  self.quality)
+        self.pending.append(future)
+        self.add_row(name, caption)
+        return future
+
+    def _collect(self, future):
+        metrics.record(f"{self.fmt}_encode", future.result())
+
+    def flush(self):
+        """Waits for every queued encode, then writes metadata.csv."""
+        while self.pending:
+            self._collect(self.pending.popleft())
+        if self.metadata_path and self.rows:
+            write_metadata(self.metadata_path, list(self.rows.items()))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+def export_records(reader, exporter, skip_existing=False):
+    """Exports every (img, text) record of a dataset_store reader; returns the number of images encoded."""
+    encoded = 0
+    for i in range(len(reader)):
+        filename = reader.name(i)
+        if skip_existing and exporter.exists(filename):
+            if reader.text(i):
+                exporter.add_row(filename, reader.text(i))
+            continue
+        try:
+            # Load the pickled dictionary / shard record
+            with metrics.span("decode", sync_cuda=False):
+                data = reader.load(i)
+
+            # Check if data is a dictionary and has the required keys
+            if not isinstance(data, dict) or 'img' not in data or 'text' not in data:
+                print(f"Skipping {filename}: Pickle is not a dict or missing 'img'/'text' key.")
+                continue
+
+            try:
+                pixels = to_pixels(data['img'])
+            except TypeError as e:
+                print(f"Skipping {filename}: 'img' key contains {e}")
+                continue
+
+            if pixels.size and data['text']:
+                exporter.add(filename, pixels, data['text'])
+                encoded += 1
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+    return encoded
+
+
+def add_arguments(parser, prefix="", sep="_"):
+    """
+    --<prefix>format / compress<sep>level / quality / workers options, spelled with the host script's
+    separator (sep="-" gives --compress-level); exporter_options reads them back.
+    """
+    parser.add_argument(f"--{prefix}format", choices=sorted(EXTENSIONS), default="png",
+                        help="png, lossless webp or jpeg")
+    parser.add_argument(f"--{prefix}compress{sep}level", type=int, default=6, help="PNG zlib level 0-9")
+    parser.add_argument(f"--{prefix}quality", type=int, default=95, help="JPEG quality / WebP effort")
+    parser.add_argument(f"--{prefix}workers", type=int, default=None, help="encoder processes")
+    return parser
+
+
+def exporter_options(args, prefix=""):
+    prefix = prefix.replace("-", "_")
+    return {"fmt": getattr(args, prefix + "format"), "compress_level": getattr(args, prefix + "compress_level"),
+            "quality": getattr(args, prefix + "quality"), "workers": getattr(args, prefix + "workers")}
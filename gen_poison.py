@@ -1,12 +1,23 @@
 import os
-
+import shutil
 import sys
 from PIL import Image
 import glob
 import argparse
 import pickle
+import json
+import queue
+import threading
+import torch
 from torchvision import transforms
-from opt import PoisonGeneration
+import numpy as np
+from opt import PRECISIONS, PoisonGeneration, configure_threads
+from encoder_backends import ENCODER_BACKENDS
+from dataset_store import open_reader, open_writer
+from caching import EmbeddingCache, content_hash
+from run_manifest import RunManifest, fingerprint
+import export
+import metrics
 
 
 def crop_to_square(img):
@@ -20,30 +31,246 @@ def crop_to_square(img):
     return image_transforms(img)
 
 
-def main():
-    poison_generator = PoisonGeneration(target_concept=args.target_name, device="cuda", eps=args.eps)
-    all_data_paths = glob.glob(os.path.join(args.directory, "*.p"))
-    all_imgs = [pickle.load(open(f, "rb"))['img'] for f in all_data_paths]
-    all_texts = [pickle.load(open(f, "rb"))['text'] for f in all_data_paths]
-    all_imgs = [Image.fromarray(img) for img in all_imgs]
+def load_items(reader, indices, out_queue, manifest, params, resumed, unreadable):
+    # prefetch thread: each record is read once and handed over as soon as it is decoded
+    for idx in indices:
+        try:
+            with metrics.span("decode", sync_cuda=False):
+                data = reader.load(idx)
+            fp = fingerprint(content_hash(data['img']), params)
+            if manifest.done(str(idx), "poison", fp):
+                resumed.append(idx)
+                continue
+            out_queue.put((idx, reader.name(idx), Image.fromarray(np.asarray(data['img'])), data['text'], fp))
+        except Exception as e:
+            print(f"Skipping {reader.name(idx)}: {e}")
+            unreadable.append(idx)
+    out_queue.put(None)
 
-    all_result_imgs = poison_generator.generate_all(all_imgs, args.target_name)
-    os.makedirs(args.outdir, exist_ok=True)
 
-    for idx, cur_img in enumerate(all_result_imgs):
-        cur_data = {"text": all_texts[idx], "img": cur_img}
-        pickle.dump(cur_data, open(os.path.join(args.outdir, "{}.p".format(idx)), "wb"))
+def write_items(in_queue, writer, manifest, errors, exporter=None, export_prefix=""):
+    # write-behind thread: results hit the disk while the next batch is being poisoned
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        idx, cur_img, text, fp = item
+        try:
+            with metrics.span("write", sync_cuda=False):
+                # the fingerprint lets poison_launcher tell this copy from one a different worker wrote earlier
+                writer.add(str(idx), cur_img, text, fingerprint=fp)
+            if exporter is not None and text:
+                # handed over in memory; the image is encoded in the exporter's pool
+                exporter.add(export_prefix + str(idx), cur_img, text)
+            # recorded only once written, so a crash never marks an image that is missing from the output
+            manifest.mark(str(idx), "poison", fp)
+        except Exception as e:
+            errors.append(e)
 
 
-def parse_arguments(argv):
-    parser = argparse.ArgumentParser()
+def build_generator(args, device=None):
+    result_cache = None
+    if not args.no_result_cache:
+        result_cache = EmbeddingCache("perturbations", args.cache_dir,
+                                      max_bytes=int(args.result_cache_max_gb * (1 << 30)),
+                                      max_age=args.result_cache_max_days * 24 * 3600)
+    return PoisonGeneration(target_concept=args.target_name, device=device or args.device, eps=args.eps,
+                            cache_dir=args.cache_dir, batch_size=args.batch_size,
+                            lean=not args.full_pipeline, max_iters=args.max_iters,
+                            patience=args.patience, min_rel_improvement=args.min_rel_improvement,
+                            adaptive_step=args.adaptive_step, result_cache=result_cache,
+                            precision=args.precision, channels_last=args.channels_last, compile=args.compile,
+                            target_bank=args.target_bank, target_samples=args.target_samples,
+                            encoder_backend=args.encoder_backend, coarse_iters=args.coarse_iters,
+                            coarse_factor=args.coarse_factor)
+
+
+def poison_records(poison_generator, reader, indices, writer, manifest, args, exporter=None):
+    """
+    Poisons the records of reader listed in indices (any iterable, consumed lazily) into writer, and
+    into exporter as images when one is given.
+    Returns (stats, resumed, unreadable): one stats dict per poisoned record, the indices skipped via the
+    manifest and the indices whose record could not be loaded.
+    Raises the first write error as soon as it is seen, instead of poisoning the remaining records for nothing.
+    """
+    params = poison_generator.params(args.target_name)
+
+    # bounded queues keep peak memory flat regardless of how many pickles are in the directory
+    load_queue = queue.Queue(maxsize=max(args.prefetch, args.batch_size))
+    write_queue = queue.Queue(maxsize=args.write_behind)
+    write_errors = []
+    resumed = []
+    unreadable = []
+    loader = threading.Thread(target=load_items,
+                              args=(reader, indices, load_queue, manifest, params, resumed, unreadable), daemon=True)
+    writer_thread = threading.Thread(target=write_items, args=(write_queue, writer, manifest, write_errors, exporter,
+                                                               args.export_prefix), daemon=True)
+    loader.start()
+    writer_thread.start()
+
+    stats = []
+    batch = []
+    done = False
+    while not done and not write_errors:
+        item = load_queue.get()
+        if item is None:
+            done = True
+        else:
+            batch.append(item)
+        if batch and (done or len(batch) == args.batch_size):
+            cur_imgs = [img if img.mode == 'RGB' else img.convert('RGB') for _, _, img, _, _ in batch]
+            profiled = [idx for idx, _, _, _, _ in batch if idx == args.profile_index]
+            if args.profile_dir and profiled:
+                # one sampled image gets a torch.profiler trace of a few PGD steps
+                trace_path = os.path.join(args.profile_dir, f"trace_{profiled[0]}.json")
+                with metrics.torch_profile(trace_path, args.profile_steps) as prof:
+                    poison_generator.profiler = prof
+                    try:
+                        result_imgs = poison_generator.generate_batch(cur_imgs, args.target_name)
+                    finally:
+                        poison_generator.profiler = None
+            else:
+                result_imgs = poison_generator.generate_batch(cur_imgs, args.target_name)
+            for (idx, name, _, text, fp), cur_img, stat in zip(batch, result_imgs, poison_generator.last_stats):
+                write_queue.put((idx, cur_img, text, fp))
+                stats.append(dict(file=str(idx), source=name, **stat))
+            batch = []
+
+    write_queue.put(None)
+    writer_thread.join()
+    if write_errors:
+        raise write_errors[0]
+    if exporter is not None:
+        # images exported by an earlier run keep their metadata rows
+        for idx in resumed:
+            name = args.export_prefix + str(idx)
+            if exporter.exists(name) and reader.text(idx):
+                exporter.add_row(name, reader.text(idx))
+    return stats, resumed, unreadable
+
+
+def build_exporter(args, metadata=export.METADATA_FILE):
+    if not args.export_dir:
+        return None
+    options = export.exporter_options(args, "export_")
+    # PGD keeps the cores busy, so encoding gets a couple of processes unless told otherwise
+    options["workers"] = options["workers"] or 2
+    return export.Exporter(args.export_dir, merge=True, metadata=metadata, **options)
+
+
+def report(stats, resumed, unreadable, outdir):
+    if resumed:
+        print(f"Skipped {len(resumed)} images already poisoned by an earlier run")
+    if unreadable:
+        print(f"Skipped {len(unreadable)} unreadable records: {', '.join(map(str, sorted(unreadable)))}")
+    # per-image iteration count and final latent loss, to weigh early stopping against attack strength
+    for stat in stats:
+        suffix = " (cached)" if stat.get("cached") else ""
+        if "loss" in stat:
+            print("{file}: {iterations} iterations, final loss {loss:.3f}".format(**stat) + suffix)
+        else:
+            print("{file}: reused cached result".format(**stat))
+    timed = [stat["seconds"] for stat in stats if "seconds" in stat and not stat.get("cached")]
+    if timed:
+        print("Mean latency {:.2f}s per image over {} images".format(sum(timed) / len(timed), len(timed)))
+    with open(os.path.join(outdir, "poison_stats.json"), "w") as f:
+        json.dump(stats, f, indent=4)
+
+
+def main():
+    metrics.configure(args.metrics)
+    configure_threads(args.threads, args.interop_threads)
+    poison_generator = build_generator(args)
+    reader = open_reader(args.directory)
+    if args.force:
+        shutil.rmtree(args.outdir, ignore_errors=True)
+    os.makedirs(args.outdir, exist_ok=True)
+    # images already written by an interrupted run with the same settings are skipped
+    manifest = RunManifest(os.path.join(args.outdir, "run_manifest.jsonl"))
+    exporter = build_exporter(args)
+    try:
+        with open_writer(args.outdir, args.format) as writer:
+            stats, resumed, unreadable = poison_records(poison_generator, reader, range(len(reader)), writer,
+                                                        manifest, args, exporter)
+    finally:
+        if exporter is not None:
+            exporter.close()
+    report(stats, resumed, unreadable, args.outdir)
+
+
+def add_arguments(parser):
     parser.add_argument('-d', '--directory', type=str,
                         help="", default='')
     parser.add_argument('-od', '--outdir', type=str,
                         help="", default='')
     parser.add_argument('-e', '--eps', type=float, default=0.04)
     parser.add_argument('-t', '--target_name', type=str, default="cat")
-    return parser.parse_args(argv)
+    parser.add_argument('-b', '--batch_size', type=int, default=1,
+                        help="number of images optimized together in one PGD forward/backward pass")
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--max_iters', type=int, default=500)
+    parser.add_argument('--patience', type=int, default=None,
+                        help="stop an image after this many steps without relative improvement (default: never)")
+    parser.add_argument('--min_rel_improvement', type=float, default=1e-3)
+    parser.add_argument('--adaptive_step', action='store_true',
+                        help="halve the step size on loss plateaus instead of decaying it linearly")
+    parser.add_argument('--coarse_iters', type=int, default=0,
+                        help="run the first N PGD steps at resolution / --coarse_factor, then refine at full size")
+    parser.add_argument('--coarse_factor', type=int, default=2)
+    parser.add_argument('--format', choices=["pickle", "shard"], default="pickle",
+                        help="output format; the input format is detected")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="max decoded inputs waiting to be poisoned")
+    parser.add_argument('--write_behind', type=int, default=8,
+                        help="max poisoned outputs waiting to be written")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="where target latents and poisoned results are cached (default: $NIGHTSHADE_CACHE_DIR or ~/.cache/nightshade)")
+    parser.add_argument('--no_result_cache', action='store_true',
+                        help="always re-poison instead of reusing results for identical (image, target, eps, model) jobs")
+    parser.add_argument('--result_cache_max_gb', type=float, default=20.0)
+    parser.add_argument('--result_cache_max_days', type=float, default=30.0)
+    parser.add_argument('--force', action='store_true',
+                        help="clear outdir and re-poison everything instead of resuming")
+    parser.add_argument('--precision', choices=PRECISIONS, default="auto",
+                        help="auto = fp16 on GPU, fp32 on CPU; bf16 runs the encoder under bf16 autocast")
+    parser.add_argument('--channels_last', dest='channels_last', action='store_true', default=None,
+                        help="NHWC layout for the VAE encoder (default: on for CPU)")
+    parser.add_argument('--no_channels_last', dest='channels_last', action='store_false')
+    parser.add_argument('--compile', action='store_true',
+                        help="torch.compile the encode + loss step (slow first batch, faster afterwards)")
+    parser.add_argument('--encoder_backend', choices=ENCODER_BACKENDS, default="eager",
+                        help="VAE encode implementation; benchmarks/run_benchmarks.py --stages encoder compares them")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    parser.add_argument('--interop_threads', type=int, default=None, help="torch inter-op threads")
+    parser.add_argument('--metrics', type=str, default=None,
+                        help="record stage/PGD-step timings and peak memory: *.prom for a Prometheus textfile, else JSON lines")
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help="write a torch.profiler Chrome trace of the record --profile_index here")
+    parser.add_argument('--profile_index', type=int, default=0, help="record index to profile")
+    parser.add_argument('--profile_steps', type=int, default=5, help="PGD steps captured in the trace")
+    parser.add_argument('--full_pipeline', action='store_true',
+                        help="always load the full SD pipeline instead of only the VAE encoder")
+    parser.add_argument('--target_bank', type=str, default=None,
+                        help="take target latents from this bank (see target_bank.py) instead of sampling with SD")
+    parser.add_argument('--target_samples', type=int, default=1,
+                        help="with --target_bank, spread images over this many target samples of the concept")
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help="also write every poisoned image (<export_prefix><idx>.png) and metadata.csv here, "
+                             "straight from memory instead of through Extract_Data.py")
+    parser.add_argument('--export_prefix', type=str, default="", help="file name prefix of exported images")
+    export.add_arguments(parser, "export_")
+    return parser
+
+
+def check_arguments(parser, args):
+    if args.compile and args.encoder_backend != "eager":
+        parser.error("--compile only applies to --encoder_backend eager; use --encoder_backend compile on its own")
+    return args
+
+
+def parse_arguments(argv):
+    parser = add_arguments(argparse.ArgumentParser())
+    return check_arguments(parser, parser.parse_args(argv))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+"""
+Wall-time and peak-memory instrumentation with a structured sink, so the real bottleneck can be
+read off production runs instead of guessed from logs.
+
+Code marks spans of work,
+
+    with metrics.span("decode"):
+        img = reader.load(idx)
+
+and nothing is recorded until a process calls configure(path), or configure() with
+$NIGHTSHADE_METRICS set. The sink is picked from the path:
+
+- *.prom   a Prometheus textfile (for node_exporter's textfile collector) with per-span count,
+           total/max seconds and peak memory, rewritten atomically every few seconds and at exit;
+           give every process its own file (see worker_path)
+- anything else   JSON lines, one object per event: {"name", "seconds", "time", labels..., fields...}
+
+Peak memory is reported where available: cuda_peak_mb (torch.cuda.max_memory_allocated, reset at
+the start of every outermost span) and rss_peak_mb (the process high-water mark from getrusage).
+On CUDA a span synchronizes the device at both ends so it measures the kernels, not their launch;
+that sync only happens while a sink is configured, and host-only spans opt out of it.
+
+torch_profile() wraps torch.profiler for a sampled image and writes a Chrome trace; spans show up
+in it as record_function ranges.
+
+Span names used across the repo: model_load, decode, target_generation, pgd.step (fields forward,
+backward, update), write, caption, clip_score, poison, png_encode, s3.download, s3.upload.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+PROM_PREFIX = "nightshade"
+PROM_INTERVAL = 10.0
+
+_sink = None
+_local = threading.local()
+
+
+def _torch():
+    # only touch torch if the process already uses it, so the S3 tools stay torch-free
+    return sys.modules.get("torch")
+
+
+def _cuda():
+    torch = _torch()
+    return torch if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized() else None
+
+
+def rss_peak_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class MetricsSink(object):
+    def __init__(self, path, labels=None):
+        self.path = str(path)
+        self.prometheus = self.path.endswith(".prom")
+        self.labels = dict(labels or {})
+        self.totals = defaultdict(lambda: {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_mb": 0.0})
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = None if self.prometheus else open(self.path, "a", encoding="utf-8")
+
+    def record(self, name, seconds, **fields):
+        event = dict(self.labels, name=name, seconds=seconds, time=time.time(), **fields)
+        with self._lock:
+            total = self.totals[name]
+            total["count"] += 1
+            total["seconds"] += seconds
+            total["max_seconds"] = max(total["max_seconds"], seconds)
+            peak = max(fields.get("cuda_peak_mb") or 0.0, fields.get("rss_peak_mb") or 0.0)
+            total["peak_mb"] = max(total["peak_mb"], peak)
+            if self._file is not None:
+                self._file.write(json.dumps(event, default=str) + "\n")
+                self._file.flush()
+            elif time.time() - self._last_flush > PROM_INTERVAL:
+                self._write_prometheus()
+
+    def _write_prometheus(self):
+        labels = "".join(',{}="{}"'.format(k, v) for k, v in sorted(self.labels.items()))
+        lines = []
+        for metric, key, kind in (("span_calls_total", "count", "counter"), ("span_seconds_total", "seconds", "counter"),
+                                  ("span_seconds_max", "max_seconds", "gauge"), ("span_peak_mb", "peak_mb", "gauge")):
+            lines.append("# TYPE {}_{} {}".format(PROM_PREFIX, metric, kind))
+            for name, total in sorted(self.totals.items()):
+                lines.append('{}_{}{{span="{}"{}}} {}'.format(PROM_PREFIX, metric, name, labels, total[key]))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+        self._last_flush = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            elif self.prometheus:
+                self._write_prometheus()
+
+
+def configure(path=None, labels=None):
+    """
+    Starts recording to path, or $NIGHTSHADE_METRICS when path is None; with neither set nothing is
+    recorded. labels (plus the script name) are added to every event.
+    """
+    global _sink
+    if _sink is not None:
+        _sink.close()
+    path = path or os.environ.get("NIGHTSHADE_METRICS")
+    labels = dict({"script": os.path.basename(sys.argv[0])}, **(labels or {}))
+    _sink = MetricsSink(path, labels) if path else None
+    return _sink
+
+
+def worker_path(path, rank):
+    """Per-process variant of a metrics path (or $NIGHTSHADE_METRICS): metrics.prom -> metrics.worker3.prom."""
+    path = path or os.environ.get("NIGHTSHADE_METRICS")
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}.worker{}{}".format(root, rank, ext)
+
+
+def enabled():
+    return _sink is not None
+
+
+def record(name, seconds, **fields):
+    if _sink is not None:
+        _sink.record(name, seconds, **fields)
+
+
+@contextmanager
+def span(name, sync_cuda=True, **fields):
+    """
+    Times the block and records it with fields; a no-op unless a sink is configured.
+    sync_cuda=False is for host-only work (I/O, decode) that should not wait on the GPU.
+    """
+    if _sink is None:
+        yield
+        return
+    torch = _torch()
+    cuda = _cuda() if sync_cuda else None
+    depth = getattr(_local, "depth", 0)
+    if cuda is not None:
+        cuda.cuda.synchronize()
+        if depth == 0:
+            cuda.cuda.reset_peak_memory_stats()
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        if torch is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+    finally:
+        if cuda is not None:
+            cuda.cuda.synchronize()
+            fields["cuda_peak_mb"] = cuda.cuda.max_memory_allocated() / (1 << 20)
+        seconds = time.perf_counter() - start
+        _local.depth = depth
+        fields["rss_peak_mb"] = rss_peak_mb()
+        _sink.record(name, seconds, **fields)
+
+
+class StepTimer(object):
+    """
+    Splits a loop iteration into named phases without a context manager per phase:
+    call lap("forward"), lap("backward"), ... after each one, then done(**fields) records one event
+    with the total time and every phase's seconds as fields.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.active = _sink is not None
+        self.cuda = _cuda() if self.active else None
+        self.phases = {}
+        if self.active:
+            self._sync()
+            self.start = self.last = time.perf_counter()
+
+    def _sync(self):
+        if self.cuda is not None:
+            self.cuda.cuda.synchronize()
+
+    def lap(self, phase):
+        if self.active:
+            self._sync()
+            now = time.perf_counter()
+            self.phases[phase] = now - self.last
+            self.last = now
+
+    def done(self, **fields):
+        if self.active:
+            record(self.name, self.last - self.start, **dict(self.phases, **fields))
+
+
+@contextmanager
+def torch_profile(trace_path, active_steps=5):
+    """
+    torch.profiler over a block; the caller calls prof.step() once per PGD iteration, and the
+    trace of active_steps iterations (after one skipped and one warm-up step) is written to
+    trace_path in Chrome trace format (open it in chrome://tracing or Perfetto).
+    """
+    import torch
+    from torch.profiler import ProfilerActivity, profile, schedule
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    if os.path.dirname(trace_path):
+        os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+
+    def export(prof):
+        prof.export_chrome_trace(trace_path)
+        print(f"Wrote torch profiler trace to {trace_path}")
+
+    with profile(activities=activities, schedule=schedule(wait=1, warmup=1, active=active_steps, repeat=1),
+                 on_trace_ready=export, record_shapes=True, profile_memory=True) as prof:
+        yield prof
+
+
+@atexit.register
+def _close():
+    if _sink is not None:
+        _sink.close()
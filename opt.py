@@ -1,119 +1,477 @@
 import os
-from diffusers import StableDiffusionPipeline
+import re
+import time
+from diffusers import AutoencoderKL, StableDiffusionPipeline
+from huggingface_hub.constants import HF_HUB_CACHE
 import torch
 import numpy as np
 import torch.utils.data
-from einops import rearrange
 from PIL import Image
 from torchvision import transforms
+from caching import EmbeddingCache, TargetLatentCache, content_hash, make_key
+from target_bank import TargetBank
+from encoder_backends import make_encoder
+import metrics
+
+MODEL_ID = "sd-legacy/stable-diffusion-v1-5"
+MODEL_REVISION = "main"
+TARGET_SEED = 123
+TARGET_GUIDANCE_SCALE = 7.5
+TARGET_NUM_INFERENCE_STEPS = 50
+TARGET_RESOLUTION = 512
+PRECISIONS = ("auto", "fp32", "bf16", "fp16")
+
+
+def resolve_revision(model_id=MODEL_ID, revision=MODEL_REVISION):
+    """
+    Commit hash the branch or tag `revision` of model_id points at in the local hub cache, which
+    from_pretrained refreshes on every online load. Cache keys use it, so weights pushed to the branch
+    later never reuse latents or results of the old ones. Falls back to revision if it was never downloaded.
+    """
+    if re.fullmatch(r"[0-9a-f]{40}", revision):
+        return revision
+    ref_path = os.path.join(HF_HUB_CACHE, "models--" + model_id.replace("/", "--"), "refs", revision)
+    try:
+        with open(ref_path, encoding="utf-8") as f:
+            return f.read().strip() or revision
+    except OSError:
+        return revision
+
+
+def resolve_precision(precision, device):
+    """The precision "auto" stands for on device: fp16 convolutions are only practical on GPU."""
+    if precision == "auto":
+        return "fp16" if str(device).startswith("cuda") else "fp32"
+    return precision
+
+
+def configure_threads(intra_op=None, inter_op=None):
+    """Sets torch's intra-op/inter-op thread pools; None leaves the torch default."""
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # only allowed before the first parallel op of the process
+            print(f"Could not set inter-op threads: {e}")
 
 
 class PoisonGeneration(object):
-    def __init__(self, target_concept, device, eps=0.05):
+    def __init__(self, target_concept, device, eps=0.05, cache_dir=None, batch_size=1, lean=True,
+                 max_iters=500, patience=None, min_rel_improvement=1e-3, adaptive_step=False, step_patience=10,
+                 result_cache=None, precision="auto", channels_last=None, compile=False, vae=None,
+                 resolution=512, target_bank=None, target_samples=1, encoder_backend="eager", coarse_iters=0,
+                 coarse_factor=2):
+        if compile and encoder_backend != "eager":
+            # --compile already wraps the encode (with the loss) in torch.compile; on top of a compiled or
+            # traced encoder it only adds another compile of the same graph
+            raise ValueError(f"compile=True is only supported with the eager encoder backend, not "
+                             f"{encoder_backend!r}; use encoder_backend='compile' alone instead")
         self.eps = eps
         self.target_concept = target_concept
         self.device = device
-        self.full_sd_model = self.load_model()
+        on_gpu = str(device).startswith("cuda")
+        # CPUs run fp32 weights, optionally under bf16 autocast
+        precision = resolve_precision(precision, device)
+        self.precision = precision
+        self.dtype = torch.float16 if precision == "fp16" else torch.float32
+        self.autocast_dtype = torch.bfloat16 if precision == "bf16" else None
+        # NHWC convolutions are markedly faster with the oneDNN CPU kernels
+        self.channels_last = (not on_gpu) if channels_last is None else channels_last
+        self.resolution = resolution
+        self.batch_size = batch_size
+        # PGD schedule: patience=None keeps the fixed-length linear decay
+        self.max_iters = max_iters
+        self.patience = patience
+        self.min_rel_improvement = min_rel_improvement
+        self.adaptive_step = adaptive_step
+        self.step_patience = step_patience
+        # coarse-to-fine: the first coarse_iters steps optimize a modifier at resolution / coarse_factor
+        self.coarse_iters = coarse_iters
+        self.coarse_factor = coarse_factor
+        self.last_stats = []
+        self.target_cache = TargetLatentCache(cache_dir)
+        # precomputed targets (see target_bank.py); each image is pulled towards one of target_samples samples
+        self.target_bank = TargetBank(target_bank) if isinstance(target_bank, (str, os.PathLike)) else target_bank
+        self.target_samples = target_samples
+        self._bank_latents = {}
+        # optional EmbeddingCache of finished uint8 outputs keyed by source pixels + attack parameters
+        self.result_cache = result_cache
+        self.lean = lean
+        self._full_sd_model = None
+        # torch.profiler handle stepped once per PGD iteration while a sampled image is traced
+        self.profiler = None
+        # an injected encoder (e.g. a tiny stand-in for benchmarks) skips all model loading
+        if vae is not None:
+            self.vae = vae.to(self.device, self.dtype)
+        else:
+            with metrics.span("model_load", model=MODEL_ID, device=str(device)):
+                self.vae = self.load_model()
+        # read once the weights are loaded, i.e. after from_pretrained has resolved the branch
+        self.revision = MODEL_REVISION if vae is not None else resolve_revision()
+        if self.channels_last:
+            self.vae = self.vae.to(memory_format=torch.channels_last)
+        # eager / compile / torchscript implementation of the encode, see encoder_backends.py
+        self.encoder_backend = encoder_backend
+        self.encoder = make_encoder(encoder_backend, self.vae, self.device, self.autocast_dtype)
+        # compiling fuses the encode + latent distance; its backward is compiled along with it
+        self.compile = compile
+        self.latent_loss = torch.compile(self._latent_loss) if compile else self._latent_loss
         self.transform = self.resizer()
 
     def resizer(self):
         image_transforms = transforms.Compose(
             [
-                transforms.Resize(512, interpolation=transforms.InterpolationMode.BILINEAR),
-                transforms.CenterCrop(512),
+                transforms.Resize(self.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+                transforms.CenterCrop(self.resolution),
             ]
         )
         return image_transforms
 
     def load_model(self):
+        # PGD only ever calls vae.encode, so skip the UNet/text encoder when the target is already cached
+        if self.lean and self.has_target(self.target_concept):
+            return self.load_vae_encoder()
+        vae = self.full_sd_model.vae
+        vae.requires_grad_(False)
+        return vae
+
+    def load_pipeline(self):
         # the old one is deprecated -- need to update from  "stabilityai/stable-diffusion-2-1"
         pipeline = StableDiffusionPipeline.from_pretrained(
-            "sd-legacy/stable-diffusion-v1-5",
+            MODEL_ID,
+            revision=MODEL_REVISION,
             safety_checker=None,
             # revision="fp16", # doesnt work for old stable diffusion
-            torch_dtype=torch.float16,
+            torch_dtype=self.dtype,
         )
         pipeline = pipeline.to(self.device)
         return pipeline
 
+    def load_vae_encoder(self):
+        vae = AutoencoderKL.from_pretrained(MODEL_ID, subfolder="vae", revision=MODEL_REVISION, torch_dtype=self.dtype)
+        # the decoder half is never used for poisoning
+        vae.decoder = None
+        vae.post_quant_conv = None
+        vae.requires_grad_(False)
+        vae.eval()
+        return vae.to(self.device)
+
+    @property
+    def full_sd_model(self):
+        # only needed to sample a target that is not cached yet
+        if self._full_sd_model is None:
+            self._full_sd_model = self.load_pipeline()
+        return self._full_sd_model
+
+    def release_pipeline(self):
+        self._full_sd_model = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
     def generate_target(self, prompts):
-        torch.manual_seed(123)  # ensuring the target image is consistent across poison set
+        torch.manual_seed(TARGET_SEED)  # ensuring the target image is consistent across poison set
         with torch.no_grad():
-            target_imgs = self.full_sd_model(prompts, guidance_scale=7.5, num_inference_steps=50,
-                                             height=512, width=512).images
-        target_imgs[0].save("target.png")
+            target_imgs = self.full_sd_model(prompts, guidance_scale=TARGET_GUIDANCE_SCALE,
+                                             num_inference_steps=TARGET_NUM_INFERENCE_STEPS,
+                                             height=TARGET_RESOLUTION, width=TARGET_RESOLUTION).images
+        # the image is kept next to the cached latent (TargetLatentCache.put), not in the working directory
         return target_imgs[0]
 
+    @staticmethod
+    def target_key(target_concept, precision="fp32"):
+        # precision as resolved by resolve_precision: an fp16 GPU target is not an fp32 / bf16 CPU one
+        return TargetLatentCache.key(MODEL_ID, resolve_revision(), precision, "A photo of a {}".format(target_concept),
+                                     TARGET_SEED, TARGET_GUIDANCE_SCALE, TARGET_NUM_INFERENCE_STEPS,
+                                     TARGET_RESOLUTION, TARGET_RESOLUTION)
+
+    def has_target(self, target_concept):
+        if self.target_bank is not None:
+            return self.target_bank.contains(target_concept, self.target_samples)
+        return self.target_cache.contains(self.target_key(target_concept, self.precision))
+
+    def get_target_latent(self, target_concept):
+        """(1, 4, 64, 64) target latent, or (target_samples, 4, 64, 64) when a target bank is used."""
+        if self.target_bank is not None:
+            # a bank never falls back to sampling with the UNet; a missing concept raises KeyError
+            if target_concept not in self._bank_latents:
+                self._bank_latents[target_concept] = self.target_bank.get(target_concept, self.target_samples,
+                                                                           self.device, self.dtype)
+            return self._bank_latents[target_concept]
+        # the target only depends on the prompt and the fixed sampling settings, so generate it once
+        key = self.target_key(target_concept, self.precision)
+        target_latent = self.target_cache.get(key, device=self.device)
+        if target_latent is not None:
+            return target_latent.to(self.dtype)
+
+        with metrics.span("target_generation", target=target_concept):
+            target_image = self.generate_target("A photo of a {}".format(target_concept))
+            target_tensor = images2tensor([target_image], TARGET_RESOLUTION, self.device, self.dtype)
+            with torch.no_grad():
+                target_latent = self.get_latent(target_tensor)
+        self.target_cache.put(key, target_latent, image=target_image)
+        if self.lean:
+            # self.vae keeps the pipeline's VAE alive; the UNet and text encoder can go
+            self.release_pipeline()
+        return target_latent
+
     def get_latent(self, tensor):
-        latent_features = self.full_sd_model.vae.encode(tensor).latent_dist.mean
-        return latent_features
+        if self.channels_last:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        return self.encoder(tensor)
+
+    def _latent_loss(self, modifier, source, target_latent):
+        adv_tensor = torch.clamp(modifier + source, -1, 1)
+        adv_latent = self.get_latent(adv_tensor)
+        if target_latent.shape[-2:] != adv_latent.shape[-2:]:
+            # targets are cached at TARGET_RESOLUTION; other working resolutions compare against an area-resized copy
+            target_latent = torch.nn.functional.interpolate(target_latent, size=adv_latent.shape[-2:], mode="area")
+        # per-sample norm; summing them keeps each sample's gradient independent of the others
+        return (adv_latent - target_latent).flatten(1).norm(dim=1)
 
     def generate_one(self, pil_image, target_concept):
+        return self.generate_batch([pil_image], target_concept)[0]
 
-        resized_pil_image = self.transform(pil_image)
-        source_tensor = img2tensor(resized_pil_image).to(self.device)
+    def params(self, target_concept):
+        """Every setting that changes the poisoned pixels, for cache keys and run manifests."""
+        if self.target_bank is not None:
+            target = self.target_bank.key(target_concept, self.target_samples)
+        else:
+            target = self.target_key(target_concept, self.precision)
+        params = dict(revision=self.revision, target=target, eps=self.eps,
+                      dtype=str(self.dtype), max_iters=self.max_iters, patience=self.patience,
+                      min_rel_improvement=self.min_rel_improvement, adaptive_step=self.adaptive_step,
+                      step_patience=self.step_patience,
+                      # compiled and traced kernels may fuse or reorder float math (bf16 compile differs from
+                      # eager by ~1-2%), so results of one never stand in for another
+                      compile=self.compile, encoder=self.encoder_backend)
+        if self.autocast_dtype is not None:
+            params["autocast"] = str(self.autocast_dtype)
+        if self.resolution != 512:
+            params["resolution"] = self.resolution
+        if self.coarse_iters:
+            params["coarse_iters"] = self.coarse_iters
+            params["coarse_factor"] = self.coarse_factor
+        if self.target_bank is not None:
+            params["target_samples"] = self.target_samples
+        return params
 
-        target_image = self.generate_target("A photo of a {}".format(target_concept))
-        target_tensor = img2tensor(target_image).to(self.device)
+    def target_index(self, resized_pil_image, num_targets):
+        # chosen by content, so an image gets the same target in any batch, run or worker
+        return int(content_hash(resized_pil_image)[:8], 16) % num_targets
 
-        target_tensor = target_tensor.half()
-        source_tensor = source_tensor.half()
+    def result_key(self, resized_pil_image, target_concept):
+        return EmbeddingCache.key(content_hash(resized_pil_image), MODEL_ID, **self.params(target_concept))
 
-        with torch.no_grad():
-            target_latent = self.get_latent(target_tensor)
+    def generate_batch(self, pil_images, target_concept):
+        resized = [self.transform(img) for img in pil_images]
+        results = [None] * len(resized)
+        stats = [None] * len(resized)
+
+        keys = []
+        if self.result_cache is not None:
+            keys = [self.result_key(img, target_concept) for img in resized]
+            for i, key in enumerate(keys):
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    results[i] = Image.fromarray(cached)
+                    stats[i] = dict(self.result_cache.get(make_key(key, "stats")) or {}, cached=True)
 
+        misses = [i for i, res in enumerate(results) if res is None]
+        if misses:
+            source_tensor = images2tensor([resized[i] for i in misses], self.resolution, self.device, self.dtype,
+                                          self.channels_last)
+
+            target_latent = self.get_target_latent(target_concept)
+            target_samples = None
+            if len(target_latent) > 1:
+                target_samples = [self.target_index(resized[i], len(target_latent)) for i in misses]
+                target_latent = target_latent[target_samples]
+
+            start = time.perf_counter()
+            modifier = self.optimize(source_tensor, target_latent)
+            # wall time of the batch split evenly, i.e. the per-image latency at this batch size
+            seconds = (time.perf_counter() - start) / len(misses)
+            for j, stat in enumerate(self.last_stats):
+                stat["seconds"] = seconds
+                if target_samples is not None:
+                    stat["target_sample"] = target_samples[j]
+
+            final_adv_batch = torch.clamp(modifier + source_tensor, -1.0, 1.0)
+            for j, (i, img) in enumerate(zip(misses, tensor2images(final_adv_batch))):
+                results[i] = img
+                stats[i] = self.last_stats[j]
+                if self.result_cache is not None:
+                    self.result_cache.put(keys[i], np.asarray(results[i]))
+                    self.result_cache.put(make_key(keys[i], "stats"), stats[i])
+
+        self.last_stats = stats
+        return results
+
+    def optimize(self, source_tensor, target_latent):
+        """
+        Sign-gradient PGD over a stack of source tensors (N, 3, resolution, resolution) towards
+        target_latent, either one latent shared by the batch or one per source (N, 4, h, w).
+        Each sample gets its own latent loss, so the step taken for one image never depends on another.
+        With patience set, a sample stops once its loss has not improved by min_rel_improvement for
+        patience steps; converged samples are dropped from the batch. Per-sample iteration counts and
+        final losses are left in self.last_stats.
+        With coarse_iters, the first steps run on an area-downsampled source through the same encoder, which
+        costs about 1 / coarse_factor**2 of a full step; the modifier is then upsampled and refined at full
+        resolution for at least the last step. Early stopping only applies to the full-resolution steps.
+        """
+        full_source = source_tensor
+        # at least the last step runs at full resolution
+        coarse_iters = max(0, min(self.coarse_iters, self.max_iters - 1))
+        if coarse_iters:
+            size = [side // self.coarse_factor for side in full_source.shape[-2:]]
+            source_tensor = torch.nn.functional.interpolate(full_source, size=size, mode="area")
         modifier = torch.clone(source_tensor) * 0.0
+        n = len(source_tensor)
 
-        t_size = 500
+        t_size = self.max_iters
         max_change = self.eps / 0.5  # scale from 0,1 to -1,1
         step_size = max_change
 
-        for i in range(t_size):
-            actual_step_size = step_size - (step_size - step_size / 100) / t_size * i
-            modifier.requires_grad_(True)
+        # per-sample bookkeeping stays on the device so the default path never syncs
+        best_loss = torch.full((n,), float("inf"), device=source_tensor.device)
+        stale = torch.zeros(n, dtype=torch.long, device=source_tensor.device)
+        sample_step = torch.full((n,), step_size, device=source_tensor.device)
+        iterations = torch.zeros(n, dtype=torch.long, device=source_tensor.device)
+        final_loss = torch.zeros(n, device=source_tensor.device)
+        active = torch.arange(n, device=source_tensor.device)
 
-            adv_tensor = torch.clamp(modifier + source_tensor, -1, 1)
-            adv_latent = self.get_latent(adv_tensor)
+        for i in range(t_size):
+            if i == coarse_iters and source_tensor is not full_source:
+                modifier = self.upsample_modifier(modifier, full_source, max_change)
+                source_tensor = full_source
+                # losses at the two resolutions are not comparable
+                best_loss.fill_(float("inf"))
+                stale.zero_()
+            timer = metrics.StepTimer("pgd.step")
+            if len(active) < n:
+                cur_source, cur_modifier = source_tensor[active], modifier[active]
+                cur_target = target_latent[active] if len(target_latent) == n and n > 1 else target_latent
+            else:
+                cur_source, cur_modifier, cur_target = source_tensor, modifier, target_latent
+            cur_modifier.requires_grad_(True)
 
-            loss = (adv_latent - target_latent).norm()
+            loss = self.latent_loss(cur_modifier, cur_source, cur_target)
+            timer.lap("forward")
 
             tot_loss = loss.sum()
-            grad = torch.autograd.grad(tot_loss, modifier)[0]
+            grad = torch.autograd.grad(tot_loss, cur_modifier)[0]
+            timer.lap("backward")
+
+            if self.adaptive_step:
+                actual_step_size = sample_step[active].view(-1, 1, 1, 1).to(grad.dtype)
+            else:
+                actual_step_size = step_size - (step_size - step_size / 100) / t_size * i
+
+            cur_modifier = cur_modifier - torch.sign(grad) * actual_step_size
+            cur_modifier = torch.clamp(cur_modifier, -max_change, max_change)
+            cur_modifier = cur_modifier.detach()
+            if len(active) < n:
+                modifier[active] = cur_modifier
+            else:
+                modifier = cur_modifier
+            timer.lap("update")
+            timer.done(step=i, batch=len(active))
+            if self.profiler is not None:
+                self.profiler.step()
 
-            modifier = modifier - torch.sign(grad) * actual_step_size
-            modifier = torch.clamp(modifier, -max_change, max_change)
-            modifier = modifier.detach()
+            loss = loss.detach().float()
+            iterations[active] = i + 1
+            final_loss[active] = loss
+            improved = loss < best_loss[active] * (1 - self.min_rel_improvement)
+            best_loss[active] = torch.where(improved, loss, best_loss[active])
+            stale[active] = torch.where(improved, torch.zeros_like(stale[active]), stale[active] + 1)
+
+            if self.adaptive_step:
+                # reduce-on-plateau: halve a sample's step every step_patience steps without improvement
+                plateau = (stale[active] > 0) & (stale[active] % self.step_patience == 0)
+                sample_step[active] = torch.where(plateau, (sample_step[active] / 2).clamp(min=step_size / 100),
+                                                  sample_step[active])
 
             if i % 50 == 0:
                 print("# Iter: {}\tLoss: {:.3f}".format(i, loss.mean().item()))
 
-        final_adv_batch = torch.clamp(modifier + source_tensor, -1.0, 1.0)
-        final_img = tensor2img(final_adv_batch)
-        return final_img
+            if self.patience is not None and i >= coarse_iters:
+                active = active[stale[active] < self.patience]
+                if len(active) == 0:
+                    break
+
+        self.last_stats = [{"iterations": int(it), "loss": float(l)}
+                           for it, l in zip(iterations.tolist(), final_loss.tolist())]
+        return modifier
 
-    def generate_all(self, image_paths, target_concept):
+    @staticmethod
+    def upsample_modifier(modifier, full_source, max_change):
+        # bilinear weights are convex, so the bound already holds up to rounding; the clamp makes it exact
+        modifier = torch.nn.functional.interpolate(modifier, size=full_source.shape[-2:], mode="bilinear",
+                                                   align_corners=False)
+        return torch.clamp(modifier, -max_change, max_change).to(full_source.dtype)
+
+    def generate_all(self, image_paths, target_concept, batch_size=None):
+        # last_stats covers every image of the call, like after generate_batch; nothing is kept across calls
+        batch_size = batch_size or self.batch_size
         res_imgs = []
-        for idx, image_f in enumerate(image_paths):
-            cur_img = image_f.convert('RGB')
-            perturbed_img = self.generate_one(cur_img, target_concept)
-            res_imgs.append(perturbed_img)
+        stats = []
+        for start in range(0, len(image_paths), batch_size):
+            cur_imgs = [img if img.mode == 'RGB' else img.convert('RGB')
+                        for img in image_paths[start:start + batch_size]]
+            res_imgs.extend(self.generate_batch(cur_imgs, target_concept))
+            stats.extend(self.last_stats)
+        self.last_stats = stats
         return res_imgs
 
 
-def img2tensor(cur_img):
-    cur_img = cur_img.resize((512, 512), resample=Image.Resampling.BICUBIC)
-    cur_img = np.array(cur_img)
-    img = (cur_img / 127.5 - 1.0).astype(np.float32)
-    img = rearrange(img, 'h w c -> c h w')
-    img = torch.tensor(img).unsqueeze(0)
-    return img
+def images2tensor(images, size=512, device="cpu", dtype=torch.float32, channels_last=False):
+    """
+    (N, 3, size, size) tensor in [-1, 1] from PIL images or HWC uint8 arrays. Images that are
+    already size x size are not resized again. The batch crosses to the device as uint8 (from
+    pinned memory, without blocking, on CUDA) and is converted there in one pass, with no float64
+    intermediate on the host. Stacking in HWC makes the result channels_last for free.
+    """
+    arrays = []
+    for img in images:
+        if not isinstance(img, Image.Image):
+            img = np.asarray(img)
+            if img.shape[:2] == (size, size) and img.dtype == np.uint8:
+                arrays.append(img)
+                continue
+            img = Image.fromarray(img.astype(np.uint8))
+        if img.size != (size, size):
+            img = img.resize((size, size), resample=Image.Resampling.BICUBIC)
+        arrays.append(np.asarray(img.convert("RGB") if img.mode != "RGB" else img))
+    batch = torch.from_numpy(np.stack(arrays))
+    if torch.device(device).type == "cuda":
+        batch = batch.pin_memory().to(device, non_blocking=True)
+    batch = batch.permute(0, 3, 1, 2).float().div_(127.5).sub_(1.0).to(dtype)
+    return batch if channels_last else batch.contiguous()
+
+
+def tensor2images(batch):
+    """PIL images from an (N, 3, H, W) tensor in [-1, 1]; quantized on the device, one host copy for the batch."""
+    # same arithmetic as before (clamp((x + 1) / 2) * 255, truncated like astype(np.uint8)), but in place
+    batch = batch.detach().float().add(1.0).div_(2.0).clamp_(0.0, 1.0).mul_(255.)
+    batch = batch.permute(0, 2, 3, 1).to(torch.uint8)
+    if batch.is_cuda:
+        batch = batch.contiguous()
+        host = torch.empty(batch.shape, dtype=torch.uint8, pin_memory=True)
+        host.copy_(batch, non_blocking=True)
+        torch.cuda.current_stream(batch.device).synchronize()
+        batch = host
+    arrays = batch.numpy()
+    return [Image.fromarray(arr) for arr in arrays]
+
+
+def img2tensor(cur_img, size=512):
+    return images2tensor([cur_img], size)
 
 
 def tensor2img(cur_img):
-    if len(cur_img) == 512:
+    if cur_img.dim() == 3:
         cur_img = cur_img.unsqueeze(0)
-
-    cur_img = torch.clamp((cur_img.detach() + 1.0) / 2.0, min=0.0, max=1.0)
-    cur_img = 255. * rearrange(cur_img[0], 'c h w -> h w c').cpu().numpy()
-    cur_img = Image.fromarray(cur_img.astype(np.uint8))
-    return cur_img
+    return tensor2images(cur_img[:1])[0]
@@ -0,0 +1,222 @@
+"""
+Data-parallel gen_poison.py: N worker processes, each with its own device and torch thread count,
+pull chunks of record indices from one shared queue until the directory is done.
+
+Every worker writes into its own store (outdir/workers/worker_<k> for --format shard, or straight
+into outdir for pickles). Records keep gen_poison.py's names (the input index), and the shard
+index of outdir is rebuilt in index order from the worker stores without copying pixels, so the
+output matches a single-process run whatever the number of workers.
+
+On CPU-only boxes --pin_cores gives each worker its own contiguous block of cores.
+
+Usage:
+    python poison_launcher.py -d SELECTED -od POISONED -t tiger --devices cuda:0,cuda:1 --format shard
+    python poison_launcher.py -d SELECTED -od POISONED -t tiger --devices cpu --workers 8 --pin_cores
+"""
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import sys
+
+import torch
+
+from caching import TargetLatentCache
+from dataset_store import ShardReader, ShardWriter, INDEX_FILE, is_shard_store, open_reader, open_writer
+from gen_poison import add_arguments, build_exporter, build_generator, check_arguments, poison_records, report
+from opt import PoisonGeneration, configure_threads, resolve_precision
+from run_manifest import RunManifest
+from target_bank import TargetBank
+import export
+import metrics
+
+WORKERS_DIR = "workers"
+
+
+def default_devices():
+    if torch.cuda.is_available():
+        return ["cuda:{}".format(i) for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def plan_workers(devices, num_workers, threads, pin_cores):
+    """Returns one (device, torch threads, cpu cores or None) tuple per worker."""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if threads is None:
+        threads = max(1, len(cpus) // num_workers)
+    plan = []
+    for rank in range(num_workers):
+        cores = None
+        if pin_cores:
+            cores = cpus[rank * threads:(rank + 1) * threads] or cpus
+        plan.append((devices[rank % len(devices)], threads, cores))
+    return plan
+
+
+def iter_tasks(task_queue):
+    while True:
+        chunk = task_queue.get()
+        if chunk is None:
+            return
+        for idx in chunk:
+            yield idx
+
+
+def warm_target(args, device):
+    # one process generates the target latent; the workers then only load the VAE encoder
+    metrics.configure(metrics.worker_path(args.metrics, "target"), labels={"worker": "target", "device": device})
+    poison_generator = build_generator(args, device)
+    poison_generator.get_target_latent(args.target_name)
+
+
+def worker_main(rank, device, threads, cores, args, task_queue, result_queue):
+    if cores:
+        os.sched_setaffinity(0, cores)
+    # one metrics file per worker, labelled with its rank and device
+    metrics.configure(metrics.worker_path(args.metrics, rank), labels={"worker": rank, "device": device})
+    configure_threads(threads, args.interop_threads)
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    print(f"[worker {rank}] device={device} threads={threads}" + (f" cores={cores}" if cores else ""), flush=True)
+
+    poison_generator = build_generator(args, device)
+    reader = open_reader(args.directory)
+    # one shared log; each mark is a single appended line, so concurrent workers do not interleave
+    manifest = RunManifest(os.path.join(args.outdir, "run_manifest.jsonl"))
+    out = os.path.join(args.outdir, WORKERS_DIR, f"worker_{rank}") if args.format == "shard" else args.outdir
+    # workers only encode; the launcher writes their metadata rows into one metadata.csv
+    exporter = build_exporter(args, metadata=None)
+    try:
+        with open_writer(out, args.format) as writer:
+            stats, resumed, unreadable = poison_records(poison_generator, reader, iter_tasks(task_queue), writer,
+                                                        manifest, args, exporter)
+    finally:
+        if exporter is not None:
+            exporter.close()
+    result_queue.put((rank, stats, resumed, unreadable, list(exporter.rows.items()) if exporter is not None else []))
+
+
+def merge_worker_stores(outdir, manifest):
+    """
+    Rebuilds outdir's index from every worker store, ordered by record index.
+    A record found in several stores (re-queued to another worker after a crash, or poisoned again by a rerun
+    with other settings) keeps the copy whose fingerprint the manifest marked done; without one, the copy
+    of the highest-ranked worker wins.
+    """
+    copies = {}
+    workers_dir = os.path.join(outdir, WORKERS_DIR)
+    names = [name for name in os.listdir(workers_dir) if name.startswith("worker_")]
+    for name in sorted(names, key=lambda name: int(name[len("worker_"):])):
+        path = os.path.join(workers_dir, name)
+        if not is_shard_store(path):
+            continue
+        reader = ShardReader(path)
+        # within one store the reader already keeps the last copy written
+        for i in range(len(reader)):
+            copies.setdefault(reader.name(i), []).append((reader, i))
+
+    records = {}
+    for name, candidates in copies.items():
+        entry = manifest.get(name, "poison")
+        current = [(reader, i) for reader, i in candidates
+                   if entry is not None and reader.records[i].get("fingerprint") == entry["fingerprint"]]
+        records[name] = (current or candidates)[-1]
+
+    index_path = os.path.join(outdir, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    with ShardWriter(outdir) as writer:
+        for name in sorted(records, key=int):
+            reader, i = records[name]
+            writer.add_reference(reader, i)
+    return len(records)
+
+
+def main():
+    devices = args.devices.split(",") if args.devices else default_devices()
+    num_workers = args.workers or len(devices)
+    if args.force:
+        shutil.rmtree(args.outdir, ignore_errors=True)
+    os.makedirs(args.outdir, exist_ok=True)
+
+    reader = open_reader(args.directory)
+    ctx = mp.get_context("spawn")
+
+    if args.target_bank:
+        if not TargetBank(args.target_bank).contains(args.target_name, args.target_samples):
+            sys.exit(f"Target bank {args.target_bank} lacks {args.target_samples} sample(s) of '{args.target_name}'; "
+                     f"run python target_bank.py build {args.target_bank} --concepts {args.target_name} "
+                     f"--samples {args.target_samples}")
+    elif not TargetLatentCache(args.cache_dir).contains(
+            PoisonGeneration.target_key(args.target_name, resolve_precision(args.precision, devices[0]))):
+        print(f"Generating the target latent for '{args.target_name}' once before starting workers...")
+        proc = ctx.Process(target=warm_target, args=(args, devices[0]))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            sys.exit("Target generation failed")
+
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    chunk = args.chunk_size or args.batch_size
+    for start in range(0, len(reader), chunk):
+        task_queue.put(list(range(start, min(start + chunk, len(reader)))))
+    for _ in range(num_workers):
+        task_queue.put(None)
+
+    procs = []
+    for rank, (device, threads, cores) in enumerate(plan_workers(devices, num_workers, args.threads_per_worker,
+                                                                 args.pin_cores)):
+        proc = ctx.Process(target=worker_main, args=(rank, device, threads, cores, args, task_queue, result_queue))
+        proc.start()
+        procs.append(proc)
+
+    results = []
+    while len(results) < len(procs):
+        try:
+            results.append(result_queue.get(timeout=5))
+        except queue.Empty:
+            # a worker that dies never reports, so stop waiting once every process has exited
+            if not any(proc.is_alive() for proc in procs) and result_queue.empty():
+                break
+    for proc in procs:
+        proc.join()
+    stats = [stat for _, worker_stats, _, _, _ in results for stat in worker_stats]
+    resumed = [idx for _, _, worker_resumed, _, _ in results for idx in worker_resumed]
+    unreadable = [idx for _, _, _, worker_unreadable, _ in results for idx in worker_unreadable]
+    failed = [rank for rank, proc in enumerate(procs) if proc.exitcode != 0]
+
+    if args.format == "shard" and os.path.isdir(os.path.join(args.outdir, WORKERS_DIR)):
+        total = merge_worker_stores(args.outdir, RunManifest(os.path.join(args.outdir, "run_manifest.jsonl")))
+        print(f"Merged {total} records from {num_workers} workers into {args.outdir}")
+    if args.export_dir:
+        metadata_path = os.path.join(args.export_dir, export.METADATA_FILE)
+        rows = dict(export.read_metadata(metadata_path))
+        for _, _, _, _, worker_rows in results:
+            rows.update(worker_rows)
+        if rows:
+            export.write_metadata(metadata_path, sorted(rows.items()))
+    report(sorted(stats, key=lambda s: int(s["file"])), resumed, unreadable, args.outdir)
+    if failed:
+        sys.exit("Workers {} failed; rerun to resume the remaining images".format(failed))
+
+
+def parse_arguments(argv):
+    parser = add_arguments(argparse.ArgumentParser())
+    parser.add_argument('--devices', type=str, default=None,
+                        help="comma separated devices assigned round robin, e.g. cuda:0,cuda:1 or cpu (default: all GPUs, else cpu)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: one per device)")
+    parser.add_argument('--threads_per_worker', type=int, default=None,
+                        help="torch intra-op threads per worker, replacing --threads (default: available cores / workers)")
+    parser.add_argument('--pin_cores', action='store_true',
+                        help="pin each worker to its own block of threads_per_worker cores")
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help="record indices handed out per queue request (default: batch_size)")
+    return check_arguments(parser, parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    main()
@@ -0,0 +1,93 @@
+"""
+Per-item record of completed pipeline stages, so an interrupted run resumes where it stopped
+instead of starting over.
+
+The manifest is a JSON-lines log. Each line marks one (item, stage) pair as done, together with
+the fingerprint of the inputs/parameters it was produced from and the files it wrote; the last
+line for a pair wins. A stage only counts as done while its fingerprint matches and all of its
+recorded outputs still exist. force=True truncates the log, which is the only way to redo work.
+
+Usage from shell scripts:
+    python run_manifest.py done <manifest> <item> <stage> <fingerprint>    # exit status 0 if done
+    python run_manifest.py mark <manifest> <item> <stage> <fingerprint> [--output PATH ...]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+def fingerprint(*parts):
+    # same scheme as caching.make_key, without pulling torch into the shell helpers
+    raw = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RunManifest(object):
+    def __init__(self, path, force=False):
+        self.path = str(path)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if force:
+            open(self.path, "w").close()
+        elif os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.entries[(entry["item"], entry["stage"])] = entry
+
+    def get(self, item, stage):
+        return self.entries.get((item, stage))
+
+    def done(self, item, stage, fingerprint):
+        entry = self.entries.get((item, stage))
+        return (entry is not None and entry["fingerprint"] == fingerprint
+                and all(os.path.exists(p) for p in entry.get("outputs", ())))
+
+    def mark(self, item, stage, fingerprint, outputs=(), **info):
+        entry = dict(info, item=item, stage=stage, fingerprint=fingerprint,
+                     outputs=[str(p) for p in outputs], time=time.time())
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[(item, stage)] = entry
+        return entry
+
+    def completed(self, stage):
+        """Entries of every item whose stage is done, whatever its fingerprint."""
+        return [e for (_, s), e in self.entries.items() if s == stage]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or update a run manifest")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("done", "mark"):
+        p = sub.add_parser(name)
+        p.add_argument("manifest")
+        p.add_argument("item")
+        p.add_argument("stage")
+        p.add_argument("fingerprint")
+        if name == "mark":
+            p.add_argument("--output", action="append", default=[])
+    args = parser.parse_args()
+
+    manifest = RunManifest(args.manifest)
+    if args.command == "done":
+        return 0 if manifest.done(args.item, args.stage, args.fingerprint) else 1
+    manifest.mark(args.item, args.stage, args.fingerprint, outputs=args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Precomputed target latents for PoisonGeneration, several seeded samples per target concept.
+
+A bank is a directory holding
+    index.jsonl     one JSON line per sample: concept, sample, seed, prompt and the SD settings it was drawn with
+    latents.npy     fp16 latents (rows, 4, 64, 64), row i belonging to line i of the index
+
+latents.npy is memory-mapped on first use, so a worker reads only the rows of the concepts it poisons.
+Building a bank is the only step that runs the UNet; with --target_bank, gen_poison.py and
+poison_launcher.py load just the VAE encoder.
+
+Usage:
+    python target_bank.py build <bank> --concepts tiger,cat,dog --samples 4 [--device cuda] [--batch_size 4]
+    python target_bank.py list <bank>
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+from caching import make_key
+
+INDEX_FILE = "index.jsonl"
+LATENTS_FILE = "latents.npy"
+
+
+class TargetBank(object):
+    def __init__(self, path):
+        self.path = str(path)
+        self.entries = []
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+        self._latents = None
+
+    @property
+    def latents(self):
+        if self._latents is None:
+            self._latents = np.load(os.path.join(self.path, LATENTS_FILE), mmap_mode="r")
+        return self._latents
+
+    def concepts(self):
+        return list(dict.fromkeys(e["concept"] for e in self.entries))
+
+    def rows(self, concept, samples=None):
+        """Row numbers of a concept's samples in sample order, at most `samples` of them."""
+        rows = sorted((e["sample"], i) for i, e in enumerate(self.entries) if e["concept"] == concept)
+        return [i for _, i in rows][:samples]
+
+    def contains(self, concept, samples=1):
+        return len(self.rows(concept)) >= samples
+
+    def key(self, concept, samples=None):
+        """Fingerprint of the samples get() returns, for cache keys and run manifests."""
+        entries = [self.entries[i] for i in self.rows(concept, samples)]
+        return make_key(*(json.dumps(e, sort_keys=True) for e in entries))
+
+    def get(self, concept, samples=None, device=None, dtype=torch.float32):
+        """(K, 4, h, w) latents of the first `samples` samples of concept (all of them by default)."""
+        rows = self.rows(concept, samples)
+        if not rows or (samples and len(rows) < samples):
+            raise KeyError("target bank {} has {} sample(s) of '{}', {} needed; add them with "
+                           "python target_bank.py build {} --concepts {} --samples {}".format(
+                               self.path, len(rows), concept, samples or 1, self.path, concept, samples or 1))
+        latents = torch.from_numpy(np.ascontiguousarray(self.latents[rows]))
+        return latents.to(device=device, dtype=dtype)
+
+    def add(self, entries, latents):
+        """Appends samples and rewrites the bank; entries replace existing ones with the same concept and sample."""
+        new = {(e["concept"], e["sample"]) for e in entries}
+        keep = [i for i, e in enumerate(self.entries) if (e["concept"], e["sample"]) not in new]
+        latents = np.asarray(latents, dtype=np.float16)
+        if keep:
+            latents = np.concatenate([np.asarray(self.latents[keep]), latents])
+        entries = [self.entries[i] for i in keep] + list(entries)
+        os.makedirs(self.path, exist_ok=True)
+        # write then rename; readers that already mapped the old file keep a valid view of it
+        tmp_path = os.path.join(self.path, LATENTS_FILE + ".tmp.npy")
+        np.save(tmp_path, latents)
+        os.replace(tmp_path, os.path.join(self.path, LATENTS_FILE))
+        tmp_path = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e) + "\n")
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+        self.entries = entries
+        self._latents = None
+
+
+def build(bank, concepts, samples, device, batch_size=4, save_images=False, cache_dir=None):
+    """Draws the missing samples of every concept with SD 1.5 and stores their VAE latents."""
+    from opt import (MODEL_ID, TARGET_GUIDANCE_SCALE, TARGET_NUM_INFERENCE_STEPS, TARGET_RESOLUTION, TARGET_SEED,
+                     PoisonGeneration, images2tensor)
+    generator = None
+    for concept in concepts:
+        have = {bank.entries[i]["sample"] for i in bank.rows(concept)}
+        todo = [k for k in range(samples) if k not in have]
+        if not todo:
+            print(f"[target_bank] {concept}: {samples} samples already in the bank")
+            continue
+        if generator is None:
+            generator = PoisonGeneration(concept, device, cache_dir=cache_dir, lean=False)
+        prompt = "A photo of a {}".format(concept)
+        entries, latents = [], []
+        for start in range(0, len(todo), batch_size):
+            chunk = todo[start:start + batch_size]
+            # one CPU generator per sample: sample k is the same image whatever the device or batch size
+            seeds = [TARGET_SEED + k for k in chunk]
+            with torch.no_grad():
+                images = generator.full_sd_model(
+                    [prompt] * len(chunk), guidance_scale=TARGET_GUIDANCE_SCALE,
+                    num_inference_steps=TARGET_NUM_INFERENCE_STEPS, height=TARGET_RESOLUTION,
+                    width=TARGET_RESOLUTION, generator=[torch.Generator("cpu").manual_seed(s) for s in seeds]).images
+                tensor = images2tensor(images, TARGET_RESOLUTION, device, generator.dtype)
+                latents.append(generator.get_latent(tensor).float().cpu().numpy())
+            for k, seed, img in zip(chunk, seeds, images):
+                entries.append(dict(concept=concept, sample=k, seed=seed, prompt=prompt, model=MODEL_ID,
+                                    revision=generator.revision, guidance_scale=TARGET_GUIDANCE_SCALE,
+                                    num_inference_steps=TARGET_NUM_INFERENCE_STEPS, resolution=TARGET_RESOLUTION,
+                                    dtype=str(generator.dtype)))
+                if save_images:
+                    os.makedirs(os.path.join(bank.path, "images"), exist_ok=True)
+                    img.save(os.path.join(bank.path, "images", f"{concept}_{k}.png"))
+        # every concept is committed on its own, so an interrupted build keeps the finished ones
+        bank.add(entries, np.concatenate(latents))
+        print(f"[target_bank] {concept}: added samples {todo}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect target latent banks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_p = sub.add_parser("build")
+    build_p.add_argument("bank")
+    build_p.add_argument("--concepts", required=True, help="comma-separated target concepts")
+    build_p.add_argument("--samples", type=int, default=4, help="seeded samples per concept")
+    build_p.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    build_p.add_argument("--batch_size", type=int, default=4, help="samples drawn per SD call")
+    build_p.add_argument("--save_images", action="store_true", help="also keep the target images under <bank>/images")
+    build_p.add_argument("--cache_dir", default=None)
+    list_p = sub.add_parser("list")
+    list_p.add_argument("bank")
+    args = parser.parse_args()
+
+    bank = TargetBank(args.bank)
+    if args.command == "build":
+        concepts = [c.strip() for c in args.concepts.split(",") if c.strip()]
+        build(bank, concepts, args.samples, args.device, args.batch_size, args.save_images, args.cache_dir)
+    else:
+        for concept in bank.concepts():
+            seeds = [bank.entries[i]["seed"] for i in bank.rows(concept)]
+            print(f"{concept}: {len(seeds)} samples, seeds {seeds}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
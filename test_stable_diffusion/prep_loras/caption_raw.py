@@ -1,9 +1,12 @@
 import os
+import sys
 import glob
 import csv
-from PIL import Image
-import torch
-from transformers import BlipProcessor, BlipForConditionalGeneration
+import argparse
+from PIL import Image, UnidentifiedImageError
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from captioning import CaptionEngine
 
 # ================= CONFIGURATION =================
 # Path to your training images
@@ -22,40 +25,25 @@ PREPEND_TRIGGER = True
 VALID_EXTENSIONS = ('*.png', '*.jpg', '*.jpeg', '*.webp')
 # =================================================
 
-def setup_model():
+def setup_model(batch_size=None, max_new_tokens=50):
     """
-    Loads the BLIP captioning model. 
-    Uses GPU if available, otherwise falls back to CPU.
+    Loads the BLIP captioning engine.
+    Uses GPU (fp16) if available, otherwise CPU (bf16 where the CPU supports it, else fp32).
     """
     print("Loading BLIP model... (this may take a moment first time)")
-    
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
-    
-    # Load processor and model from HuggingFace Hub
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-    
-    return processor, model, device
-
-def generate_caption(processor, model, device, image_path):
+
+    engine = CaptionEngine(batch_size=batch_size, max_new_tokens=max_new_tokens)
+    print(f"Using device: {engine.device}, dtype: {engine.dtype}, batch size: {engine.batch_size}")
+    return engine
+
+def load_image(image_path):
     """
-    Generates a caption for a single image file.
+    RGB image, or None if the file cannot be read.
     """
     try:
-        raw_image = Image.open(image_path).convert('RGB')
-        
-        # Determine strict prefix if desired (unconditional captioning usually starts with 'a photo of')
-        # You can pass text="a photography of" to the processor to guide it, 
-        # but leaving it None often yields the most natural results for BLIP.
-        inputs = processor(raw_image, return_tensors="pt").to(device)
-        
-        # Generate output
-        out = model.generate(**inputs, max_new_tokens=50)
-        caption = processor.decode(out[0], skip_special_tokens=True)
-        
-        return caption
-    except Exception as e:
+        with Image.open(image_path) as im:
+            return im.convert('RGB')
+    except (UnidentifiedImageError, OSError) as e:
         print(f"Error processing {image_path}: {e}")
         return None
 
@@ -77,46 +65,59 @@ def format_caption(caption):
     return final_caption
 
 def main():
-    if not os.path.exists(IMAGE_DIRECTORY):
-        print(f"Error: Directory '{IMAGE_DIRECTORY}' not found.")
+    global TRIGGER_WORD, PREPEND_TRIGGER
+    parser = argparse.ArgumentParser(description="Caption a folder of LoRA training images into metadata.csv")
+    parser.add_argument("--image_dir", default=IMAGE_DIRECTORY)
+    parser.add_argument("--trigger_word", default=TRIGGER_WORD)
+    parser.add_argument("--append_trigger", action="store_true", help="put the trigger word at the end instead of the start")
+    parser.add_argument("--batch_size", type=int, default=None, help="default: sized from free memory")
+    parser.add_argument("--max_new_tokens", type=int, default=50)
+    args = parser.parse_args()
+    TRIGGER_WORD = args.trigger_word
+    PREPEND_TRIGGER = PREPEND_TRIGGER and not args.append_trigger
+
+    if not os.path.exists(args.image_dir):
+        print(f"Error: Directory '{args.image_dir}' not found.")
         return
 
     # Load model once
-    processor, model, device = setup_model()
-    
+    engine = setup_model(args.batch_size, args.max_new_tokens)
+
     # Gather all images
     image_files = []
     for ext in VALID_EXTENSIONS:
-        image_files.extend(glob.glob(os.path.join(IMAGE_DIRECTORY, ext)))
-    
-    print(f"Found {len(image_files)} images in {IMAGE_DIRECTORY}")
-    
+        image_files.extend(glob.glob(os.path.join(args.image_dir, ext)))
+    image_files.sort()
+
+    print(f"Found {len(image_files)} images in {args.image_dir}")
+
     metadata_rows = []
 
-    for img_file in image_files:
-        raw_caption = generate_caption(processor, model, device, img_file)
+    # images are decoded ahead of the model and captioned in batches
+    for img_file, raw_caption in engine.caption_files(image_files, load_image):
         if raw_caption:
             final_caption = format_caption(raw_caption)
-            
+
             print(f"Processed: {os.path.basename(img_file)} -> '{final_caption}'")
-            
+
             # Add to metadata list
             metadata_rows.append({
                 "file_name": os.path.basename(img_file),
                 "text": final_caption
             })
 
-    # Save metadata.csv
+    # Save metadata.csv once, after every caption is in (written then renamed, so it is never partial)
     if metadata_rows:
-        csv_path = os.path.join(IMAGE_DIRECTORY, "metadata.csv")
-        with open(csv_path, "w", newline="", encoding="utf-8") as csvfile:
+        csv_path = os.path.join(args.image_dir, "metadata.csv")
+        with open(csv_path + ".tmp", "w", newline="", encoding="utf-8") as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=["file_name", "text"])
             writer.writeheader()
             writer.writerows(metadata_rows)
+        os.replace(csv_path + ".tmp", csv_path)
         print(f"\nSaved metadata.csv to {csv_path}")
 
     print("\nDone! Captions generated.")
 
 if __name__ == "__main__":
     main()
-# example usage: python caption_raw.py
+# example usage: python caption_raw.py [--image_dir DIR --trigger_word WORD --batch_size 16]
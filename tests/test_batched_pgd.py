@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import standins
+
+RESOLUTION = 32
+EPS = 0.05
+
+
+def run(tmp_path, images, **kwargs):
+    """generate_batch over all images and over each image alone: (batch outputs, batch stats, solo outputs, solo stats)."""
+    torch.manual_seed(0)
+    generator = standins.tiny_poison_generator(str(tmp_path), resolution=RESOLUTION, eps=EPS, **kwargs)
+    batch = generator.generate_batch(images, standins.TARGET_CONCEPT)
+    batch_stats = generator.last_stats
+    solo, solo_stats = [], []
+    for img in images:
+        solo.extend(generator.generate_batch([img], standins.TARGET_CONCEPT))
+        solo_stats.extend(generator.last_stats)
+    return batch, batch_stats, solo, solo_stats
+
+
+def pixel_diff(a, b):
+    return np.abs(np.asarray(a, dtype=int) - np.asarray(b, dtype=int))
+
+
+def test_one_step_is_exact(tmp_path):
+    images = standins.random_images(4, RESOLUTION)
+    batch, _, solo, _ = run(tmp_path, images, max_iters=1)
+    for a, b in zip(batch, solo):
+        assert pixel_diff(a, b).max() == 0
+
+
+# noise and flat images converge after different numbers of steps, so the early-stop cases drop rows mid-batch
+@pytest.mark.parametrize("kwargs", [dict(max_iters=30),
+                                    dict(max_iters=40, patience=3, min_rel_improvement=0.01),
+                                    dict(max_iters=40, patience=5, min_rel_improvement=0.002, adaptive_step=True)])
+def test_batch_matches_solo(tmp_path, kwargs):
+    images = standins.random_images(2, RESOLUTION) + [Image.new("RGB", (RESOLUTION, RESOLUTION), c)
+                                                      for c in ((255, 255, 255), (128, 128, 128))]
+    batch, batch_stats, solo, solo_stats = run(tmp_path, images, **kwargs)
+    if "patience" in kwargs:
+        assert len({s["iterations"] for s in batch_stats}) > 1
+    assert [s["iterations"] for s in batch_stats] == [s["iterations"] for s in solo_stats]
+    for b, s in zip(batch_stats, solo_stats):
+        assert b["loss"] == pytest.approx(s["loss"], rel=1e-3)
+    # sign-gradient steps amplify last-bit differences of batched kernels where a gradient is ~0, so a
+    # small share of pixels may end up a step or two apart
+    diffs = np.stack([pixel_diff(a, b) for a, b in zip(batch, solo)])
+    assert (diffs > 0).mean() < 0.03
+    resize = standins.tiny_poison_generator(str(tmp_path), resolution=RESOLUTION).transform
+    for img, out in zip(images, batch):
+        assert pixel_diff(out, resize(img)).max() <= np.ceil(EPS * 255) + 1
+
+
+def test_generate_all_keeps_only_the_last_call(tmp_path):
+    generator = standins.tiny_poison_generator(str(tmp_path), resolution=RESOLUTION, max_iters=2, batch_size=2)
+    for n in (5, 3):
+        outputs = generator.generate_all(standins.random_images(n, RESOLUTION), standins.TARGET_CONCEPT)
+        assert len(outputs) == n and len(generator.last_stats) == n
+    assert not hasattr(generator, "stats")
@@ -0,0 +1,44 @@
+import numpy as np
+
+import opt
+import standins
+from caching import EmbeddingCache
+
+
+def test_revision_resolves_through_hub_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(opt, "HF_HUB_CACHE", str(tmp_path))
+    assert opt.resolve_revision() == opt.MODEL_REVISION
+    key = opt.PoisonGeneration.target_key("tiger")
+    refs = tmp_path / ("models--" + opt.MODEL_ID.replace("/", "--")) / "refs"
+    refs.mkdir(parents=True)
+    (refs / opt.MODEL_REVISION).write_text("a" * 40)
+    assert opt.resolve_revision() == "a" * 40
+    # new weights behind the branch mean a new target latent
+    assert opt.PoisonGeneration.target_key("tiger") != key
+
+
+def test_result_key_depends_on_encoder(tmp_path):
+    keys = set()
+    for kwargs in (dict(), dict(compile=True), dict(encoder_backend="torchscript")):
+        generator = standins.tiny_poison_generator(str(tmp_path), resolution=32, **kwargs)
+        keys.add(generator.result_key(standins.random_images(1, 32)[0], standins.TARGET_CONCEPT))
+    assert len(keys) == 3
+
+
+def test_target_key_depends_on_precision(tmp_path):
+    keys = {opt.PoisonGeneration.target_key("tiger", p) for p in ("fp16", "fp32", "bf16")}
+    assert len(keys) == 3
+    assert opt.resolve_precision("auto", "cuda:1") == "fp16" and opt.resolve_precision("auto", "cpu") == "fp32"
+    # the bf16 generator finds the latent seeded under its precision instead of sampling a new target
+    generator = standins.tiny_poison_generator(str(tmp_path), resolution=32, precision="bf16")
+    assert generator.target_cache.contains(opt.PoisonGeneration.target_key(standins.TARGET_CONCEPT, "bf16"))
+    assert generator.has_target(standins.TARGET_CONCEPT)
+
+
+def test_overwrite_is_counted_once(tmp_path):
+    cache = EmbeddingCache("embeddings", str(tmp_path))
+    cache.put("first", np.zeros(100, dtype=np.float32))
+    size = cache._size
+    for _ in range(5):
+        cache.put("second", np.zeros(100, dtype=np.float32))
+    assert cache._size == 2 * size == sum(entry_size for _, entry_size, _ in cache._entries())
@@ -0,0 +1,43 @@
+import torch
+from PIL import Image
+
+import standins
+from captioning import generate_captions, plain_greedy
+
+MAX_NEW_TOKENS = 12
+
+
+def blip_with_varied_lengths():
+    # tiny_blip suppresses [SEP] so benchmark captions run to full length; with wider random weights and
+    # [SEP] allowed, greedy captions end at different steps and rows leave the batch mid-generation
+    processor, model = standins.tiny_blip()
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for p in model.parameters():
+            if p.dim() > 1:
+                p.normal_(0, 0.3)
+        model.text_decoder.cls.predictions.bias[model.config.text_config.sep_token_id] = 0.0
+    return processor, model
+
+
+def test_matches_generate():
+    processor, model = blip_with_varied_lengths()
+    assert plain_greedy(model)
+    sep = model.config.text_config.sep_token_id
+    images = standins.random_images(4, 64, seed=3) + [Image.new("RGB", (64, 64), c)
+                                                      for c in ((255, 0, 0), (0, 255, 0), (0, 0, 0), (255, 255, 255))]
+    pixel_values = processor(images=images, return_tensors="pt")["pixel_values"]
+
+    ours = generate_captions(model, pixel_values, MAX_NEW_TOKENS)
+    lengths = [len(t) for t in ours]
+    assert len(set(lengths)) > 2 and MAX_NEW_TOKENS in lengths
+
+    with torch.no_grad():
+        reference = model.generate(pixel_values=pixel_values, max_new_tokens=MAX_NEW_TOKENS, do_sample=False)[:, 1:]
+    for row, tokens in zip(reference.tolist(), ours):
+        # generate pads a finished row after its [SEP]; generate_captions stops at it
+        if sep in row:
+            row = row[:row.index(sep) + 1]
+        assert tokens.tolist() == row
+    decode = processor.tokenizer.batch_decode
+    assert decode(ours, skip_special_tokens=True) == decode(reference, skip_special_tokens=True)
@@ -0,0 +1,21 @@
+import numpy as np
+
+from dataset_store import ShardReader, open_writer
+
+
+def image(value):
+    return np.full((4, 5, 3), value, dtype=np.uint8)
+
+
+def test_rewritten_name_keeps_last_copy(tmp_path):
+    with open_writer(str(tmp_path), "shard") as writer:
+        writer.add("0", image(10), "first")
+        writer.add("1", image(20), "other")
+    # a resumed run writes record 0 again because its manifest mark was lost
+    with open_writer(str(tmp_path), "shard") as writer:
+        writer.add("0", image(30), "again")
+
+    reader = ShardReader(str(tmp_path))
+    assert reader.names == ["0", "1"]
+    assert reader.texts == ["again", "other"]
+    assert (reader.image(0) == 30).all()
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+import standins
+from run_benchmarks import PARITY_TOLERANCE, encoder_step, rel_diff
+
+RESOLUTION = 32
+
+
+def latent_and_grad(tmp_path, backend, precision, source):
+    generator = standins.tiny_poison_generator(str(tmp_path / backend), resolution=RESOLUTION, precision=precision,
+                                               encoder_backend=backend)
+    with torch.no_grad():
+        torch.manual_seed(3)
+        target_latent = torch.randn_like(generator.get_latent(source))
+    return encoder_step(generator, source, target_latent)
+
+
+@pytest.mark.parametrize("precision", ["fp32", "bf16"])
+@pytest.mark.parametrize("backend", ["compile", "torchscript"])
+def test_backend_matches_eager(tmp_path, backend, precision):
+    torch.manual_seed(2)
+    source = torch.rand(2, 3, RESOLUTION, RESOLUTION) * 2 - 1
+    ref_latent, ref_grad = latent_and_grad(tmp_path, "eager", precision, source)
+    latent, grad = latent_and_grad(tmp_path, backend, precision, source)
+    assert rel_diff(latent, ref_latent) <= PARITY_TOLERANCE[precision]
+    assert rel_diff(grad, ref_grad) <= PARITY_TOLERANCE[precision]
+
+
+def test_torchscript_is_exact_in_fp32(tmp_path):
+    # the trace replays the eager kernels; only compile may reorder float math
+    torch.manual_seed(2)
+    source = torch.rand(3, 3, RESOLUTION, RESOLUTION) * 2 - 1
+    ref_latent, ref_grad = latent_and_grad(tmp_path, "eager", "fp32", source)
+    latent, grad = latent_and_grad(tmp_path, "torchscript", "fp32", source)
+    assert torch.equal(latent, ref_latent)
+    assert torch.equal(grad, ref_grad)
+
+
+def test_compile_flag_rejects_compiled_encoder(tmp_path):
+    with pytest.raises(ValueError):
+        standins.tiny_poison_generator(str(tmp_path), resolution=RESOLUTION, compile=True, encoder_backend="compile")
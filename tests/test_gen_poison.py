@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import gen_poison
+import standins
+from run_manifest import RunManifest
+
+RESOLUTION = 32
+
+
+class Reader(object):
+    """In-memory reader; the records listed in broken raise on load."""
+
+    def __init__(self, n, broken=()):
+        self.images = [np.asarray(img) for img in standins.random_images(n, RESOLUTION)]
+        self.broken = set(broken)
+
+    def __len__(self):
+        return len(self.images)
+
+    def name(self, idx):
+        return f"{idx}.p"
+
+    def text(self, idx):
+        return f"caption {idx}"
+
+    def load(self, idx):
+        if idx in self.broken:
+            raise ValueError("truncated pickle")
+        return {"img": self.images[idx], "text": self.text(idx)}
+
+
+class Writer(object):
+    def __init__(self, fail_after=None):
+        self.names = []
+        self.fail_after = fail_after
+
+    def add(self, name, img, text, **meta):
+        if self.fail_after is not None and len(self.names) >= self.fail_after:
+            raise OSError(28, "No space left on device")
+        self.names.append(name)
+
+
+def poison(tmp_path, reader, writer, calls=None):
+    args = gen_poison.parse_arguments(["-t", standins.TARGET_CONCEPT, "--batch_size", "1", "--prefetch", "1",
+                                      "--write_behind", "1"])
+    generator = standins.tiny_poison_generator(str(tmp_path / "cache"), resolution=RESOLUTION, max_iters=1)
+    if calls is not None:
+        generate_batch = generator.generate_batch
+
+        def counted(*a, **kw):
+            calls.append(1)
+            return generate_batch(*a, **kw)
+        generator.generate_batch = counted
+    manifest = RunManifest(tmp_path / "run_manifest.jsonl")
+    return gen_poison.poison_records(generator, reader, range(len(reader)), writer, manifest, args)
+
+
+def test_unreadable_records_are_counted(tmp_path, capsys):
+    writer = Writer()
+    stats, resumed, unreadable = poison(tmp_path, Reader(5, broken=(1, 3)), writer)
+    assert unreadable == [1, 3] and not resumed
+    assert writer.names == ["0", "2", "4"] and len(stats) == 3
+    gen_poison.report(stats, resumed, unreadable, str(tmp_path))
+    assert "Skipped 2 unreadable records: 1, 3" in capsys.readouterr().out
+
+
+def test_write_error_aborts_early(tmp_path):
+    calls = []
+    with pytest.raises(OSError, match="No space left"):
+        poison(tmp_path, Reader(40), Writer(fail_after=2), calls)
+    # only the few records already queued behind the failed write are poisoned, not all 40
+    assert len(calls) < 10
+    assert len(RunManifest(tmp_path / "run_manifest.jsonl").entries) == 2
@@ -0,0 +1,38 @@
+import asyncio
+
+from pipeline import STOP, Pipeline
+from standins import LocalObjectStore
+
+
+def listed(pipeline):
+    queue = asyncio.Queue()
+    asyncio.run(pipeline.list_source(queue))
+    items = []
+    while True:
+        item = queue.get_nowait()
+        if item is STOP:
+            return items
+        items.append(item)
+
+
+def test_equal_basenames_get_their_own_files(tmp_path):
+    store = LocalObjectStore(str(tmp_path / "store"))
+    for key in ["raw/a/dup.jpg", "raw/b/dup.jpg", "raw/one.jpg", "raw/a__dup.jpg", "raw/notes.txt"]:
+        store.put_object(Bucket="bench", Key=key, Body=b"")
+    pipeline = Pipeline(None, store, "bench", "raw/", "out/", str(tmp_path / "work"), "dog", score_threshold=0.0)
+
+    items = listed(pipeline)
+    assert [(item["key"], item["path"].name, item["output"].name) for item in items] == [
+        ("raw/a/dup.jpg", "a__dup.jpg", "dog_a__dup_0.png"),
+        ("raw/b/dup.jpg", "b__dup.jpg", "dog_b__dup_0.png"),
+        ("raw/one.jpg", "one.jpg", "dog_one_0.png"),
+    ]
+    # a flat key that maps onto a nested key's name is refused instead of overwriting its files
+    assert pipeline.counts["listed"] == 4 and pipeline.counts["failed"] == 1
+
+
+def test_partial_prefix_keeps_the_basename(tmp_path):
+    store = LocalObjectStore(str(tmp_path / "store"))
+    store.put_object(Bucket="bench", Key="raw/img1.jpg", Body=b"")
+    pipeline = Pipeline(None, store, "bench", "raw/im", "out/", str(tmp_path / "work"), "dog", score_threshold=0.0)
+    assert [item["path"].name for item in listed(pipeline)] == ["img1.jpg"]
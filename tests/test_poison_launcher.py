@@ -0,0 +1,29 @@
+import os
+
+import numpy as np
+
+from dataset_store import ShardReader, ShardWriter
+from poison_launcher import WORKERS_DIR, merge_worker_stores
+from run_manifest import RunManifest
+
+
+def write_store(path, records):
+    with ShardWriter(str(path)) as writer:
+        for name, value, fp in records:
+            writer.add(name, np.full((2, 2, 3), value, dtype=np.uint8), "text " + name, fingerprint=fp)
+
+
+def test_merge_prefers_the_copy_marked_done(tmp_path):
+    workers = tmp_path / WORKERS_DIR
+    # worker_2 re-poisoned "0" in this run; worker_10 still holds its copy from an earlier run with other settings
+    write_store(workers / "worker_2", [("0", 2, "new"), ("1", 2, None)])
+    write_store(workers / "worker_10", [("0", 10, "old"), ("1", 10, None), ("2", 10, "new")])
+    manifest = RunManifest(tmp_path / "run_manifest.jsonl")
+    manifest.mark("0", "poison", "new")
+    manifest.mark("2", "poison", "new")
+
+    assert merge_worker_stores(str(tmp_path), manifest) == 3
+    merged = ShardReader(str(tmp_path))
+    assert merged.names == ["0", "1", "2"]
+    # without a manifest match, workers are ranked numerically, so worker_10 comes after worker_2
+    assert [int(merged.image(i)[0, 0, 0]) for i in range(3)] == [2, 10, 10]
@@ -0,0 +1,113 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import s3_transfer
+
+BUCKET = "bench"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put(client, keys):
+    for key in keys:
+        client.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+
+
+def test_lists_past_one_page_and_skips_unchanged(client, tmp_path):
+    keys = [f"raw/img{i:05d}.jpg" for i in range(1005)]
+    put(client, keys)
+    assert len(list(s3_transfer.list_keys(client, BUCKET, "raw/"))) == 1005
+
+    downloaded, skipped, failed = s3_transfer.download_prefix(client, BUCKET, "raw/", tmp_path, max_workers=4)
+    assert sorted(downloaded) == keys and not skipped and not failed
+    assert (tmp_path / "img01004.jpg").read_bytes() == b"raw/img01004.jpg"
+
+    # only the changed object is fetched again
+    client.put_object(Bucket=BUCKET, Key="raw/img00007.jpg", Body=b"changed")
+    downloaded, skipped, failed = s3_transfer.download_prefix(client, BUCKET, "raw/", tmp_path, max_workers=4)
+    assert downloaded == ["raw/img00007.jpg"] and len(skipped) == 1004 and not failed
+    assert (tmp_path / "img00007.jpg").read_bytes() == b"changed"
+
+
+def test_basename_collisions_are_not_downloaded(client, tmp_path):
+    put(client, ["raw/a/dup.jpg", "raw/b/dup.jpg", "raw/a/one.jpg"])
+    for _ in range(2):
+        downloaded, skipped, failed = s3_transfer.download_prefix(client, BUCKET, "raw/", tmp_path)
+        assert sorted(failed) == ["raw/a/dup.jpg", "raw/b/dup.jpg"]
+    # the second run skips the unique key instead of fetching it again
+    assert downloaded == [] and skipped == ["raw/a/one.jpg"]
+    assert not (tmp_path / "dup.jpg").exists()
+    assert not list(tmp_path.glob("*.part"))
+
+
+def test_interrupted_download_keeps_finished_keys(client, tmp_path):
+    keys = [f"raw/img{i}.jpg" for i in range(5)]
+    put(client, keys)
+
+    class Interrupting(object):
+        """Delegates to the moto client but is interrupted on the fourth download."""
+
+        def __init__(self, client):
+            self.client = client
+            self.calls = 0
+
+        def __getattr__(self, name):
+            return getattr(self.client, name)
+
+        def download_file(self, *args, **kwargs):
+            self.calls += 1
+            if self.calls == 4:
+                raise KeyboardInterrupt
+            return self.client.download_file(*args, **kwargs)
+
+    with pytest.raises(KeyboardInterrupt):
+        s3_transfer.download_prefix(Interrupting(client), BUCKET, "raw/", tmp_path, max_workers=1)
+    manifest = json.loads((tmp_path / s3_transfer.MANIFEST_NAME).read_text())
+    assert len(manifest) == 3
+
+    downloaded, skipped, failed = s3_transfer.download_prefix(client, BUCKET, "raw/", tmp_path)
+    assert len(skipped) == 3 and len(downloaded) == 2 and not failed
+
+
+def test_interrupted_upload_keeps_finished_files(client, tmp_path):
+    files = []
+    for i in range(5):
+        path = tmp_path / f"img{i}.png"
+        path.write_bytes(b"png %d" % i)
+        files.append(path)
+    manifest_path = tmp_path / s3_transfer.MANIFEST_NAME
+
+    class Interrupting(object):
+        """Delegates to the moto client but is interrupted on the fourth upload."""
+
+        def __init__(self, client):
+            self.client = client
+            self.calls = 0
+
+        def __getattr__(self, name):
+            return getattr(self.client, name)
+
+        def upload_file(self, *args, **kwargs):
+            self.calls += 1
+            if self.calls == 4:
+                raise KeyboardInterrupt
+            return self.client.upload_file(*args, **kwargs)
+
+    with pytest.raises(KeyboardInterrupt):
+        s3_transfer.upload_files(Interrupting(client), BUCKET, "out/", files, manifest_path, max_workers=1)
+    assert len(json.loads(manifest_path.read_text())) == 3
+
+    uploaded, skipped, failed = s3_transfer.upload_files(client, BUCKET, "out/", files, manifest_path)
+    assert len(skipped) == 3 and len(uploaded) == 2 and not failed